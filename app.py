@@ -15,6 +15,7 @@ from recommendation.recommender_views import bp as recommendation_bp
 import exceptions_views
 from apispec.ext.marshmallow import MarshmallowPlugin
 from common.utils.utils import cache
+from common.utils.artifact_registry import artifact_registry
 from dotenv import load_dotenv
 
 logging.basicConfig(
@@ -81,6 +82,9 @@ def create_app():
 
     cache.init_app(app)
 
+    # Artifacts load in the background from startup, then follow newly published versions
+    artifact_registry.start()
+
     CORS(app, origins=[os.getenv("ORIGINS")])
 
     app.register_blueprint(users_bp)
@@ -0,0 +1,217 @@
+import datetime
+import os
+import pickle
+import sys
+import threading
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Any
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
+from dotenv import load_dotenv
+from common.utils import azure_blob
+from common.utils.logging_service import logger
+
+load_dotenv()
+
+# Seconds between checks of the published manifest for new artifacts
+ARTIFACT_REFRESH_SECONDS = int(os.getenv("ARTIFACT_REFRESH_SECONDS", "300"))
+
+
+class LazyArtifacts(Mapping):
+    """
+    The artifacts of one published version, each loaded the first time it is read and then kept as it is.
+    """
+
+    def __init__(self, manifest: dict, declared: frozenset = frozenset()):
+        self.manifest = manifest
+        self.declared = declared
+        self._values = {}
+        self._load_lock = threading.Lock()
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._values:
+            return self._values[key]
+        if key not in azure_blob.ARTIFACTS:
+            raise KeyError(key)
+
+        with self._load_lock:
+            if key not in self._values:
+                if key not in self.declared:
+                    logger.warning(
+                        f"Artifact {key} is not declared, it is loaded on the request path"
+                    )
+
+                value = azure_blob.load_artifact(key, manifest=self.manifest)
+                if isinstance(value, np.ndarray):
+                    value.flags.writeable = False  # shared by every request
+
+                self._values[key] = value
+                logger.info(
+                    f"Loaded artifact {key}: {get_artifact_size(value) / 1024**2:.1f} MB"
+                    f"{' memory mapped' if isinstance(value, np.memmap) else ''}"
+                )
+
+        return self._values[key]
+
+    def __contains__(self, key) -> bool:
+        return key in azure_blob.ARTIFACTS
+
+    def __iter__(self):
+        return iter(azure_blob.ARTIFACTS)
+
+    def __len__(self) -> int:
+        return len(azure_blob.ARTIFACTS)
+
+    def memory_usage(self) -> dict[str, int]:
+        """
+        :return: estimated bytes held by each artifact loaded so far
+        """
+        return {key: get_artifact_size(value) for key, value in self._values.items()}
+
+
+@dataclass(frozen=True)
+class ArtifactSnapshot:
+    """
+    One published version of the artifacts, never changed once loaded.
+    A request should take one snapshot and read every artifact it needs from it.
+    """
+
+    artifacts: LazyArtifacts
+    manifest: dict
+    loaded_at: datetime.datetime
+
+
+class ArtifactRegistry:
+    """
+    Loads the artifacts once per process. A background thread checks the published manifest
+    and loads a new version next to the current one, then swaps it in as a whole,
+    so requests never wait on a load or see part of one.
+    Only the artifacts declared by consumers are loaded up front, any other loads when first read.
+    """
+
+    def __init__(self, refresh_seconds: int = ARTIFACT_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._declared = set()
+        self._snapshot: ArtifactSnapshot | None = None
+        self._load_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def declare(self, keys: list[str]):
+        """
+        Declares artifacts a consumer reads, they are loaded with every new snapshot before it is swapped in.
+        """
+        unknown = set(keys) - set(azure_blob.ARTIFACTS)
+        if unknown:
+            raise ValueError(f"Unknown artifact keys: {sorted(unknown)}")
+
+        self._declared.update(keys)
+
+    def start(self):
+        """
+        Loads the artifacts in the background and keeps them up to date, call on startup so requests don't load them.
+        """
+        with self._load_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, daemon=True)
+                self._thread.start()
+
+    def get(self) -> ArtifactSnapshot:
+        """
+        The current snapshot, only loaded on the request path when no snapshot was loaded yet.
+        Raises when there is no snapshot and the manifest can't be read.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._load_lock:
+                if self._snapshot is None:
+                    self._load(azure_blob.read_manifest())
+            snapshot = self._snapshot
+
+        return snapshot
+
+    def refresh(self) -> bool:
+        """
+        Swaps in the published artifacts if they are newer than the current snapshot.
+        The current snapshot is kept while the manifest can't be read.
+        :return: whether a new snapshot was loaded
+        """
+        try:
+            manifest = azure_blob.read_manifest()
+        except Exception as e:
+            logger.warning(f"Artifact manifest could not be read: {e}")
+            return False
+
+        with self._load_lock:
+            if self._snapshot is not None and manifest == self._snapshot.manifest:
+                return False
+
+            self._load(manifest)
+            return True
+
+    def memory_usage(self) -> dict[str, int]:
+        """
+        :return: estimated bytes held by each artifact loaded in the current snapshot
+        """
+        snapshot = self._snapshot
+        return {} if snapshot is None else snapshot.artifacts.memory_usage()
+
+    def _load(self, manifest: dict):
+        # downloaded in parallel first, then loaded one at a time
+        azure_blob.sync_artifacts(sorted(self._declared), manifest=manifest)
+        artifacts = LazyArtifacts(manifest, frozenset(self._declared))
+        for key in sorted(self._declared):
+            artifacts[key]
+
+        previous = self._snapshot
+        self._snapshot = ArtifactSnapshot(
+            artifacts=artifacts,
+            manifest=manifest,
+            loaded_at=datetime.datetime.now(tz=datetime.timezone.utc),
+        )
+        # requests still holding the previous snapshot may read artifacts it has not loaded yet
+        azure_blob.prune_version_dirs(
+            keep=[manifest] + ([previous.manifest] if previous else [])
+        )
+
+        logger.info(
+            f"Loaded artifacts {manifest['version']}: "
+            f"{sum(artifacts.memory_usage().values()) / 1024**2:.1f} MB"
+        )
+
+    def _watch(self):
+        while True:
+            try:
+                if self._snapshot is None:
+                    self.get()
+                else:
+                    self.refresh()
+            except Exception as e:
+                # the current snapshot keeps being served, the load is retried on the next check
+                logger.warning(f"Artifact refresh failed: {e}")
+
+            time.sleep(self.refresh_seconds)
+
+
+def get_artifact_size(value: Any) -> int:
+    """
+    Estimated bytes held by a loaded artifact, by content for arrays, matrices, DataFrames and dicts
+    and by pickled size for anything else, such as the fitted TF-IDF vectorizer.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if issparse(value):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            sys.getsizeof(key) + sys.getsizeof(item) for key, item in value.items()
+        )
+
+    return len(pickle.dumps(value))
+
+
+artifact_registry = ArtifactRegistry()
@@ -0,0 +1,144 @@
+import os
+import shutil
+from abc import ABC, abstractmethod
+from pathlib import Path
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
+from azure.storage.blob import BlobServiceClient
+
+# Bytes read per request (Azure) or per copy (local directory) when streaming an artifact to disk
+CHUNK_BYTES = 8 * 1024**2
+
+
+class ArtifactStorage(ABC):
+    """
+    Where artifacts are published, blob paths are relative like "latest/movie_ids.npy".
+    ETags are opaque strings that change whenever the content of a blob does.
+    """
+
+    @abstractmethod
+    def download(
+        self, blob_path: str, local_path: Path, etag: str | None = None
+    ) -> str | None:
+        """
+        Streams a blob to local_path in chunks.
+        :param etag: ETag of the copy already cached, the blob is then only downloaded when it changed since
+        :return: ETag of the downloaded blob, None when it is unchanged and nothing was written
+        """
+
+    @abstractmethod
+    def upload(self, local_path: Path, blob_path: str) -> str:
+        """
+        :return: ETag of the uploaded blob
+        """
+
+    @abstractmethod
+    def read(self, blob_path: str) -> bytes:
+        """
+        Reads a small blob, such as the manifest, into memory.
+        """
+
+
+class AzureBlobStorage(ArtifactStorage):
+    def __init__(
+        self,
+        account_url: str,
+        container_name: str,
+        credential: str | None,
+        max_concurrency: int = 4,
+    ):
+        self.container_name = container_name
+        self.max_concurrency = max_concurrency
+        self.blob_service_client = BlobServiceClient(
+            account_url=account_url,
+            credential=credential,
+            max_single_get_size=CHUNK_BYTES,
+            max_chunk_get_size=CHUNK_BYTES,
+        )
+
+    def download(
+        self, blob_path: str, local_path: Path, etag: str | None = None
+    ) -> str | None:
+        blob_client = self.blob_service_client.get_blob_client(
+            container=self.container_name, blob=blob_path
+        )
+        conditions = (
+            {"etag": etag, "match_condition": MatchConditions.IfModified}
+            if etag is not None
+            else {}
+        )
+
+        try:
+            # ranged requests of CHUNK_BYTES, max_concurrency at a time, written straight to the file
+            downloader = blob_client.download_blob(
+                max_concurrency=self.max_concurrency, **conditions
+            )
+        except ResourceNotModifiedError:
+            return None
+
+        with open(local_path, "wb") as f:
+            downloader.readinto(f)
+
+        return downloader.properties.etag
+
+    def upload(self, local_path: Path, blob_path: str) -> str:
+        blob_client = self.blob_service_client.get_blob_client(
+            container=self.container_name, blob=blob_path
+        )
+        with open(local_path, "rb") as f:
+            result = blob_client.upload_blob(
+                f,
+                overwrite=True,
+                max_concurrency=2,
+                timeout=600,
+                connection_timeout=600,
+            )
+
+        return result["etag"]
+
+    def read(self, blob_path: str) -> bytes:
+        blob_client = self.blob_service_client.get_blob_client(
+            container=self.container_name, blob=blob_path
+        )
+        return blob_client.download_blob().readall()
+
+
+class LocalDirectoryStorage(ArtifactStorage):
+    """
+    Publishes artifacts to a local directory instead of Azure Blob, e.g. for tests or running offline.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def download(
+        self, blob_path: str, local_path: Path, etag: str | None = None
+    ) -> str | None:
+        with open(self.root / blob_path, "rb") as src:
+            # the ETag of the file opened, even if a new one is renamed over it meanwhile
+            source_etag = self._etag(os.fstat(src.fileno()))
+            if etag == source_etag:
+                return None
+
+            with open(local_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, CHUNK_BYTES)
+
+        return source_etag
+
+    def upload(self, local_path: Path, blob_path: str) -> str:
+        target = self.root / blob_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        # renamed into place like the local cache, so a download never copies a partial file
+        tmp_path = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+        shutil.copyfile(local_path, tmp_path)
+        etag = self._etag(tmp_path.stat())
+        os.replace(tmp_path, target)
+
+        return etag
+
+    def read(self, blob_path: str) -> bytes:
+        return (self.root / blob_path).read_bytes()
+
+    def _etag(self, stat: os.stat_result) -> str:
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
@@ -1,14 +1,23 @@
 import datetime
+import hashlib
 import json
+import shutil
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 import joblib
 import numpy as np
 import pandas as pd
-from azure.storage.blob import BlobServiceClient
+from scipy.sparse import csr_matrix, load_npz, save_npz
 from pathlib import Path
 import os
 from dotenv import load_dotenv
+from common.utils.artifact_storage import (
+    CHUNK_BYTES,
+    ArtifactStorage,
+    AzureBlobStorage,
+    LocalDirectoryStorage,
+)
 
 load_dotenv()
 
@@ -18,52 +27,87 @@ AZURE_CONTAINER_NAME = os.getenv("AZURE_CONTAINER_NAME")
 AZURE_CREDENTIAL = os.getenv("AZURE_CREDENTIAL")
 
 # Artifacts to load (blob path → local filename)
+# Model artifacts are only uploaded under their version and are only read through the published manifest,
+# which has no fallback to latest/. These latest/ paths are read for artifacts the manifest doesn't list,
+# such as the external interactions
 ARTIFACTS = {
     "tfidf_vectorizer": "latest/tfidf_vectorizer.pkl",
-    "item_feature_matrix": "latest/item_feature_matrix.npy",
-    "item_feature_matrix_movie_id_lookup": "latest/item_feature_matrix_movie_id_lookup.json",
+    # Sorted movie id table, the movie codes every matrix artifact is indexed by
+    "movie_ids": "latest/movie_ids.npy",
+    "item_feature_matrix": "latest/item_feature_matrix.npz",
     "baseline_recs": "latest/baseline_recommendations.parquet",
     "movie_features": "latest/movie_features.npy",
-    "movie_features_movie_id_lookup": "latest/movie_features_movie_id_lookup.json",
+    "movie_features_movie_codes": "latest/movie_features_movie_codes.npy",
     "movies_metadata": "latest/movies_metadata.parquet",
+    "movie_quality_prior": "latest/movie_quality_prior.npy",
     "external_interactions_transformed": "latest/external_interactions_transformed.parquet",
 }
 
+# Model matrices saved as float32, C-contiguous .npy and opened memory mapped,
+# so every worker process on a host reads one shared page cache copy instead of loading its own
+MMAP_ARTIFACTS = {"movie_features"}
+
+# Published last by save_all_artifacts, so a new version is only seen once all its artifacts are uploaded
+MANIFEST_BLOB = "latest/manifest.json"
+
+# Local cache subdirectory artifacts of a published version are kept in, one directory per version
+VERSIONS_DIR = "versions"
+
 # Local cache directory
 CACHE_DIR = Path("artifacts")
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
-blob_service_client = BlobServiceClient(
-    account_url=AZURE_ACCOUNT_URL,
-    credential=AZURE_CREDENTIAL,
-)
+# Suffix of the file next to each cached artifact recording the ETag and content hash it was downloaded with
+CACHE_ENTRY_SUFFIX = ".etag.json"
 
+# Artifacts downloaded at once, each also downloaded in parallel chunks by the Azure backend
+ARTIFACT_DOWNLOAD_CONCURRENCY = int(os.getenv("ARTIFACT_DOWNLOAD_CONCURRENCY", "4"))
 
-def download_blob_to_cache(blob_path: str, local_path: Path):
-    blob_client = blob_service_client.get_blob_client(
-        container=AZURE_CONTAINER_NAME, blob=blob_path
+# Local directory artifacts are published to and read from instead of Azure Blob, e.g. in tests
+ARTIFACT_STORAGE_DIR = os.getenv("ARTIFACT_STORAGE_DIR")
+
+storage: ArtifactStorage = (
+    LocalDirectoryStorage(Path(ARTIFACT_STORAGE_DIR))
+    if ARTIFACT_STORAGE_DIR
+    else AzureBlobStorage(
+        AZURE_ACCOUNT_URL,
+        AZURE_CONTAINER_NAME,
+        AZURE_CREDENTIAL,
+        max_concurrency=ARTIFACT_DOWNLOAD_CONCURRENCY,
     )
-    with open(local_path, "wb") as f:
-        f.write(blob_client.download_blob().readall())
-    print(f"Downloaded: {blob_path} → {local_path}")
+)
+
+
+def download_blob_to_cache(
+    blob_path: str, local_path: Path, etag: str | None = None
+) -> str | None:
+    """
+    :param etag: ETag of the cached copy, which is kept when the blob is unchanged
+    :return: ETag of the downloaded blob, None when the cached copy is unchanged
+    """
+    # renamed into place, so other processes reading the cache never see a partial file
+    tmp_path = local_path.with_name(f"{local_path.name}.{os.getpid()}.tmp")
+    try:
+        new_etag = storage.download(blob_path, tmp_path, etag)
+        if new_etag is not None:
+            os.replace(tmp_path, local_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    if new_etag is not None:
+        print(f"Downloaded: {blob_path} → {local_path}")
+    return new_etag
 
 
-def upload_file_to_blob(local_path: Path, blob_path: str, retries=3):
+def upload_file_to_blob(local_path: Path, blob_path: str, retries=3) -> str | None:
+    """
+    :return: ETag of the uploaded blob, None when every attempt failed
+    """
     for attempt in range(retries):
         try:
-            blob_client = blob_service_client.get_blob_client(
-                container=AZURE_CONTAINER_NAME, blob=blob_path
-            )
-            with open(local_path, "rb") as f:
-                blob_client.upload_blob(
-                    f,
-                    overwrite=True,
-                    max_concurrency=2,
-                    timeout=600,
-                    connection_timeout=600,
-                )
+            etag = storage.upload(local_path, blob_path)
             print(f"Uploaded: {local_path} → {blob_path}")
-            return
+            return etag
         except Exception as e:
             print(f"Attempt {attempt + 1} failed: {e}")
             if attempt < retries - 1:
@@ -73,44 +117,208 @@ def upload_file_to_blob(local_path: Path, blob_path: str, retries=3):
                 print(traceback.format_exc())
 
 
-def is_expired(local_path: Path, max_age_seconds: int = 86400):  # 24 hrs
-    return (
-        not local_path.exists()
-        or (time.time() - local_path.stat().st_mtime) > max_age_seconds
+def get_artifact_path(
+    key: str, force_refresh=False, manifest: dict | None = None
+) -> Path:
+    """
+    Local path of an artifact, downloaded first unless the cached copy is known to be current.
+    For artifacts read in parts rather than loaded into memory.
+    :param manifest: Published manifest to read the artifact of, cached in a directory per version and
+                     used without a request while its hash matches the manifest.
+                     The latest artifact when None or when the manifest doesn't list it, downloaded only if its ETag changed
+    """
+    filename = Path(ARTIFACTS[key]).name
+
+    versioned = manifest is not None and key in manifest["artifacts"]
+    if versioned:
+        blob_path = f"{manifest['version']}/{filename}"
+        local_path = get_version_dir(manifest) / filename
+        expected = __get_manifest_entry(manifest, key)
+    else:
+        blob_path = ARTIFACTS[key]
+        local_path = CACHE_DIR / filename
+        expected = None
+
+    cached = __read_cache_entry(local_path)
+    if versioned and not force_refresh and cached is not None:
+        # a published version never changes, its copy is current unless the version was published again
+        if expected is None or cached.get("sha256") == expected.get("sha256"):
+            print(f"Using cached {key} from {local_path}")
+            return local_path
+
+    etag = None if force_refresh or cached is None else cached.get("etag")
+    new_etag = download_blob_to_cache(blob_path, local_path, etag)
+    if new_etag is None:
+        print(f"Using cached {key} from {local_path}, unchanged")
+        return local_path
+
+    sha256 = get_file_sha256(local_path)
+    if expected is not None and expected.get("sha256") not in (None, sha256):
+        local_path.unlink(missing_ok=True)
+        raise ValueError(f"Downloaded {key} doesn't match the published manifest")
+
+    __write_json_atomically(
+        __cache_entry_path(local_path), {"etag": new_etag, "sha256": sha256}
     )
+    return local_path
 
 
-def load_artifacts(force_refresh=False):
-    artifacts = {}
+def sync_artifacts(
+    keys: list[str], force_refresh=False, manifest: dict | None = None
+) -> dict[str, Path]:
+    """
+    Brings the cached copies of the artifacts up to date, ARTIFACT_DOWNLOAD_CONCURRENCY at a time.
+    :return: local path of each artifact, see get_artifact_path
+    """
+    if manifest is not None:
+        get_version_dir(manifest)  # prepared once, before the downloads into it
 
-    for key, blob_path in ARTIFACTS.items():
-        filename = Path(blob_path).name
-        local_path = CACHE_DIR / filename
+    with ThreadPoolExecutor(max_workers=ARTIFACT_DOWNLOAD_CONCURRENCY) as executor:
+        paths = executor.map(
+            lambda key: get_artifact_path(key, force_refresh, manifest), keys
+        )
+        return dict(zip(keys, paths))
 
-        if force_refresh or not local_path.exists() or is_expired(local_path):
-            print(f"Downloading {key} from Azure Blob...")
-            download_blob_to_cache(blob_path, local_path)
-        else:
-            print(f"Using cached {key} from {local_path}")
 
-        # Load into memory
-        if filename.endswith(".pkl"):
-            artifacts[key] = joblib.load(local_path)
-        elif filename.endswith(".npy"):
-            artifacts[key] = np.load(local_path)
-        elif filename.endswith(".json"):
-            with open(local_path) as f:
-                artifacts[key] = json.load(f)
-        elif filename.endswith(".parquet"):
-            artifacts[key] = pd.read_parquet(local_path)
+def load_artifact(key: str, force_refresh=False, manifest: dict | None = None):
+    """
+    Loads one artifact into memory, see get_artifact_path.
+    """
+    return __read_artifact(key, get_artifact_path(key, force_refresh, manifest))
+
+
+def load_artifacts(force_refresh=False, keys: list[str] | None = None):
+    """
+    Loads the artifacts of the published manifest, see get_artifact_path.
+    Raises when the manifest can't be read, the latest/ model artifacts are not kept up to date.
+    :param keys: Artifacts to load, every artifact when None
+    """
+    manifest = read_manifest()
+
+    paths = sync_artifacts(
+        list(keys if keys is not None else ARTIFACTS), force_refresh, manifest
+    )
+    artifacts = {key: __read_artifact(key, path) for key, path in paths.items()}
 
     print("All artifacts ready.")
     return artifacts
 
 
-def save_and_upload_artifact(key: str, data, version: str = "latest"):
+def __read_artifact(key: str, local_path: Path):
+    filename = local_path.name
+
+    if filename.endswith(".pkl"):
+        return joblib.load(local_path)
+    elif filename.endswith(".npy"):
+        # read only, the cached file may only be replaced by renaming a new one over it
+        return np.load(local_path, mmap_mode="r" if key in MMAP_ARTIFACTS else None)
+    elif filename.endswith(".npz"):
+        return load_npz(local_path)
+    elif filename.endswith(".json"):
+        with open(local_path) as f:
+            return json.load(f)
+    elif filename.endswith(".parquet"):
+        return pd.read_parquet(local_path)
+
+
+def read_manifest() -> dict:
+    """
+    The manifest of the latest published artifacts, read straight from storage.
+    """
+    return json.loads(storage.read(MANIFEST_BLOB))
+
+
+def get_file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def __get_manifest_entry(manifest: dict, key: str) -> dict | None:
+    # manifests published before content hashes list only the keys
+    artifacts = manifest["artifacts"]
+    return artifacts[key] if isinstance(artifacts, dict) else None
+
+
+def __cache_entry_path(local_path: Path) -> Path:
+    return local_path.with_name(f"{local_path.name}{CACHE_ENTRY_SUFFIX}")
+
+
+def __read_cache_entry(local_path: Path) -> dict | None:
+    entry_path = __cache_entry_path(local_path)
+    if not local_path.exists() or not entry_path.exists():
+        return None
+
+    with open(entry_path) as f:
+        return json.load(f)
+
+
+def get_version_dir(manifest: dict) -> Path:
+    """
+    Local cache directory of a published version, emptied when the version was published again since.
+    """
+    version_dir = CACHE_DIR / VERSIONS_DIR / manifest["version"]
+    manifest_path = version_dir / Path(MANIFEST_BLOB).name
+
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return version_dir
+
+        # only a version published again is emptied, concurrent first downloads of a version share its directory
+        shutil.rmtree(version_dir, ignore_errors=True)
+
+    version_dir.mkdir(parents=True, exist_ok=True)
+    __write_json_atomically(manifest_path, manifest)
+    return version_dir
+
+
+def prune_version_dirs(keep: list[dict]):
+    """
+    Removes the cached versions older than those of the manifests in keep.
+    Versions are dated, newer ones may be downloading for another process sharing the cache and are left alone.
+    """
+    versions_dir = CACHE_DIR / VERSIONS_DIR
+    if not versions_dir.exists():
+        return
+
+    oldest_kept = min(manifest["version"] for manifest in keep)
+    for version_dir in versions_dir.iterdir():
+        if version_dir.name < oldest_kept:
+            shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def publish_manifest(version: str, artifacts: dict[str, dict]):
+    """
+    Uploads the manifest of the artifacts just saved under version and as latest.
+    :param artifacts: content hash, size and ETag of each artifact saved, see save_and_upload_artifact
+    """
+    manifest = {
+        "version": version,
+        "published_at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        "artifacts": artifacts,
+    }
+    local_path = CACHE_DIR / Path(MANIFEST_BLOB).name
+    __write_json_atomically(local_path, manifest)
+
+    upload_file_to_blob(local_path, f"{version}/{local_path.name}")
+    upload_file_to_blob(local_path, MANIFEST_BLOB)
+
+
+def __write_json_atomically(path: Path, data: dict):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def save_and_upload_artifact(key: str, data, version: str = "latest") -> dict:
     """
     Save and upload an artifact. `key` must match keys in ARTIFACTS.
+    :return: content hash, size and ETag of the uploaded artifact, as listed in the manifest
     """
     if key not in ARTIFACTS:
         raise ValueError(f"Unknown artifact key: {key}")
@@ -118,12 +326,23 @@ def save_and_upload_artifact(key: str, data, version: str = "latest"):
     filename = Path(ARTIFACTS[key]).name
     blob_path = f"{version}/{filename}"
     local_path = CACHE_DIR / filename
+    # the cached ETag no longer describes the file once it is overwritten
+    __cache_entry_path(local_path).unlink(missing_ok=True)
 
     # Save locally
     if filename.endswith(".pkl"):
         joblib.dump(data, local_path)
     elif filename.endswith(".npy"):
-        np.save(local_path, data)
+        if key in MMAP_ARTIFACTS:
+            # np.save aligns the data after the header, contiguous float32 maps without conversion
+            data = np.ascontiguousarray(data, dtype=np.float32)
+        # renamed into place, a process mapping the cached file keeps reading the old one
+        tmp_path = local_path.with_name(f"{local_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp_path, local_path)
+    elif filename.endswith(".npz"):
+        save_npz(local_path, csr_matrix(data, dtype=np.float32))
     elif filename.endswith(".json"):
         with open(local_path, "w") as f:
             json.dump(data, f)
@@ -133,19 +352,31 @@ def save_and_upload_artifact(key: str, data, version: str = "latest"):
         raise ValueError("Unsupported file type for saving")
 
     # Upload to Blob
-    upload_file_to_blob(local_path, blob_path)
+    entry = {
+        "sha256": get_file_sha256(local_path),
+        "size": local_path.stat().st_size,
+        "etag": upload_file_to_blob(local_path, blob_path),
+    }
+    if version == "latest" and entry["etag"] is not None:
+        # the saved file is the cached copy of latest, so it isn't downloaded again
+        __write_json_atomically(
+            __cache_entry_path(local_path),
+            {"etag": entry["etag"], "sha256": entry["sha256"]},
+        )
 
     print(f"{key} saved & uploaded to Azure Blob.")
+    return entry
 
 
 def save_all_artifacts(
     tfidf_vectorizer,
+    movie_ids,
     item_feature_matrix,
-    item_feature_matrix_movie_id_lookup,
     baseline_recs,
     movie_features,
-    movie_features_movie_id_lookup,
+    movie_features_movie_codes,
     movies_metadata,
+    movie_quality_prior,
     version=None,
 ):
     # Use current date if no version provided
@@ -154,16 +385,26 @@ def save_all_artifacts(
 
     print(f"Saving and uploading artifacts under version: {version}")
 
-    def save_dual(key, data):
-        save_and_upload_artifact(key, data, version=version)
-        save_and_upload_artifact(key, data, version="latest")
+    # Uploaded once under the version, readers find it through the manifest published last
+    saved = {
+        key: save_and_upload_artifact(key, data, version=version)
+        for key, data in [
+            ("tfidf_vectorizer", tfidf_vectorizer),
+            ("movie_ids", movie_ids),
+            ("item_feature_matrix", item_feature_matrix),
+            ("baseline_recs", baseline_recs),
+            ("movie_features", movie_features),
+            ("movie_features_movie_codes", movie_features_movie_codes),
+            ("movies_metadata", movies_metadata),
+            ("movie_quality_prior", movie_quality_prior),
+        ]
+    }
 
-    save_dual("tfidf_vectorizer", tfidf_vectorizer)
-    save_dual("item_feature_matrix", item_feature_matrix)
-    save_dual(
-        "item_feature_matrix_movie_id_lookup", item_feature_matrix_movie_id_lookup
-    )
-    save_dual("baseline_recs", baseline_recs)
-    save_dual("movie_features", movie_features)
-    save_dual("movie_features_movie_id_lookup", movie_features_movie_id_lookup)
-    save_dual("movies_metadata", movies_metadata)
+    failed = [key for key, entry in saved.items() if entry["etag"] is None]
+    if failed:
+        # readers would switch to a version missing these artifacts, the previous manifest stays published
+        raise ValueError(
+            f"Artifacts failed to upload, not publishing {version}: {failed}"
+        )
+
+    publish_manifest(version, saved)
@@ -1,8 +1,9 @@
 from flask import Blueprint, jsonify
+import psutil
 import psycopg
 
 from common.utils.utils import DB_CONFIG
-
+from common.utils.artifact_registry import artifact_registry
 
 bp_name = "utils"
 bp_url_prefix = "/api/v1.0"
@@ -20,9 +21,20 @@ def check_database():
 @bp.route("/health", methods=["GET"])
 def health_check():
     db_status = check_database()
+    memory = psutil.Process().memory_info()
 
     return jsonify(
         {
             "database": "up" if db_status else "down",
+            # only the artifacts loaded so far, reading them here would load them
+            "artifacts_mb": {
+                key: round(size / 1024**2, 1)
+                for key, size in artifact_registry.memory_usage().items()
+            },
+            # memory mapped artifacts count in rss but their pages are shared with the other workers
+            "worker_memory_mb": {
+                "rss": round(memory.rss / 1024**2, 1),
+                "shared": round(memory.shared / 1024**2, 1),
+            },
         }
     )
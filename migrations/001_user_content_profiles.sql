@@ -0,0 +1,11 @@
+-- Content profiles used to explain recommendations on request,
+-- replacing the explanation blobs the batch job used to store per recommendation.
+CREATE TABLE IF NOT EXISTS user_content_profiles (
+    user_id INTEGER PRIMARY KEY,
+    feature_indices INTEGER[] NOT NULL,
+    feature_weights REAL[] NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Explanations are no longer written, clear the old ones so VACUUM can reclaim the space.
+UPDATE user_recommendations SET explanation = NULL WHERE explanation IS NOT NULL;
@@ -0,0 +1,19 @@
+-- User shards of a distributed nightly recommender run, claimed by workers through leases.
+-- A shard covers user codes [user_code_start, user_code_stop) of the run's scoring bundle.
+CREATE TABLE IF NOT EXISTS recommender_shard_leases (
+    run_id TEXT NOT NULL,
+    shard_id INTEGER NOT NULL,
+    user_code_start INTEGER NOT NULL,
+    user_code_stop INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'leased', 'done')),
+    worker_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_expires_at TIMESTAMPTZ,
+    heartbeat_at TIMESTAMPTZ,
+    completed_at TIMESTAMPTZ,
+    PRIMARY KEY (run_id, shard_id)
+);
+
+-- Workers look for claimable shards of a run
+CREATE INDEX IF NOT EXISTS recommender_shard_leases_claimable_idx
+    ON recommender_shard_leases (run_id, status, lease_expires_at);
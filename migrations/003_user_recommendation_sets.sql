@@ -0,0 +1,46 @@
+-- Compact recommendation layout, one row per user with parallel arrays ordered by predicted score.
+-- Written by the recommender when RECOMMENDER_STORAGE_LAYOUT=arrays.
+CREATE TABLE IF NOT EXISTS user_recommendation_sets (
+    user_id INTEGER PRIMARY KEY,
+    movie_ids TEXT[] NOT NULL,
+    predicted_scores REAL[] NOT NULL,
+    cf_scores REAL[] NOT NULL,
+    content_scores REAL[] NOT NULL,
+    model_version TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Same columns as user_recommendations, read paths query this when the arrays layout is used.
+-- The user_id predicate of a query is pushed into the view, so only that users arrays are unnested.
+CREATE OR REPLACE VIEW user_recommendation_pairs AS
+SELECT
+    urs.user_id,
+    pair.movie_id,
+    pair.predicted_score,
+    pair.cf_score,
+    pair.content_score,
+    urs.model_version,
+    urs.updated_at
+FROM user_recommendation_sets urs
+CROSS JOIN LATERAL unnest(
+    urs.movie_ids, urs.predicted_scores, urs.cf_scores, urs.content_scores
+) AS pair(movie_id, predicted_score, cf_score, content_score);
+
+-- Backfill from the row per pair table so reads keep working before the next nightly run.
+INSERT INTO user_recommendation_sets (
+    user_id, movie_ids, predicted_scores, cf_scores, content_scores, model_version, updated_at
+)
+SELECT
+    user_id,
+    array_agg(movie_id::text ORDER BY predicted_score DESC),
+    array_agg(predicted_score::real ORDER BY predicted_score DESC),
+    array_agg(cf_score::real ORDER BY predicted_score DESC),
+    array_agg(content_score::real ORDER BY predicted_score DESC),
+    'migrated',
+    MAX(updated_at)
+FROM user_recommendations
+GROUP BY user_id
+ON CONFLICT (user_id) DO NOTHING;
+
+-- get_filtered_movies_with_recommendation_score reads the arrays layout through a copy of it, see 006.
+-- Once every reader is switched, user_recommendations can be truncated.
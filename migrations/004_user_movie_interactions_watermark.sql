@@ -0,0 +1,3 @@
+-- The recommender reads interactions created or deactivated since its last run by this expression.
+CREATE INDEX IF NOT EXISTS idx_user_movie_interactions_changed_at
+    ON user_movie_interactions ((COALESCE(updated_at, created_at)));
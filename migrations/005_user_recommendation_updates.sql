@@ -0,0 +1,17 @@
+-- When each user's recommendations were last generated, written for every stored user whether or not
+-- their rows changed, since unchanged rows (and sets) keep their old updated_at.
+CREATE TABLE IF NOT EXISTS user_recommendation_updates (
+    user_id INTEGER PRIMARY KEY,
+    generated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Backfill from both layouts so the /generate check keeps working before the next nightly run.
+INSERT INTO user_recommendation_updates (user_id, generated_at)
+SELECT user_id, MAX(updated_at)
+FROM (
+    SELECT user_id, updated_at FROM user_recommendations
+    UNION ALL
+    SELECT user_id, updated_at FROM user_recommendation_sets
+) stored
+GROUP BY user_id
+ON CONFLICT (user_id) DO NOTHING;
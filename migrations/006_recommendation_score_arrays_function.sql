@@ -0,0 +1,28 @@
+-- get_filtered_movies_with_recommendation_score joins user_recommendations, which the arrays layout doesn't write.
+-- Creates get_filtered_movies_with_recommendation_score_arrays, the same function joining user_recommendation_pairs,
+-- which the movies listing calls when RECOMMENDER_STORAGE_LAYOUT=arrays. The function is maintained in the database,
+-- so the copy is made from its current definition, every overload of it.
+-- Rerun after changing get_filtered_movies_with_recommendation_score, so both stay the same.
+DO $$
+DECLARE
+    fn RECORD;
+BEGIN
+    FOR fn IN
+        SELECT p.oid
+        FROM pg_proc p
+        WHERE p.proname = 'get_filtered_movies_with_recommendation_score'
+    LOOP
+        EXECUTE regexp_replace(
+            regexp_replace(
+                pg_get_functiondef(fn.oid),
+                '\mget_filtered_movies_with_recommendation_score\M',
+                'get_filtered_movies_with_recommendation_score_arrays',
+                'g'
+            ),
+            '\muser_recommendations\M',
+            'user_recommendation_pairs',
+            'g'
+        );
+    END LOOP;
+END
+$$;
@@ -16,6 +16,10 @@ from movies.model.tag import Tag
 from movies.model.user_movie_interactions import MovieDetailsUserInteraction
 from movies.model.watch_provider import WatchProvider
 from recommendation.model.user_movie_interaction import MovieMetadata
+from recommendation.storage_layout import (
+    RECOMMENDATION_SCORE_FUNCTION,
+    RECOMMENDATIONS_RELATION,
+)
 import users.users_service as users_service
 from common.utils.utils import cache
 import hashlib
@@ -112,8 +116,8 @@ def __get_movies_and_count(
                 )
                 """
 
-    select_query_with_recommendation = """
-                SELECT * FROM get_filtered_movies_with_recommendation_score(
+    select_query_with_recommendation = f"""
+                SELECT * FROM {RECOMMENDATION_SCORE_FUNCTION}(
                     %(user_id_param)s, %(search)s, %(genre_ids)s, %(tag_ids)s,
                     %(release_date_from)s, %(release_date_to)s,
                     %(rating_from)s::numeric, %(rating_to)s::numeric, %(watch_provider_ids)s,
@@ -124,9 +128,9 @@ def __get_movies_and_count(
                 )
                 """
 
-    select_recommendations_query = """
+    select_recommendations_query = f"""
         SELECT COUNT(*) AS count
-        FROM user_recommendations ur
+        FROM {RECOMMENDATIONS_RELATION} ur
         WHERE ur.user_id = %(user_id_param)s
     """
 
@@ -469,7 +473,7 @@ def get_movies_metadata() -> List[MovieMetadata]:
 def get_watchlist_movies(user_id) -> Dict[str, List[Dict[str, any]]]:
     page_start, page_size = __get_paging_params()
 
-    query = """
+    query = f"""
      SELECT 
         m.id,
         title,
@@ -480,7 +484,7 @@ def get_watchlist_movies(user_id) -> Dict[str, List[Dict[str, any]]]:
         MAX(ur.predicted_score) AS recommendation_score
     FROM user_movie_list uml
     INNER JOIN movies m on m.id = uml.movie_id
-    LEFT JOIN user_recommendations ur ON ur.movie_id = uml.movie_id AND ur.user_id = uml.user_id
+    LEFT JOIN {RECOMMENDATIONS_RELATION} ur ON ur.movie_id = uml.movie_id AND ur.user_id = uml.user_id
     WHERE uml.user_id = %s
     GROUP BY m.id
     OFFSET %s LIMIT %s;
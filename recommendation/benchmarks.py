@@ -0,0 +1,666 @@
+import argparse
+import datetime
+import inspect
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+from pathlib import Path
+from typing import List
+import numpy as np
+import pandas as pd
+import psutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+import psycopg
+from scipy.sparse import load_npz, random as sparse_random, save_npz
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from common.utils.utils import DB_CONFIG
+from recommendation import (
+    content_based_filtering_service,
+    hybrid_recommendation_service,
+    ratings_matrix,
+)
+
+
+def benchmark_normalize_per_user(n_users: int = 10_000, n_movies: int = 20_000):
+    """
+    Compares the vectorised normalize_per_user with the previous groupby().apply() version.
+    The frame has a row per user and movie, 10k x 20k is 200M rows and several GB per copy.
+    With less memory keep --movies at the catalog size and lower --users, the users are normalised independently.
+    """
+    columns = ["content_score", "cf_score"]
+    df = __build_hybrid_frame(n_users, n_movies)
+
+    start = time.perf_counter()
+    expected = __normalize_per_user_apply(df.copy(), columns)
+    apply_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = hybrid_recommendation_service.normalize_per_user(df.copy(), columns)
+    transform_seconds = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(
+        result.sort_index(), expected.sort_index(), check_exact=True
+    )
+
+    print(f"normalize_per_user on {n_users} users x {n_movies} movies:")
+    print(f"   groupby().apply(): {apply_seconds:.2f}s")
+    print(f"   groupby().transform(): {transform_seconds:.2f}s")
+    print(f"   speedup: {apply_seconds / transform_seconds:.1f}x")
+
+
+def __build_hybrid_frame(n_users: int, n_movies: int, seed: int = 42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n_rows = n_users * n_movies
+
+    cf_score = rng.normal(size=n_rows)
+    cf_score[rng.random(n_rows) < 0.2] = np.nan  # movies without a cf score
+
+    content_score = rng.random(n_rows)
+    content_score[:n_movies] = 0.5  # a user with a constant score
+
+    return pd.DataFrame(
+        {
+            "user_code": np.repeat(np.arange(n_users, dtype=np.int32), n_movies),
+            "movie_code": np.tile(np.arange(n_movies, dtype=np.int32), n_users),
+            "content_score": content_score,
+            "cf_score": cf_score,
+        }
+    )
+
+
+def __normalize_per_user_apply(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    def normalize(group):
+        for column in columns:
+            min_val = group[column].min()
+            max_val = group[column].max()
+            if max_val - min_val == 0:
+                group[column] = 0.0
+            else:
+                group[column] = (group[column] - min_val) / (max_val - min_val)
+        return group
+
+    return df.groupby("user_code", group_keys=False).apply(normalize)
+
+
+def benchmark_quality_boost(n_users: int = 1_000, n_movies: int = 20_000):
+    """
+    Compares applying the precomputed quality prior by movie code with merging movies_metadata onto every row.
+    """
+    df = __build_hybrid_frame(n_users, n_movies)
+    df["raw_final_score"] = df["content_score"]
+    metadata = __build_quality_metadata(n_movies)
+
+    start = time.perf_counter()
+    expected = __apply_quality_boost_merge(df.copy(), metadata)
+    merge_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    quality_prior = hybrid_recommendation_service.compute_quality_prior(metadata)
+    prior_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = hybrid_recommendation_service.apply_quality_boost(df.copy(), quality_prior)
+    index_seconds = time.perf_counter() - start
+
+    np.testing.assert_allclose(
+        result["final_score"].to_numpy(), expected["final_score"].to_numpy()
+    )
+
+    print(f"apply_quality_boost on {n_users} users x {n_movies} movies:")
+    print(f"   metadata merge per row: {merge_seconds:.2f}s")
+    print(f"   quality prior, once per catalog: {prior_seconds * 1000:.2f}ms")
+    print(f"   quality prior by movie code: {index_seconds:.2f}s")
+    print(f"   speedup: {merge_seconds / index_seconds:.1f}x")
+
+
+def __build_quality_metadata(n_movies: int, seed: int = 42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+
+    vote_average = rng.random(n_movies) * 10
+    vote_average[::50] = np.nan  # movies without votes
+
+    return pd.DataFrame(
+        {
+            "popularity": rng.random(n_movies) * 150,
+            "vote_count": rng.integers(0, 3000, n_movies),
+            "vote_average": vote_average,
+        }
+    )
+
+
+def __apply_quality_boost_merge(
+    hybrid_df: pd.DataFrame, metadata: pd.DataFrame
+) -> pd.DataFrame:
+    merged = hybrid_df.merge(
+        metadata[["popularity", "vote_count", "vote_average"]].assign(
+            movie_code=np.arange(len(metadata), dtype=np.int32)
+        ),
+        on="movie_code",
+        how="left",
+    )
+
+    merged["popularity"] = merged["popularity"].clip(0, 100).fillna(0)
+    merged["vote_count"] = merged["vote_count"].clip(0, 1000).fillna(0)
+    merged["vote_average"] = merged["vote_average"].fillna(0)
+
+    C = float(metadata["vote_average"].mean())
+    m = float(metadata["vote_count"].quantile(0.70))
+    v = merged["vote_count"].astype(float)
+    R = merged["vote_average"].astype(float)
+    merged["rating_score"] = ((v / (v + m)) * R + (m / (v + m)) * C) / 10
+    merged["popularity_score"] = np.tanh(merged["popularity"].astype(float) / 40)
+
+    merged["final_score"] = (
+        0.75 * merged["raw_final_score"]
+        + 0.05 * merged["popularity_score"]
+        + 0.1 * merged["rating_score"]
+    )
+
+    return merged
+
+
+def benchmark_interaction_scoring(
+    n_rows: int = 50_000_000, n_small_rows: int = 50, small_repeats: int = 1000
+):
+    """
+    Compares the numpy interaction scoring kernel with the previous pandas masks and groupby,
+    on the nightly batch (n_rows) and on one user's interactions online (n_small_rows).
+    """
+    reference_date = datetime.date(2025, 1, 1)
+
+    for n, repeats in [(n_rows, 1), (n_small_rows, small_repeats)]:
+        df = __build_interactions_frame(n)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            expected = __aggregate_interactions_masks(df.copy(), reference_date)
+        masks_seconds = (time.perf_counter() - start) / repeats
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            # unwrapped, so time_it's logging isn't timed along with it
+            result = ratings_matrix.aggregate_interactions.__wrapped__(
+                df, reference_date
+            )
+        kernel_seconds = (time.perf_counter() - start) / repeats
+
+        pd.testing.assert_frame_equal(
+            result[["user_id", "movie_id", "final_score"]], expected, check_exact=False
+        )
+
+        print(f"aggregate_interactions on {n} interactions:")
+        print(f"   masks and groupby: {masks_seconds * 1000:.2f}ms")
+        print(f"   numpy kernel: {kernel_seconds * 1000:.2f}ms")
+        print(f"   speedup: {masks_seconds / kernel_seconds:.1f}x")
+
+
+def __build_interactions_frame(n_rows: int, seed: int = 42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n_users = max(1, n_rows // 50)
+
+    interaction_type = rng.choice(ratings_matrix.INTERACTION_TYPES, n_rows)
+    rating = rng.integers(1, 11, n_rows).astype(float)
+    rating[interaction_type != "RATING"] = np.nan
+
+    return pd.DataFrame(
+        {
+            "user_id": rng.integers(0, n_users, n_rows),
+            "movie_id": rng.integers(0, 20_000, n_rows),
+            "interaction_type": interaction_type.astype(object),
+            "rating": rating,
+            "created_at": pd.Timestamp("2023-01-01")
+            + pd.to_timedelta(rng.integers(0, 730 * 24, n_rows), unit="h"),
+        }
+    )
+
+
+def __aggregate_interactions_masks(
+    df_all: pd.DataFrame, reference_date: datetime.date
+) -> pd.DataFrame:
+    df_all["user_id"] = df_all["user_id"].astype(str)
+    df_all["movie_id"] = df_all["movie_id"].astype(str)
+
+    df_all["interaction_score"] = 0.0
+    rating_mask = df_all["interaction_type"] == "RATING"
+    df_all.loc[rating_mask, "interaction_score"] = (
+        df_all.loc[rating_mask, "rating"].astype(float) - 5
+    )
+    df_all.loc[df_all["interaction_type"] == "LIKE", "interaction_score"] = 2
+    df_all.loc[df_all["interaction_type"] == "WATCHED", "interaction_score"] = 1.0
+    df_all.loc[df_all["interaction_type"] == "REVIEW", "interaction_score"] = 1.2
+
+    created_at = pd.to_datetime(df_all["created_at"]).dt.tz_localize("UTC")
+    days_ago = (
+        pd.Timestamp(reference_date, tz="UTC") - created_at.dt.floor("D")
+    ).dt.days
+    df_all["adjusted_score"] = df_all["interaction_score"] * 0.97 ** days_ago.clip(
+        lower=0
+    )
+
+    return (
+        df_all.groupby(["user_id", "movie_id"])["adjusted_score"]
+        .sum()
+        .reset_index()
+        .rename(columns={"adjusted_score": "final_score"})
+    )
+
+
+def benchmark_arrow_aggregation(n_rows: int = 50_000_000):
+    """
+    Compares reading the external interactions parquet into pandas before aggregating it with
+    streaming it through aggregate_interaction_batches, each in a fresh process so their peak memory can be compared.
+    """
+    reference_date = datetime.date(2025, 1, 1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "external_interactions_transformed.parquet"
+        __write_external_interactions(path, n_rows)
+
+        results = {}
+        for streamed in [False, True]:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[streamed] = executor.submit(
+                    __aggregate_external_interactions, path, streamed, reference_date
+                ).result()
+
+    pd.testing.assert_frame_equal(
+        results[True][0], results[False][0], check_exact=False
+    )
+
+    print(f"Aggregating {n_rows} external interactions:")
+    for streamed, label in [
+        (False, "read_parquet and numpy kernel"),
+        (True, "arrow batches"),
+    ]:
+        _, seconds, peak_bytes = results[streamed]
+        print(f"   {label}: {seconds:.2f}s, peak memory +{peak_bytes / 1024**2:.0f} MB")
+
+
+def __write_external_interactions(path: Path, n_rows: int, seed: int = 42):
+    """
+    Written in parts so the benchmark data never has to fit in memory.
+    """
+    rng = np.random.default_rng(seed)
+    n_users = max(1, n_rows // 50)
+    usernames = np.array([f"lb_user{i}" for i in range(n_users)], dtype=object)
+    movie_ids = np.array([f"{i:024x}" for i in range(20_000)], dtype=object)
+
+    with pq.ParquetWriter(
+        path,
+        pa.schema(
+            [
+                ("user_id", pa.string()),
+                ("movie_id", pa.string()),
+                ("interaction_type", pa.string()),
+                ("rating", pa.float64()),
+            ]
+        ),
+    ) as writer:
+        for start in range(0, n_rows, ratings_matrix.INTERACTION_BATCH_SIZE):
+            n = min(ratings_matrix.INTERACTION_BATCH_SIZE, n_rows - start)
+            interaction_type = rng.choice(["RATING", "LIKE", "WATCHED"], n)
+            rating = rng.integers(1, 11, n).astype(float)
+            rating[interaction_type != "RATING"] = np.nan
+
+            writer.write_table(
+                pa.table(
+                    {
+                        "user_id": usernames[rng.integers(0, n_users, n)],
+                        "movie_id": movie_ids[rng.integers(0, len(movie_ids), n)],
+                        "interaction_type": interaction_type,
+                        "rating": rating,
+                    }
+                )
+            )
+
+
+def __aggregate_external_interactions(
+    path: Path, streamed: bool, reference_date: datetime.date
+) -> tuple[pd.DataFrame, float, int]:
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+
+    # unwrapped, so time_it's logging isn't timed along with it
+    if streamed:
+        result = ratings_matrix.aggregate_interaction_batches.__wrapped__(
+            ratings_matrix.read_interaction_batches(path), reference_date
+        )
+    else:
+        result = ratings_matrix.aggregate_interactions.__wrapped__(
+            pd.read_parquet(path), reference_date
+        )
+
+    seconds = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return result, seconds, (peak_kb - baseline_kb) * 1024
+
+
+def benchmark_mmap_artifacts(
+    n_movies: int = 10_000, n_features: int = 5_000, n_workers: int = 4
+):
+    """
+    Compares the memory of worker processes scoring a new user against a dense item feature matrix,
+    loaded with np.load as float64 and scored with cosine_similarity, or memory mapped as float32.
+    The workers hold the matrix at the same time, like the workers of one web server.
+    """
+    rng = np.random.default_rng(42)
+    item_feature_matrix = rng.random((n_movies, n_features))
+    item_feature_matrix[item_feature_matrix < 0.99] = 0  # sparse like TF-IDF
+    user_ratings = {
+        __movie_id(code): 5.0 for code in range(0, n_movies, n_movies // 10)
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {
+            False: Path(tmp_dir) / "item_feature_matrix_float64.npy",
+            True: Path(tmp_dir) / "item_feature_matrix.npy",
+        }
+        np.save(paths[False], item_feature_matrix)
+        np.save(
+            paths[True], np.ascontiguousarray(item_feature_matrix, dtype=np.float32)
+        )
+        del item_feature_matrix
+
+        results = {}
+        for mapped, path in paths.items():
+            with Manager() as manager, ProcessPoolExecutor(
+                max_workers=n_workers
+            ) as executor:
+                barrier = manager.Barrier(n_workers)
+                results[mapped] = [
+                    future.result()
+                    for future in [
+                        executor.submit(
+                            __score_in_worker, path, mapped, user_ratings, barrier
+                        )
+                        for _ in range(n_workers)
+                    ]
+                ]
+
+    np.testing.assert_allclose(
+        results[True][0][0], results[False][0][0], rtol=1e-4, atol=1e-6
+    )
+
+    print(
+        f"Scoring a new user against {n_movies} x {n_features} item features in {n_workers} workers:"
+    )
+    for mapped, label in [
+        (False, "np.load float64 and cosine_similarity"),
+        (True, "memory mapped float32"),
+    ]:
+        memory = np.mean([worker[1:] for worker in results[mapped]], axis=0) / 1024**2
+        print(
+            f"   {label}: per worker rss {memory[0]:.0f} -> {memory[1]:.0f} MB, "
+            f"private {memory[2]:.0f} -> {memory[3]:.0f} MB"
+        )
+
+
+def __score_in_worker(
+    path: Path, mapped: bool, user_ratings: dict[str, float], barrier
+) -> tuple[np.ndarray, int, int, int, int]:
+    """
+    :return: content scores, then rss and private (uss) bytes before loading and after scoring
+    """
+    process = psutil.Process()
+    before = process.memory_full_info()
+
+    movie_id_lookup = {movie_id: int(movie_id) for movie_id in user_ratings}
+    item_feature_matrix = np.load(path, mmap_mode="r" if mapped else None)
+    if mapped:
+        artifacts = {
+            "item_feature_matrix": item_feature_matrix,
+            "movie_ids": __movie_id_table(len(item_feature_matrix)),
+        }
+        # unwrapped, so time_it's logging doesn't add to the memory measured
+        (_, _, scores), _ = (
+            content_based_filtering_service.get_new_user_content_score.__wrapped__(
+                user_ratings, None, artifacts
+            )
+        )
+    else:
+        scores = __content_scores_cosine_similarity(
+            user_ratings, item_feature_matrix, movie_id_lookup
+        )
+
+    after = process.memory_full_info()
+    barrier.wait()  # every worker holds its matrix at once, each on its own process
+
+    return scores, before.rss, after.rss, before.uss, after.uss
+
+
+def __content_scores_cosine_similarity(
+    user_ratings: dict[str, float], item_matrix: np.ndarray, movie_id_lookup: dict
+) -> np.ndarray:
+    idx = [movie_id_lookup[movie_id] for movie_id in user_ratings]
+    weights = np.array(list(user_ratings.values())).reshape(-1, 1)
+    user_vector = (item_matrix[idx] * weights).sum(axis=0) / weights.sum()
+
+    return cosine_similarity(user_vector.reshape(1, -1), item_matrix).ravel()
+
+
+def benchmark_sparse_item_features(n_movies: int = 20_000, n_features: int = 5_000):
+    """
+    Compares item_feature_matrix saved dense, as before, with the CSR npz artifact:
+    file size, load time, memory and scoring a new user.
+    """
+    rng = np.random.default_rng(42)
+    item_feature_matrix = normalize(
+        sparse_random(
+            n_movies, n_features, density=0.006, format="csr", random_state=42
+        )
+    )  # about 30 terms per movie, like the TF-IDF of movies_metadata
+    user_ratings = {
+        __movie_id(code): float(rating)
+        for code, rating in zip(
+            rng.choice(n_movies, 20, replace=False), rng.integers(1, 6, 20)
+        )
+    }
+    movie_id_lookup = {movie_id: int(movie_id) for movie_id in user_ratings}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for stored_sparse in [False, True]:
+            if stored_sparse:
+                path = Path(tmp_dir) / "item_feature_matrix.npz"
+                save_npz(path, item_feature_matrix.astype(np.float32))
+            else:
+                path = Path(tmp_dir) / "item_feature_matrix.npy"
+                np.save(path, item_feature_matrix.toarray())
+
+            start = time.perf_counter()
+            loaded = load_npz(path) if stored_sparse else np.load(path)
+            load_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            if stored_sparse:
+                # unwrapped, so time_it's logging isn't timed along with it
+                (_, _, scores), _ = (
+                    content_based_filtering_service.get_new_user_content_score.__wrapped__(
+                        user_ratings,
+                        None,
+                        {
+                            "item_feature_matrix": loaded,
+                            "movie_ids": __movie_id_table(n_movies),
+                        },
+                    )
+                )
+            else:
+                scores = __content_scores_cosine_similarity(
+                    user_ratings, loaded, movie_id_lookup
+                )
+            score_seconds = time.perf_counter() - start
+
+            memory_bytes = (
+                loaded.data.nbytes + loaded.indices.nbytes + loaded.indptr.nbytes
+                if stored_sparse
+                else loaded.nbytes
+            )
+            results[stored_sparse] = (
+                scores,
+                path.stat().st_size,
+                load_seconds,
+                memory_bytes,
+                score_seconds,
+            )
+            del loaded
+
+    np.testing.assert_allclose(results[True][0], results[False][0], atol=1e-6)
+
+    print(f"item_feature_matrix of {n_movies} movies x {n_features} features:")
+    for stored_sparse, label in [
+        (False, "dense float64 npy"),
+        (True, "CSR float32 npz"),
+    ]:
+        _, file_bytes, load_seconds, memory_bytes, score_seconds = results[
+            stored_sparse
+        ]
+        print(
+            f"   {label}: file {file_bytes / 1024**2:.1f} MB, load {load_seconds:.2f}s, "
+            f"memory {memory_bytes / 1024**2:.1f} MB, new user scored in {score_seconds * 1000:.1f}ms"
+        )
+
+
+def __movie_id(code: int) -> str:
+    return f"{code:024d}"  # 24 characters like the catalog's ids, sorted in code order
+
+
+def __movie_id_table(n_movies: int) -> np.ndarray:
+    return np.array([__movie_id(code) for code in range(n_movies)])
+
+
+def benchmark_recommendation_layouts(n_users: int = 10_000, n_movies: int = 500):
+    """
+    Compares the row per pair and array per user layouts in temporary tables, nothing real is touched.
+    n_movies is the number of recommendations stored per user.
+    """
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "CREATE TEMP TABLE bench_rows (LIKE user_recommendations INCLUDING ALL)"
+            )
+            cur.execute(
+                "CREATE TEMP TABLE bench_sets (LIKE user_recommendation_sets INCLUDING ALL)"
+            )
+
+            write_seconds = {
+                "rows": __time_query(
+                    cur,
+                    """
+                    INSERT INTO bench_rows (
+                        user_id, movie_id, predicted_score, cf_score, content_score, updated_at
+                    )
+                    SELECT u, 'movie_' || m, random(), random(), random(), NOW()
+                    FROM generate_series(1, %(users)s) u, generate_series(1, %(movies)s) m
+                    """,
+                    {"users": n_users, "movies": n_movies},
+                ),
+                "arrays": __time_query(
+                    cur,
+                    """
+                    INSERT INTO bench_sets (
+                        user_id, movie_ids, predicted_scores, cf_scores, content_scores,
+                        model_version, updated_at
+                    )
+                    SELECT
+                        u,
+                        array_agg('movie_' || m ORDER BY m),
+                        array_agg(random()::real),
+                        array_agg(random()::real),
+                        array_agg(random()::real),
+                        'benchmark',
+                        NOW()
+                    FROM generate_series(1, %(users)s) u, generate_series(1, %(movies)s) m
+                    GROUP BY u
+                    """,
+                    {"users": n_users, "movies": n_movies},
+                ),
+            }
+            cur.execute("ANALYZE bench_rows")
+            cur.execute("ANALYZE bench_sets")
+            cur.execute("""
+                CREATE TEMP VIEW bench_pairs AS
+                SELECT urs.user_id, pair.movie_id, pair.predicted_score, urs.updated_at
+                FROM bench_sets urs
+                CROSS JOIN LATERAL unnest(urs.movie_ids, urs.predicted_scores)
+                    AS pair(movie_id, predicted_score)
+                """)
+
+            print(f"{n_users} users x {n_movies} recommendations:")
+            for layout, relation, table in [
+                ("rows", "bench_rows", "bench_rows"),
+                ("arrays", "bench_pairs", "bench_sets"),
+            ]:
+                cur.execute("SELECT pg_total_relation_size(%s)", [table])
+                (size,) = cur.fetchone()
+
+                lookup_seconds = min(
+                    __time_query(
+                        cur,
+                        f"SELECT predicted_score FROM {relation} WHERE user_id = %s AND movie_id = %s",
+                        [n_users // 2, f"movie_{n_movies // 2}"],
+                    )
+                    for _ in range(20)
+                )
+                user_seconds = min(
+                    __time_query(
+                        cur,
+                        f"SELECT COUNT(*), MAX(updated_at) FROM {relation} WHERE user_id = %s",
+                        [n_users // 2],
+                    )
+                    for _ in range(20)
+                )
+
+                print(f"   {layout}:")
+                print(f"      write: {write_seconds[layout]:.2f}s")
+                print(f"      size: {size / 1024**2:.1f} MB")
+                print(f"      single score lookup: {lookup_seconds * 1000:.2f}ms")
+                print(f"      user count and last update: {user_seconds * 1000:.2f}ms")
+        conn.rollback()  # temp tables go with the session anyway
+
+
+def __time_query(cur, query: str, params) -> float:
+    start = time.perf_counter()
+    cur.execute(query, params)
+    if cur.description is not None:
+        cur.fetchall()
+    return time.perf_counter() - start
+
+
+BENCHMARKS = {
+    "normalize": benchmark_normalize_per_user,
+    "quality": benchmark_quality_boost,
+    "layouts": benchmark_recommendation_layouts,
+    "interactions": benchmark_interaction_scoring,
+    "arrow": benchmark_arrow_aggregation,
+    "mmap": benchmark_mmap_artifacts,
+    "sparse": benchmark_sparse_item_features,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recommender micro benchmarks")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument("--users", type=int, help="Defaults to the benchmark's own")
+    parser.add_argument("--movies", type=int, help="Defaults to the benchmark's own")
+    parser.add_argument("--rows", type=int, help="Defaults to the benchmark's own")
+    args = parser.parse_args()
+
+    benchmark = BENCHMARKS[args.benchmark]
+    sizes = {"n_users": args.users, "n_movies": args.movies, "n_rows": args.rows}
+    sizes = {name: size for name, size in sizes.items() if size is not None}
+
+    # each benchmark takes only some of the sizes
+    accepted = inspect.signature(benchmark).parameters
+    unsupported = [name for name in sizes if name not in accepted]
+    if unsupported:
+        parser.error(
+            f"{args.benchmark} doesn't take "
+            + ", ".join(f"--{name.removeprefix('n_')}" for name in unsupported)
+        )
+
+    benchmark(**sizes)
@@ -0,0 +1,73 @@
+import os
+from typing import Iterator
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Shared by the CF and CBF scoring stages, the memory a single block of scores may use
+MEMORY_BUDGET_MB = int(os.getenv("RECOMMENDER_MEMORY_BUDGET_MB", "1024"))
+
+# Number of movies kept per user by each scoring stage, unset (0) keeps the whole catalog
+CANDIDATES_PER_USER = int(os.getenv("RECOMMENDER_CANDIDATES_PER_USER", "0")) or None
+
+# A block needs room for its scores plus the selection and output copies made from them
+BLOCK_OVERHEAD_FACTOR = 3
+
+# Rough bytes a (user, movie) row costs through merge, normalisation, quality boost and storage
+BYTES_PER_HYBRID_ROW = 512
+
+
+def get_block_size(
+    n_movies: int,
+    memory_budget_mb: int = MEMORY_BUDGET_MB,
+    bytes_per_score: int = np.dtype(np.float32).itemsize,
+) -> int:
+    """
+    Number of users whose [block x n_movies] score matrix fits in the memory budget.
+    """
+    bytes_per_user = max(n_movies, 1) * bytes_per_score * BLOCK_OVERHEAD_FACTOR
+    return max(1, int(memory_budget_mb * 1024**2 // bytes_per_user))
+
+
+def iter_blocks(n_rows: int, block_size: int) -> Iterator[tuple[int, int]]:
+    for start in range(0, n_rows, block_size):
+        yield start, min(start + block_size, n_rows)
+
+
+def top_k_per_row(
+    scores: np.ndarray, top_k: int | None = CANDIDATES_PER_USER
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the top_k scores of every row in a block, every column when top_k is None.
+    :param scores: Dense scores [n_block_users x n_movies]
+    :return: row index and column index of each kept score, grouped by row
+    """
+    n_rows, n_cols = scores.shape
+
+    if top_k is None or top_k >= n_cols:
+        return np.repeat(np.arange(n_rows), n_cols), np.tile(np.arange(n_cols), n_rows)
+
+    top_cols = np.argpartition(scores, -top_k, axis=1)[:, -top_k:]
+
+    return np.repeat(np.arange(n_rows), top_k), top_cols.ravel()
+
+
+def get_movies_per_user(n_movies: int, top_k: int | None = CANDIDATES_PER_USER) -> int:
+    """
+    Most hybrid rows a user can have, the union of their CF and CBF candidates.
+    """
+    if top_k is None:
+        return n_movies
+
+    return min(2 * top_k, n_movies)
+
+
+def get_shard_size(
+    movies_per_user: int, memory_budget_mb: int = MEMORY_BUDGET_MB
+) -> int:
+    """
+    Number of users whose hybrid rows fit in the memory budget.
+    """
+    bytes_per_user = max(movies_per_user, 1) * BYTES_PER_HYBRID_ROW
+    return max(1, int(memory_budget_mb * 1024**2 // bytes_per_user))
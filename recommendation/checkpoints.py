@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Callable
+import joblib
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse, load_npz, save_npz
+from dotenv import load_dotenv
+from common.utils.logging_service import logger
+
+load_dotenv()
+
+# Local directory stage outputs of the nightly recommender are kept in between runs
+CHECKPOINT_DIR = Path(os.getenv("RECOMMENDER_CHECKPOINT_DIR", "checkpoints"))
+
+STAGE_MANIFEST = "stage.json"
+
+
+def fingerprint(*inputs) -> str:
+    """
+    Hashes stage inputs, DataFrames, arrays and files (as a Path) by content and anything else by its str.
+    Stages chain by passing the fingerprint of the stages they depend on.
+    """
+    digest = hashlib.sha256()
+
+    for value in inputs:
+        if isinstance(value, pd.DataFrame):
+            digest.update(",".join(map(str, value.columns)).encode())
+            for column in value.columns:
+                series = value[column]
+                if series.dtype == object:
+                    series = series.astype(str)  # lists and other unhashable cells
+                digest.update(pd.util.hash_pandas_object(series, index=False).values)
+        elif isinstance(value, np.ndarray):
+            digest.update(f"{value.dtype}{value.shape}".encode())
+            digest.update(np.ascontiguousarray(value).data)
+        elif isinstance(value, Path):
+            with open(value, "rb") as f:
+                for chunk in iter(lambda: f.read(1024**2), b""):
+                    digest.update(chunk)
+        else:
+            digest.update(str(value).encode())
+        digest.update(b"\0")
+
+    return digest.hexdigest()[:16]
+
+
+def stage_dir(stage: str, key: str) -> Path:
+    """
+    Directory of a stage's checkpoint, checkpoints of the stage with other keys are removed.
+    """
+    path = CHECKPOINT_DIR / stage / key
+
+    if (CHECKPOINT_DIR / stage).exists():
+        for other in (CHECKPOINT_DIR / stage).iterdir():
+            if other != path:
+                shutil.rmtree(other, ignore_errors=True)
+
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def load_stage(stage: str, key: str) -> dict | None:
+    """
+    :return: values saved by save_stage for this key, None when the stage has to run
+    """
+    path = CHECKPOINT_DIR / stage / key
+    if not (path / STAGE_MANIFEST).exists():
+        return None
+
+    with open(path / STAGE_MANIFEST) as f:
+        filenames = json.load(f)
+
+    values = {}
+    for name, filename in filenames.items():
+        if filename is None:
+            values[name] = None
+        elif filename.endswith(".npz"):
+            values[name] = load_npz(path / filename).tocsr()
+        elif filename.endswith(".npy"):
+            values[name] = np.load(path / filename)
+        elif filename.endswith(".parquet"):
+            values[name] = pd.read_parquet(path / filename)
+        else:
+            values[name] = joblib.load(path / filename)
+
+    return values
+
+
+def save_stage(stage: str, key: str, values: dict):
+    """
+    Saves the outputs of a stage, sparse matrices as npz, arrays as npy, DataFrames as parquet and anything else with joblib.
+    The manifest is written last so a stage interrupted while saving is run again.
+    """
+    path = stage_dir(stage, key)
+    filenames = {}
+
+    for name, value in values.items():
+        if value is None:
+            filenames[name] = None
+        elif issparse(value):
+            filenames[name] = f"{name}.npz"
+            save_npz(path / filenames[name], value)
+        elif isinstance(value, np.ndarray):
+            filenames[name] = f"{name}.npy"
+            np.save(path / filenames[name], value)
+        elif isinstance(value, pd.DataFrame):
+            filenames[name] = f"{name}.parquet"
+            value.to_parquet(path / filenames[name])
+        else:
+            filenames[name] = f"{name}.pkl"
+            joblib.dump(value, path / filenames[name])
+
+    tmp_path = path / f"{STAGE_MANIFEST}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(filenames, f)
+    os.replace(tmp_path, path / STAGE_MANIFEST)
+
+
+def run_stage(stage: str, key: str, compute: Callable[[], dict]) -> dict:
+    """
+    Loads the checkpoint of a stage whose inputs are unchanged, otherwise runs and checkpoints it.
+    """
+    values = load_stage(stage, key)
+
+    if values is not None:
+        logger.info(f"Skipping {stage}, inputs unchanged since checkpoint {key}")
+        return values
+
+    values = compute()
+    save_stage(stage, key, values)
+
+    return values
+
+
+def clear_checkpoints():
+    shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
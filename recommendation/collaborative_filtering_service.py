@@ -1,22 +1,19 @@
 import numpy as np
-import pandas as pd
 from sklearn.decomposition import TruncatedSVD
 from scipy.sparse import csr_matrix
 from common.utils.utils import time_it
+from recommendation import block_scoring, movie_codes
+from recommendation.model.recommender_models import CollaborativeFilteringModel
 
 
 @time_it
 def get_collaborative_filtering_model(
     ratings_sparse: csr_matrix,
-    user_id_lookup: dict[str, int],
-    movie_id_lookup: dict[str, int],
-) -> tuple[pd.DataFrame, np.ndarray]:
+) -> CollaborativeFilteringModel:
     """
     Get collaborative filtering model using SVD.
     :param ratings_sparse: Sparse matrix of user-item interactions
-    :param user_id_lookup: Dictionary mapping user IDs to row indices
-    :param movie_id_lookup: Dictionary mapping movie IDs to column indices
-    :return: DataFrame with user_id, movie_id, and cf_score; movie_features array [k x n_movies]
+    :return: CollaborativeFilteringModel with user features [n_users x k] and movie_features [k x n_movies]
     """
 
     # Apply SVD
@@ -26,76 +23,100 @@ def get_collaborative_filtering_model(
     )  # shape: [n_users x k] Where k is the number of components i.e 50
     movie_features = svd.components_  # shape: [k x n_movies]
 
-    # Predict ratings (dot product)
-    predicted_ratings = (
-        user_features @ movie_features
-    )  # shape: [n_users x n_movies] but this time for all pairs
+    return CollaborativeFilteringModel(
+        user_features=user_features.astype(np.float32),
+        movie_features=movie_features,
+    )
 
-    user_ids = list(user_id_lookup.keys())  # all user_ids
-    movie_ids = list(movie_id_lookup.keys())  # all movie_ids
 
-    predicted_df = pd.DataFrame(
-        predicted_ratings, index=user_ids, columns=movie_ids
-    )  # shape: df index [n_users], columns [n_movies] values: predicted ratings
-
-    cf_df = (
-        predicted_df.stack().reset_index()
-    )  # makes it so there is a new row for each user_id, movie_id pair rather than one row with all movies as columns
-    cf_df.columns = ["user_id", "movie_id", "cf_score"]
-
-    return cf_df, movie_features  # shape: row = [user_id, movie_id, cf_score]
+@time_it
+def get_cf_scores(
+    model: CollaborativeFilteringModel,
+    user_codes: np.ndarray,
+    memory_budget_mb: int = block_scoring.MEMORY_BUDGET_MB,
+    top_k: int | None = block_scoring.CANDIDATES_PER_USER,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Predicts ratings for the given users from the SVD factors.
+    :param user_codes: Ratings matrix rows of the users to score
+    :param memory_budget_mb: Memory a block of predicted ratings may use
+    :param top_k: Number of movies kept per user, None keeps all of them
+    :return: columnar user codes, movie codes (ratings matrix column) and cf scores
+    """
+    user_factors = model.user_features[user_codes]
+    movie_factors = np.asarray(
+        model.movie_features, dtype=np.float32
+    )  # no copy when already float32, e.g. memory mapped by a scoring worker
+
+    cf_user_codes, cf_movie_codes, scores = [], [], []
+    block_size = block_scoring.get_block_size(movie_factors.shape[1], memory_budget_mb)
+
+    for start, stop in block_scoring.iter_blocks(len(user_factors), block_size):
+        # Predict ratings (dot product)
+        block_ratings = (
+            user_factors[start:stop] @ movie_factors
+        )  # shape: [n_block_users x n_movies] only a block of users at a time to bound memory
+
+        rows, cols = block_scoring.top_k_per_row(block_ratings, top_k)
+        cf_user_codes.append(user_codes[start:stop][rows].astype(np.int32))
+        cf_movie_codes.append(cols.astype(np.int32))
+        scores.append(block_ratings[rows, cols])
+
+    if not scores:
+        return (
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.float32),
+        )
+
+    return (
+        np.concatenate(cf_user_codes),
+        np.concatenate(cf_movie_codes),
+        np.concatenate(scores),
+    )  # columnar: a row for each user, movie pair kept
 
 
 @time_it
-def get_new_user_cf_scores(user_ratings: dict[str, float], user_id: int, artifacts):
+def get_new_user_cf_scores(user_ratings: dict[str, float], artifacts):
     # user_ratings: {movie_id: score}
     movie_features = artifacts[
         "movie_features"
     ]  # shape: [k x n_movies] where k is the number of components i.e 50 Got from SVD before, is too expensive to retrain for single user
-    movie_id_lookup_cf = artifacts[
-        "movie_features_movie_id_lookup"
-    ]  # {movie_id: col_index}
-
-    user_vector = np.zeros(
-        movie_features.shape[0]
-    )  # shape: [k x 1] this gets number of rows, so we can do the matrix multi with the new user, we set to zero as initial no features
-    count = 0
-
-    # Iterate over user ratings and gets the movie feature for each rating
-    # and adds it to the user vector
-    # Then we divide by the number of ratings to get the average
+    feature_movie_codes = artifacts[
+        "movie_features_movie_codes"
+    ]  # ascending movie code of each column
+
+    # Gets the movie feature column of each movie the user rated, -1 for movies without one
+    columns = movie_codes.get_sorted_positions(
+        movie_codes.get_movie_codes(list(user_ratings.keys()), artifacts["movie_ids"]),
+        feature_movie_codes,
+    )
+    rated = columns >= 0
+
+    if not rated.any():
+        return (
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            np.empty(0),
+        )
+
+    # Weights the features of each rated movie by its rating and averages them into the user vector
     # This is the same as the user features we got from SVD
     # but we are not going to use SVD for new users, so we just get the features
     # for the movies they rated
-
-    for mid, rating in user_ratings.items():
-        if mid in movie_id_lookup_cf:
-            idx = movie_id_lookup_cf[mid]
-            user_vector += rating * movie_features[:, idx]
-            count += 1
-
-    if count == 0:
-        return {}
-
-    user_vector /= count
-    scores = (user_vector @ movie_features).reshape(
-        1, -1
-    )  # do matrix multiplication with the movie features Shape: [1 x n_movies]
-
-    movie_ids = list(movie_id_lookup_cf.keys())  # get the movie id for each movie
-    # cf_scores = {
-    #     movie_ids[i]: float(scores[i]) for i in range(len(scores))
-    # }  # shape: {movie_id: cf_score} For len(scores) = n_movies, we get the id at that index and score.
-
-    predicted_df = pd.DataFrame(
-        scores, index=[user_id], columns=movie_ids
-    )  # shape: df index [n_users], columns [n_movies] values: predicted ratings
-
-    cf_df = (
-        predicted_df.stack().reset_index()
-    )  # makes it so there is a new row for each user_id, movie_id pair rather than one row with all movies as columns
-    cf_df.columns = ["user_id", "movie_id", "cf_score"]
-
-    cf_df["user_id"] = cf_df["user_id"].astype(str)
-
-    return cf_df
+    ratings = np.fromiter(
+        user_ratings.values(), dtype=movie_features.dtype, count=len(columns)
+    )[rated]
+    user_vector = (movie_features[:, columns[rated]] @ ratings) / np.count_nonzero(
+        rated
+    )  # shape: [k x 1], same dtype as the memory mapped movie_features so the matrix multi below doesn't copy them
+
+    scores = (
+        user_vector @ movie_features
+    )  # do matrix multiplication with the movie features Shape: [n_movies]
+
+    return (
+        np.zeros(len(scores), dtype=np.int32),
+        feature_movie_codes.astype(np.int32),
+        scores,
+    )  # columnar: user code 0 for the user, movie code, cf_score
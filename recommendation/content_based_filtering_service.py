@@ -2,27 +2,27 @@ import numpy as np
 import pandas as pd
 from common.utils.utils import time_it
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from tqdm import tqdm
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, diags, issparse
+from sklearn.preprocessing import normalize
+from recommendation import block_scoring, movie_codes
+from recommendation.model.recommender_models import ContentBasedFilteringModel
 
 
 @time_it
 def get_content_based_filtering_model(
     ratings_sparse: csr_matrix,
-    user_id_lookup: dict[str, int],
-    movie_id_lookup: dict[str, int],
+    user_codes: np.ndarray,
+    ratings_to_catalog: np.ndarray,
     movies_metadata: pd.DataFrame,
-):
-    """_summary_
-
-    Args:
-        :param ratings_sparse: Sparse matrix of user-item interactions
-        :param user_id_lookup: Dictionary mapping user IDs to row indices
-        :param movie_id_lookup: Dictionary mapping movie IDs to column indices
-
-    Returns:
-        _type_: _description_
+) -> ContentBasedFilteringModel:
+    """
+    Fits TF-IDF on movie metadata and builds a content profile for each user.
+    :param ratings_sparse: Sparse matrix of user-item interactions
+    :param user_codes: Ratings matrix rows of the users to profile
+    :param ratings_to_catalog: movies_metadata row of each ratings matrix column, -1 if missing
+    :param movies_metadata: Movie metadata, row order is the catalog movie code
+    :return: ContentBasedFilteringModel, profiles are stored so explanations can be computed when requested
     """
 
     movies_metadata["metadata"] = __build_metadata_vectorized(
@@ -30,183 +30,182 @@ def get_content_based_filtering_model(
     )  # Just big list of features for each movie
 
     # TF-IDF on metadata
-    tfidf_vectorizer, tfidf_matrix, tfidf_movie_id_to_index = __tf_idf_on_metadata(
+    tfidf_vectorizer, tfidf_matrix = __tf_idf_on_metadata(
         movies_metadata
     )  # tfidf_matrix shape: [n_movies x n_features], gets features from metadata for each movie
 
-    ratings_matrix_index_to_mid = list(
-        movie_id_lookup.keys()
-    )  # reverses so we can map from index to movie_id, for the ratings matrix
-
     # Creates User feature vectors from the top 10 movies they have rated
-    user_profiles = {}
-    for user_id, user_idx in tqdm(
-        user_id_lookup.items(), desc="Building user profiles"
-    ):
-        user_row: np.ndarray = ratings_sparse.getrow(user_idx).toarray().flatten()
-        top_rated_indices = user_row.argsort()[-10:][
-            ::-1
-        ]  # top 10 movies indices, we get users top rated ten movies to use for user's feature vector. This is for speed
-        top_rated_movie_ids = [
-            ratings_matrix_index_to_mid[i] for i in top_rated_indices
-        ]  # get movie_ids since ratings indices do not map to metadata matrix indices
-
-        tfidf_indices = [
-            tfidf_movie_id_to_index[mid]
-            for mid in top_rated_movie_ids
-            if mid in tfidf_movie_id_to_index
-        ]  # we get the indices of the movies in the tfidf matrix, this is to get the feature vector for the user
-
-        if tfidf_indices:
-            user_vector = tfidf_matrix[tfidf_indices].toarray().mean(axis=0)
-            user_profiles[user_id] = (
-                user_vector  # shape: [1 x n_features] this is the user profile, we take the mean of the top 10 movies they rated to get a feature vector for the user
-            )
+    user_profiles, profile_user_indices = __build_user_profiles(
+        ratings_sparse[user_codes], ratings_to_catalog, tfidf_matrix
+    )  # shape: [n_profiles x n_features]; tfidf rows follow movies_metadata so catalog rows are tfidf rows
+
+    # Unit length rows so the dot product of a profile and a movie is their cosine similarity
+    return ContentBasedFilteringModel(
+        tfidf_vectorizer=tfidf_vectorizer,
+        tfidf_matrix=tfidf_matrix,
+        user_profiles=user_profiles,
+        profile_user_codes=user_codes[profile_user_indices],
+        normalized_profiles=normalize(user_profiles).astype(np.float32),
+        movie_vectors_t=normalize(tfidf_matrix)
+        .astype(np.float32)
+        .T.tocsr(),  # shape: [n_features x n_movies] kept sparse
+    )
 
-    user_profiles_index_to_user_ids = list(user_profiles.keys())
-    tfidf_index_to_movie_ids = list(tfidf_movie_id_to_index.keys())
 
-    user_matrix = np.stack(list(user_profiles.values()))
-    similarity_matrix = cosine_similarity(
-        user_matrix, tfidf_matrix
-    )  # get similarity between each users top 10 and all movies
+@time_it
+def get_content_scores(
+    model: ContentBasedFilteringModel,
+    user_codes: np.ndarray,
+    memory_budget_mb: int = block_scoring.MEMORY_BUDGET_MB,
+    top_k: int | None = block_scoring.CANDIDATES_PER_USER,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Scores every movie for the given users by cosine similarity with their profile.
+    :param user_codes: Users to score, users without a profile are skipped
+    :param memory_budget_mb: Memory a block of similarity scores may use, shared with CF
+    :param top_k: Number of movies kept per user, None keeps all of them
+    :return: columnar user codes, movie codes (tfidf row) and content scores
+    """
+    profile_rows = np.flatnonzero(np.isin(model.profile_user_codes, user_codes))
 
-    feature_names = tfidf_vectorizer.get_feature_names_out()
-    movie_vectors = tfidf_matrix.toarray()
+    content_user_codes, content_movie_codes, scores = [], [], []
+    block_size = block_scoring.get_block_size(
+        model.movie_vectors_t.shape[1], memory_budget_mb
+    )
 
-    content_scores = []
-    for user_idx, user_id in tqdm(
-        enumerate(user_profiles_index_to_user_ids),
-        desc="Scoring and explaining top movies",
+    for start, stop in tqdm(
+        block_scoring.iter_blocks(len(profile_rows), block_size),
+        desc="Scoring top movies",
     ):
-        user_vector = user_profiles[user_id].reshape(1, -1)  # shape: [1 x n_features]
-        scores = similarity_matrix[user_idx]
-
-        create_final_content_score(
-            content_scores,
-            scores,
-            user_vector,
-            feature_names,
-            movie_vectors,
-            tfidf_index_to_movie_ids,
-            user_id,
+        block_rows = profile_rows[start:stop]
+        similarity_block = (
+            model.normalized_profiles[block_rows] @ model.movie_vectors_t
+        ).toarray()  # get similarity between a block of users top 10 and all movies
+
+        block_user_codes, block_movie_codes, block_scores = create_final_content_score(
+            similarity_block, model.profile_user_codes[block_rows], top_k
         )
+        content_user_codes.append(block_user_codes)
+        content_movie_codes.append(block_movie_codes)
+        scores.append(block_scores)
 
-    # content_scores is now a list of dicts with user_id, movie_id, content_score, and explanation
-    cbf_df = pd.DataFrame(content_scores)
+    if not scores:
+        return (
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.float32),
+        )
 
-    return cbf_df, tfidf_vectorizer, tfidf_matrix, tfidf_movie_id_to_index
+    return (
+        np.concatenate(content_user_codes),
+        np.concatenate(content_movie_codes),
+        np.concatenate(scores),
+    )  # columnar: ratings matrix row of the user, tfidf row of the movie, content_score
 
 
 @time_it
 def get_new_user_content_score(user_ratings: dict[str, float], user_id, artifacts):
-    tfidf_vectorizer = artifacts["tfidf_vectorizer"]
-    item_matrix: np.ndarray = artifacts["item_feature_matrix"]
-    movie_id_lookup: dict[str, int] = artifacts["item_feature_matrix_movie_id_lookup"]
-
-    vectors = []
-    weights = []
-
-    for movie_id, score in user_ratings.items():
-        if movie_id in movie_id_lookup:
-            idx = movie_id_lookup[movie_id]
-            vectors.append(item_matrix[idx])
-            weights.append(score)
-    # goes through and gets weights(Rating Score) and features for each movie the user rated
-
-    if not vectors:
-        return None
-
-    vectors = np.array(vectors)  # shape: [n_user_ratings x n_features]
-    weights = np.array(weights).reshape(
+    item_matrix: csr_matrix = artifacts["item_feature_matrix"]  # row = movie code
+
+    rows = movie_codes.get_movie_codes(
+        list(user_ratings.keys()), artifacts["movie_ids"]
+    )  # movie code of each movie the user rated, -1 when missing from the catalog
+    rated = rows >= 0
+
+    if not rated.any():
+        return None, None
+
+    vectors = item_matrix[
+        rows[rated]
+    ]  # shape: [n_user_ratings x n_features] kept sparse
+    weights = np.fromiter(user_ratings.values(), dtype=float, count=len(rows))[
+        rated
+    ].reshape(
         -1, 1
     )  # shape: [n_user_ratings x 1] but treats as 1d array, we do this so we treat it as a 2d array
-    user_vector = (vectors * weights).sum(
-        axis=0
-    ) / weights.sum()  # We weight the user vector here based on rating score
+    user_vector = (
+        np.asarray(vectors.T @ weights).ravel() / weights.sum()
+    )  # We weight the user vector here based on rating score
 
     # user_vector is now [n_features x 1]
 
-    # user_vector reshape to [1 x n_features]
-    scores = cosine_similarity(user_vector.reshape(1, -1), item_matrix)[0]
-
-    feature_names = tfidf_vectorizer.get_feature_names_out()
-    tfidf_index_to_movie_ids = list(movie_id_lookup.keys())
-
-    content_scores = []
-    create_final_content_score(
-        content_scores,
-        scores,
-        user_vector,
-        feature_names,
-        item_matrix,
-        tfidf_index_to_movie_ids,
-        user_id,
-    )
+    scores = __cosine_similarity_to_rows(
+        user_vector, item_matrix
+    )  # shape: [1 x n_movies]
+
+    content_scores = create_final_content_score(
+        scores, np.zeros(1, dtype=np.int32)
+    )  # columnar: user code 0 for the user, movie code, content_score
 
-    cbf_df = pd.DataFrame(content_scores)
+    return content_scores, user_vector
 
-    cbf_df["user_id"] = cbf_df["user_id"].astype(str)
 
-    return cbf_df
+def __cosine_similarity_to_rows(vector: np.ndarray, matrix) -> np.ndarray:
+    """
+    Cosine similarity of a vector with every row of a sparse or dense matrix, without the copies cosine_similarity makes of it.
+    Sparse rows only touch their stored features, a dense memory mapped matrix is read in place.
+    :return: similarities [1 x n_rows]
+    """
+    vector = vector.astype(matrix.dtype)
+    if issparse(matrix):
+        row_norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    else:
+        row_norms = np.sqrt(np.einsum("ij,ij->i", matrix, matrix))
+
+    denominator = row_norms * np.linalg.norm(vector)
+    dots = np.asarray(matrix @ vector).ravel()
+
+    return np.divide(
+        dots, denominator, out=np.zeros_like(dots), where=denominator > 0
+    ).reshape(1, -1)
 
 
 def create_final_content_score(
-    content_scores,
-    user_scores,
-    user_vector,
-    feature_names,
-    movie_vectors,
-    tfidf_index_to_movie_ids,
-    user_id,
-    top_n_explain=100,
-):
-    # Find the indices of top-N scores (for explanation)
-    top_expl_idx_set = set(
-        np.argpartition(user_scores, -top_n_explain)[-top_n_explain:]
+    similarity_block: np.ndarray,
+    block_user_codes: np.ndarray,
+    top_k: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Flattens a block of similarity scores into columnar arrays, keeping each users top_k movies.
+    :param similarity_block: Scores [n_block_users x n_movies]
+    :param block_user_codes: User code of each row in the block
+    :return: user codes, movie codes (column in the block) and content scores
+    """
+    rows, cols = block_scoring.top_k_per_row(similarity_block, top_k)
+
+    return (
+        block_user_codes[rows].astype(np.int32),
+        cols.astype(np.int32),
+        similarity_block[rows, cols],
     )
 
-    for movie_idx, score in tqdm(enumerate(user_scores), desc="Getting explanation"):
-        explanation = None
-
-        if movie_idx in top_expl_idx_set:
-            contribution = user_vector.flatten() * movie_vectors[movie_idx]
-            top_feat_idx = contribution.argsort()[-10:][::-1]
-            explanation = [
-                {"feature": feature_names[j], "score": float(contribution[j])}
-                for j in top_feat_idx
-                if contribution[j] > 0
-            ]
-
-        content_scores.append(
-            {
-                "user_id": user_id,
-                "movie_id": tfidf_index_to_movie_ids[movie_idx],
-                "content_score": float(score),
-                "explanation": explanation,
-            }
-        )
+
+def __dense_row(matrix, idx: int) -> np.ndarray:
+    if issparse(matrix):
+        return matrix[idx].toarray().ravel()
+
+    return matrix[idx]
 
 
 def explain_recommendation(
-    user_id: str,
+    user_vector: np.ndarray,
     movie_id: str,
-    user_profiles: dict,
-    movie_id_lookup: dict,
-    tfidf_matrix,
-    tfidf_vectorizer: TfidfVectorizer,
-    top_n: int = 5,
+    movie_ids: np.ndarray,
+    item_feature_matrix,
+    feature_names,
+    top_n: int = 10,
 ) -> list[dict]:
     """
     Returns the top N feature contributions explaining why a movie was recommended to a user.
+    :param user_vector: The users profile [n_features]
+    :param movie_ids: Sorted movie id table, item_feature_matrix rows are its movie codes
+    :param item_feature_matrix: TF-IDF features of every movie [n_movies x n_features], sparse or dense
     """
-    if user_id not in user_profiles or movie_id not in movie_id_lookup:
+    movie_code = movie_codes.get_movie_codes([movie_id], movie_ids)[0]
+    if movie_code < 0:
         return []
 
-    feature_names = tfidf_vectorizer.get_feature_names_out()
-    user_vector = user_profiles[user_id]
-    movie_index = movie_id_lookup[movie_id]
-    movie_vector = tfidf_matrix[movie_index].toarray().flatten()
+    movie_vector = __dense_row(item_feature_matrix, movie_code)
 
     contribution = user_vector * movie_vector  # element-wise dot product
 
@@ -222,13 +221,94 @@ def explain_recommendation(
     return explanation
 
 
-def build_baseline_recs(cbf_df: pd.DataFrame, top_n=100):
-    return (
-        cbf_df.groupby("movie_id")["content_score"]
-        .mean()
-        .sort_values(ascending=False)
-        .head(top_n)
-        .reset_index()
+def build_baseline_recs(
+    content_sums: np.ndarray,
+    content_counts: np.ndarray,
+    catalog_movie_ids: np.ndarray,
+    top_n=100,
+):
+    """
+    Top movies by mean content_score across users.
+    :param content_sums: Sum of each movies content scores, indexed by movie code
+    :param content_counts: Number of content scores of each movie, indexed by movie code
+    """
+    scored = np.flatnonzero(content_counts)
+    mean_scores = content_sums[scored] / content_counts[scored]
+    top = np.argsort(-mean_scores, kind="stable")[:top_n]
+
+    return pd.DataFrame(
+        {
+            "movie_id": catalog_movie_ids[scored[top]],
+            "content_score": mean_scores[top],
+        }
+    )
+
+
+@time_it
+def __build_user_profiles(
+    ratings_sparse: csr_matrix,
+    ratings_index_to_tfidf_index: np.ndarray,
+    tfidf_matrix: csr_matrix,
+    top_n: int = 10,
+) -> tuple[csr_matrix, np.ndarray]:
+    """
+    Builds a feature vector for every user as the mean TF-IDF vector of their top rated movies.
+    :param ratings_sparse: Sparse matrix of user-item interactions [n_users x n_movies]
+    :param ratings_index_to_tfidf_index: TF-IDF row for each ratings matrix column, -1 if missing
+    :param tfidf_matrix: Sparse TF-IDF matrix [n_tfidf_movies x n_features]
+    :param top_n: Number of top rated movies used for each profile
+    :return: Sparse profiles [n_profiles x n_features]; ratings row index of each profile
+    """
+    top_rated = __top_n_per_row(
+        ratings_sparse, top_n
+    )  # 1 for each users top rated movies
+
+    has_metadata = ratings_index_to_tfidf_index >= 0
+    ratings_to_tfidf = csr_matrix(
+        (
+            np.ones(has_metadata.sum()),
+            (
+                np.flatnonzero(has_metadata),
+                ratings_index_to_tfidf_index[has_metadata],
+            ),
+        ),
+        shape=(ratings_sparse.shape[1], tfidf_matrix.shape[0]),
+    )  # shape: [n_movies x n_tfidf_movies] moves each ratings column to its TF-IDF row
+
+    top_rated = top_rated @ ratings_to_tfidf  # shape: [n_users x n_tfidf_movies]
+
+    counts = np.asarray(top_rated.sum(axis=1)).ravel()
+    profile_user_indices = np.flatnonzero(
+        counts
+    )  # users with no metadata for their movies get no profile
+
+    weights = (
+        diags(1.0 / counts[profile_user_indices]) @ top_rated[profile_user_indices]
+    )  # row normalised so each profile is the mean of its movies
+
+    return (weights @ tfidf_matrix).tocsr(), profile_user_indices
+
+
+def __top_n_per_row(matrix: csr_matrix, top_n: int) -> csr_matrix:
+    """
+    Keeps the top_n largest positive values of each row, returned as a 0/1 mask of the same shape.
+    """
+    matrix = matrix.tocsr()
+    n_rows = matrix.shape[0]
+
+    rows = np.repeat(np.arange(n_rows), np.diff(matrix.indptr))
+    positive = matrix.data > 0
+    rows, cols, values = rows[positive], matrix.indices[positive], matrix.data[positive]
+
+    order = np.lexsort((-values, rows))  # grouped by row, highest value first
+    rows, cols = rows[order], cols[order]
+
+    row_starts = np.searchsorted(rows, np.arange(n_rows))
+    rank_in_row = np.arange(len(rows)) - row_starts[rows]
+    keep = rank_in_row < top_n
+
+    return csr_matrix(
+        (np.ones(keep.sum()), (rows[keep], cols[keep])), shape=matrix.shape
     )
 
 
@@ -289,10 +369,6 @@ def __tf_idf_on_metadata(movies_metadata):
     )
     tfidf_matrix = tfidf_vectorizer.fit_transform(
         movies_metadata["metadata"]
-    )  # shape: [n_movies x n_features]
-
-    movie_id_lookup = dict(
-        zip(movies_metadata["movie_id"], range(len(movies_metadata)))
-    )  # {movie_id: col_index}
+    )  # shape: [n_movies x n_features] row = catalog movie code
 
-    return tfidf_vectorizer, tfidf_matrix, movie_id_lookup
+    return tfidf_vectorizer, tfidf_matrix
@@ -0,0 +1,95 @@
+import numpy as np
+import psycopg
+from psycopg.rows import dict_row
+from common.utils.artifact_registry import artifact_registry
+from common.utils.utils import DB_CONFIG, cache, time_it
+from recommendation import content_based_filtering_service
+from recommendation.storage_layout import RECOMMENDATIONS_RELATION
+
+# Read by get_explanation
+artifact_registry.declare(["tfidf_vectorizer", "movie_ids", "item_feature_matrix"])
+
+
+def get_explanation(user_id: int, movie_id: str) -> dict | None:
+    """
+    Explains a single recommendation from the users stored content profile and the movies features.
+    """
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT updated_at FROM user_content_profiles WHERE user_id = %s",
+                [user_id],
+            )
+            row = cur.fetchone()
+
+    if row is None:
+        return None
+
+    return __get_profile_explanation(user_id, movie_id, row[0])
+
+
+@cache.memoize(timeout=3600)
+@time_it
+def __get_profile_explanation(
+    user_id: int, movie_id: str, profile_updated_at
+) -> dict | None:
+    """
+    :param profile_updated_at: Only keys the cache, so a profile rewritten by a batch run isn't explained from a stale entry
+    """
+    query = f"""
+    SELECT ucp.feature_indices, ucp.feature_weights, ur.cf_score
+    FROM user_content_profiles ucp
+    LEFT JOIN {RECOMMENDATIONS_RELATION} ur ON ur.user_id = ucp.user_id AND ur.movie_id = %s
+    WHERE ucp.user_id = %s
+    """
+
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(query, [movie_id, user_id])
+
+            profile = cur.fetchone()
+
+    if profile is None:
+        return None
+
+    artifacts = artifact_registry.get().artifacts
+    feature_names = artifacts["tfidf_vectorizer"].get_feature_names_out()
+
+    user_vector = np.zeros(len(feature_names))
+    user_vector[profile["feature_indices"]] = profile["feature_weights"]
+
+    content_features = content_based_filtering_service.explain_recommendation(
+        user_vector,
+        movie_id,
+        artifacts["movie_ids"],
+        artifacts["item_feature_matrix"],
+        feature_names,
+    )
+
+    return build_hybrid_explanation(profile["cf_score"], content_features)
+
+
+def build_hybrid_explanation(
+    cf_score: float | None, content_features: list[dict] | None
+) -> dict | None:
+    """
+    Builds a hybrid explanation combining CF and content-based insights.
+    """
+    if not content_features:
+        return None
+
+    # Collaborative filtering explanation
+    if cf_score is not None and not np.isnan(cf_score):
+        cf_msg = f"Based on collaborative filtering — similar users liked this movie (score: {cf_score:.2f})"
+    else:
+        cf_msg = "Collaborative filtering data was not available; recommendation is based on movie features"
+
+    # Build top features (limit + fallback)
+    summary = "Based on your preference for: " + ", ".join(
+        f.get("feature", "N/A") for f in content_features[:3]
+    )
+
+    return {
+        "cf": cf_msg,
+        "content": {"summary": summary, "top_features": content_features},
+    }
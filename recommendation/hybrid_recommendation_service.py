@@ -1,8 +1,24 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import time
 import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 from typing import List
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
+from threadpoolctl import threadpool_limits
+from tqdm import tqdm
 from common.utils import azure_blob
+from common.utils.artifact_registry import artifact_registry
 from common.utils.utils import time_it
 from movies.movies_service import get_movies_metadata
 from recommendation import (
@@ -10,160 +26,847 @@ from recommendation import (
     content_based_filtering_service,
     collaborative_filtering_service,
     ratings_matrix as rating_matrix_service,
+    ratings_aggregate,
+    block_scoring,
+    checkpoints,
+    scoring_bundle,
+    shard_leases,
+    recommendation_snapshot,
+    movie_codes,
 )
+from recommendation.model.recommender_models import (
+    CollaborativeFilteringModel,
+    ContentBasedFilteringModel,
+)
+from recommendation.scoring_bundle import ScoringBundle
 from recommendation.evaluation import evaluate_topk_metrics
 from dotenv import load_dotenv
 from common.utils.logging_service import logger
 
 load_dotenv()
 
+# Set in each scoring worker process by __init_scoring_worker
+_worker_bundle: ScoringBundle | None = None
+
+# Points workers at the run a coordinator published in a run directory
+RUN_MANIFEST = "manifest.json"
+
+# Read by generate_user_hybrid_recommendations
+artifact_registry.declare(
+    [
+        "movie_ids",
+        "item_feature_matrix",
+        "movie_features",
+        "movie_features_movie_codes",
+        "movie_quality_prior",
+    ]
+)
+
 
 @time_it
-def get_hybrid_filtering():
+def get_hybrid_filtering(
+    shard_size: int | None = None,
+    memory_budget_mb: int = block_scoring.MEMORY_BUDGET_MB,
+    workers: int = 1,
+    blas_threads: int | None = None,
+    run_dir: Path | None = None,
+    rebuild_ratings: bool = False,
+):
+    """
+    Fits the CF and CBF models once, then scores, merges and stores users one shard at a time.
+    :param shard_size: Users per shard, chosen from memory_budget_mb when None
+    :param memory_budget_mb: Memory budget for all shards in flight, also bounds the scoring blocks
+    :param workers: Processes scoring shards in parallel, 1 scores in this process
+    :param blas_threads: BLAS threads per worker, defaults to splitting the cores between workers
+    :param run_dir: Shared directory to publish the run to as coordinator, shards are then leased to workers on any node
+    :param rebuild_ratings: Rebuild the ratings aggregate from every interaction instead of applying the changes since the last run
+    """
     split_for_evaluation = False
-    (
-        raw_ratings_sparse,
-        centered_ratings_sparse,
-        user_id_lookup,
-        movie_id_lookup,
-        test_df,
-    ) = rating_matrix_service.create_ratings_matrix(
-        split_for_evaluation=split_for_evaluation
-    )  # shape sparse array [n_users x n_movies]; {user_id: row_index}; {movie_id: col_index}
 
-    movies_metadata = pd.DataFrame(get_movies_metadata())
+    if run_dir is not None:
+        # Workers must not join the previous run while this one is being fitted
+        (run_dir / RUN_MANIFEST).unlink(missing_ok=True)
 
-    cf_df, movie_features = (
-        collaborative_filtering_service.get_collaborative_filtering_model(
-            centered_ratings_sparse, user_id_lookup, movie_id_lookup
-        )
+    # Each stage is checkpointed under a fingerprint of its inputs, a rerun skips stages whose inputs are unchanged
+    aggregated_ratings, ratings_version = ratings_aggregate.load_ratings(
+        full_rebuild=rebuild_ratings
     )
+    ratings_key = checkpoints.fingerprint(ratings_version, split_for_evaluation)
+    ratings = checkpoints.run_stage(
+        "ratings_matrix",
+        ratings_key,
+        lambda: dict(
+            zip(
+                [
+                    "raw_ratings_sparse",
+                    "centered_ratings_sparse",
+                    "user_id_lookup",
+                    "movie_id_lookup",
+                    "test_df",
+                ],
+                rating_matrix_service.create_ratings_matrix(
+                    split_for_evaluation=split_for_evaluation,
+                    ratings=aggregated_ratings,
+                ),
+            )
+        ),
+    )  # shape sparse array [n_users x n_movies]; {user_id: row_index}; {movie_id: col_index}
+    del aggregated_ratings
+    user_id_lookup = ratings["user_id_lookup"]
+    movie_id_lookup = ratings["movie_id_lookup"]
+    test_df = ratings["test_df"]
 
-    # if not split_for_evaluation:
-    #     # Only use internal users (numeric user_ids) for content-based filtering
-    internal_user_ids = [uid for uid in user_id_lookup if uid.isnumeric()]
-    internal_user_indices = [user_id_lookup[uid] for uid in internal_user_ids]
+    movies_metadata = movie_codes.sort_catalog(pd.DataFrame(get_movies_metadata()))
+
+    # The pipeline works on integer codes, ids only come back when storing
+    # users are coded by ratings matrix row and movies by movies_metadata row (the catalog, sorted by movie id)
+    user_ids = np.array(list(user_id_lookup.keys()), dtype=object)
+    catalog_movie_ids = movies_metadata["movie_id"].to_numpy(dtype=object)
+    ratings_to_catalog = movie_codes.get_movie_codes(
+        list(movie_id_lookup.keys()), catalog_movie_ids
+    )
 
-    raw_ratings_sparse = raw_ratings_sparse[internal_user_indices]
-    user_id_lookup = {uid: i for i, uid in enumerate(internal_user_ids)}
+    # Only internal users (numeric user_ids) get a content profile, external ones can be scored too
+    internal_user_codes = get_scored_user_codes(user_ids)
+    scored_user_codes = get_scored_user_codes(
+        user_ids, recommendation_storing_service.SCORE_EXTERNAL_USERS
+    )
 
-    cbf_df, tfidf_vectorizer, tfidf_matrix, tfidf_movie_id_to_index = (
-        content_based_filtering_service.get_content_based_filtering_model(
-            raw_ratings_sparse, user_id_lookup, movie_id_lookup, movies_metadata
+    cf_key = checkpoints.fingerprint("cf_model", ratings_key)
+    cf_model = CollaborativeFilteringModel(
+        **checkpoints.run_stage(
+            "cf_model",
+            cf_key,
+            lambda: vars(
+                collaborative_filtering_service.get_collaborative_filtering_model(
+                    ratings["centered_ratings_sparse"]
+                )
+            ),
         )
     )
 
-    cbf_df["user_id"] = cbf_df["user_id"].astype(str)
-    cf_df["user_id"] = cf_df["user_id"].astype(str)
+    cbf_key = checkpoints.fingerprint("cbf_model", ratings_key, movies_metadata)
+    cbf_stage = checkpoints.run_stage(
+        "cbf_model",
+        cbf_key,
+        lambda: {
+            **vars(
+                content_based_filtering_service.get_content_based_filtering_model(
+                    ratings["raw_ratings_sparse"],
+                    internal_user_codes,
+                    ratings_to_catalog,
+                    movies_metadata,
+                )
+            ),
+            "metadata_text": movies_metadata[["metadata"]],
+        },
+    )
+    movies_metadata["metadata"] = cbf_stage.pop("metadata_text")["metadata"].to_numpy()
+    cbf_model = ContentBasedFilteringModel(**cbf_stage)
+    del ratings  # only the fitted models are needed to score
 
-    cbf_df["movie_id"] = cbf_df["movie_id"].astype(str)
-    cf_df["movie_id"] = cf_df["movie_id"].astype(str)
+    # Every worker holds a shard at once, so they share the budget
+    worker_budget_mb = max(1, memory_budget_mb // workers)
+    if shard_size is None:
+        shard_size = block_scoring.get_shard_size(
+            block_scoring.get_movies_per_user(len(catalog_movie_ids)), worker_budget_mb
+        )
+    logger.info(
+        f"Scoring {len(scored_user_codes)} users in shards of {shard_size} users"
+        f" with {workers} worker(s)"
+    )
 
-    hybrid_df = merge_scores(cbf_df, cf_df)
+    # Shards are only resumed when the models, candidates, shard layout and storage settings are all unchanged
+    scores_key = (
+        None
+        if test_df is not None
+        else checkpoints.fingerprint(
+            cf_key,
+            cbf_key,
+            shard_size,
+            block_scoring.CANDIDATES_PER_USER,
+            recommendation_storing_service.SCORE_EXTERNAL_USERS,
+            recommendation_storing_service.STORE_TOP_N,
+            recommendation_storing_service.STORE_CANDIDATES,
+            recommendation_storing_service.STORAGE_LAYOUT,
+            recommendation_storing_service.MONGO_WRITE_MODE,
+            recommendation_snapshot.DELTA_WRITES,
+        )
+    )
 
-    hybrid_df = normalize_per_user(hybrid_df, ["content_score", "cf_score"])
+    bundle = ScoringBundle(
+        cf_model,
+        cbf_model,
+        ratings_to_catalog,
+        compute_quality_prior(movies_metadata),
+        user_ids,
+        catalog_movie_ids,
+        (
+            recommendation_storing_service.get_watch_provider_candidates(
+                user_ids, catalog_movie_ids
+            )
+            if recommendation_storing_service.STORE_CANDIDATES == "watch_providers"
+            else None
+        ),
+        model_version=datetime.datetime.now(tz=datetime.timezone.utc).strftime(
+            "%Y-%m-%d"
+        ),
+        score_external_users=recommendation_storing_service.SCORE_EXTERNAL_USERS,
+    )
+
+    replace_external = (
+        recommendation_storing_service.MONGO_WRITE_MODE == "replace" and test_df is None
+    )
+    if replace_external:
+        # shards stored by an earlier attempt of this run are skipped, what they staged is kept
+        progress_dir = checkpoints.CHECKPOINT_DIR / "storage_progress" / scores_key
+        recommendation_storing_service.prepare_external_recommendations(
+            bundle.model_version,
+            resume=run_dir is None and any(progress_dir.glob("*.npz")),
+        )
 
-    hybrid_df = compute_hybrid_scores(hybrid_df)
+    delta_writes = recommendation_snapshot.DELTA_WRITES and test_df is None
+    if delta_writes:
+        # parts left by an interrupted run describe what the database holds now
+        recommendation_snapshot.finalize_snapshot()
 
-    hybrid_df = apply_quality_boost(hybrid_df, movies_metadata)
+    if run_dir is not None:
+        content_sums, content_counts = __coordinate_shards(
+            bundle,
+            scored_user_codes,
+            shard_size,
+            worker_budget_mb,
+            run_dir,
+            blas_threads,
+        )
+        evaluation_dfs = []
+    elif workers > 1:
+        content_sums, content_counts, evaluation_dfs = __score_shards_in_pool(
+            bundle,
+            scored_user_codes,
+            shard_size,
+            worker_budget_mb,
+            workers,
+            blas_threads or max(1, (os.cpu_count() or 1) // workers),
+            evaluate=test_df is not None,
+            scores_key=scores_key,
+        )
+    else:
+        content_sums, content_counts, evaluation_dfs = __score_shards_in_process(
+            bundle,
+            scored_user_codes,
+            shard_size,
+            worker_budget_mb,
+            evaluate=test_df is not None,
+            scores_key=scores_key,
+        )
 
     if test_df is not None:
+        hybrid_df = pd.concat(evaluation_dfs, ignore_index=True)
+        hybrid_df["user_id"] = user_ids[hybrid_df["user_code"]]
+        hybrid_df["movie_id"] = catalog_movie_ids[hybrid_df["movie_code"]]
+
         metrics = evaluate_topk_metrics(hybrid_df, test_df, k=100)
         print("Evaluation Metrics:")
         for metric, value in metrics.items():
             print(f"   {metric}: {value}")
     else:
-        recommendation_storing_service.store_predictions(hybrid_df)
+        if delta_writes:
+            recommendation_snapshot.finalize_snapshot()
+        if replace_external:
+            recommendation_storing_service.swap_external_recommendations(
+                bundle.model_version
+            )
 
-        item_feature_matrix = tfidf_matrix.toarray()
+        recommendation_storing_service.store_user_profiles(
+            user_ids[cbf_model.profile_user_codes], cbf_model.user_profiles
+        )
 
         baseline_recs = content_based_filtering_service.build_baseline_recs(
-            cbf_df
+            content_sums, content_counts, catalog_movie_ids
         )  # Top movies overall or diverse
 
+        # CF columns of catalog movies in catalog code order, so they are found by binary search on their codes
+        cf_columns = np.flatnonzero(ratings_to_catalog >= 0)
+        cf_columns = cf_columns[np.argsort(ratings_to_catalog[cf_columns])]
+
         azure_blob.save_all_artifacts(
-            tfidf_vectorizer=tfidf_vectorizer,
-            item_feature_matrix=item_feature_matrix,
-            item_feature_matrix_movie_id_lookup=tfidf_movie_id_to_index,
-            movie_features=movie_features,
-            movie_features_movie_id_lookup=movie_id_lookup,
+            tfidf_vectorizer=cbf_model.tfidf_vectorizer,
+            movie_ids=movie_codes.get_movie_id_table(catalog_movie_ids),
+            item_feature_matrix=cbf_model.tfidf_matrix,
+            movie_features=cf_model.movie_features[:, cf_columns],
+            movie_features_movie_codes=ratings_to_catalog[cf_columns],
             baseline_recs=baseline_recs,
             movies_metadata=movies_metadata,
+            movie_quality_prior=bundle.quality_prior,
+        )
+
+
+def score_user_shard(
+    bundle: ScoringBundle,
+    shard_user_codes: np.ndarray,
+    memory_budget_mb: int,
+    evaluate: bool = False,
+    scores_key: str | None = None,
+    heartbeat: shard_leases.LeaseHeartbeat | None = None,
+) -> tuple[np.ndarray, np.ndarray, pd.DataFrame | None]:
+    """
+    Scores, merges and stores one shard of users, when evaluating their top 100 is returned instead of stored.
+    :param scores_key: Checkpoints the shard's scores under this key, so a shard whose storing failed is not scored again
+    :param heartbeat: Lease the shard is scored under, nothing is stored once it was lost to another worker
+    :return: content score sum and count per catalog movie, and the evaluation rows
+    """
+
+    external_user_codes = (
+        shard_user_codes[
+            [bundle.user_ids[code].startswith("lb_") for code in shard_user_codes]
+        ]
+        if bundle.score_external_users
+        else None
+    )
+
+    def score() -> dict:
+        n_movies = len(bundle.catalog_movie_ids)
+
+        content_scores = content_based_filtering_service.get_content_scores(
+            bundle.cbf_model, shard_user_codes, memory_budget_mb
+        )
+        cf_scores = collaborative_filtering_service.get_cf_scores(
+            bundle.cf_model, shard_user_codes, memory_budget_mb
+        )
+
+        _, content_movie_codes, content_values = content_scores
+
+        return {
+            "content_sums": np.bincount(
+                content_movie_codes, weights=content_values, minlength=n_movies
+            ),
+            "content_counts": np.bincount(content_movie_codes, minlength=n_movies),
+            "hybrid_df": score_shard(
+                content_scores,
+                remap_movie_codes(cf_scores, bundle.ratings_to_catalog),
+                bundle.quality_prior,
+                external_user_codes,
+            ),
+        }
+
+    scored = (
+        score()
+        if scores_key is None
+        else checkpoints.run_stage("hybrid_scores", scores_key, score)
+    )
+    content_sums, content_counts, hybrid_df = (
+        scored["content_sums"],
+        scored["content_counts"],
+        scored["hybrid_df"],
+    )
+
+    if evaluate:
+        return content_sums, content_counts, get_top_k_per_user(hybrid_df, k=100)
+
+    if heartbeat is not None and heartbeat.lost:
+        logger.warning(
+            f"Not storing shard {heartbeat.shard_id}, its lease was taken over"
+        )
+        return content_sums, content_counts, None
+
+    recommendation_storing_service.store_predictions(
+        hybrid_df,
+        bundle.user_ids,
+        bundle.catalog_movie_ids,
+        candidates=bundle.candidates,
+        model_version=bundle.model_version,
+        snapshot=(
+            recommendation_snapshot.load_snapshot()
+            if recommendation_snapshot.DELTA_WRITES
+            else None
+        ),
+    )
+    return content_sums, content_counts, None
+
+
+def __score_shards_in_process(
+    bundle: ScoringBundle,
+    user_codes: np.ndarray,
+    shard_size: int,
+    memory_budget_mb: int,
+    evaluate: bool,
+    scores_key: str | None = None,
+) -> tuple[np.ndarray, np.ndarray, list[pd.DataFrame]]:
+    """
+    Scores and stores shards one after the other, with a scores_key shards stored by an earlier run are skipped.
+    """
+    content_sums = np.zeros(len(bundle.catalog_movie_ids))
+    content_counts = np.zeros(len(bundle.catalog_movie_ids), dtype=np.int64)
+    evaluation_dfs = []
+    progress_dir = (
+        None
+        if scores_key is None
+        else checkpoints.stage_dir("storage_progress", scores_key)
+    )
+
+    for shard_id, (start, stop) in enumerate(
+        block_scoring.iter_blocks(len(user_codes), shard_size)
+    ):
+        if progress_dir is not None and (progress_dir / f"{shard_id}.npz").exists():
+            shard_sums, shard_counts = __load_shard_stats(
+                progress_dir / f"{shard_id}.npz"
+            )
+            content_sums += shard_sums
+            content_counts += shard_counts
+            logger.info(f"Shard of users {start}-{stop} already stored")
+            continue
+
+        shard_sums, shard_counts, evaluation_df = score_user_shard(
+            bundle,
+            user_codes[start:stop],
+            memory_budget_mb,
+            evaluate,
+            scores_key=(
+                None
+                if scores_key is None
+                else checkpoints.fingerprint(scores_key, shard_id)
+            ),
+        )  # each shard is stored before the next one is scored
+
+        if progress_dir is not None:
+            __save_shard_stats(
+                progress_dir / f"{shard_id}.npz", shard_sums, shard_counts
+            )  # marks the shard as stored
+
+        content_sums += shard_sums
+        content_counts += shard_counts
+        if evaluation_df is not None:
+            evaluation_dfs.append(evaluation_df)
+
+        logger.info(f"Shard of users {start}-{stop} done")
+
+    return content_sums, content_counts, evaluation_dfs
+
+
+def __save_shard_stats(
+    path: Path, content_sums: np.ndarray, content_counts: np.ndarray
+):
+    # not named *.npz, so a partial file is never taken for a stored shard
+    tmp_path = path.with_suffix(".npz.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, content_sums=content_sums, content_counts=content_counts)
+    os.replace(tmp_path, path)
+
+
+def __load_shard_stats(path: Path) -> tuple[np.ndarray, np.ndarray]:
+    with np.load(path) as stats:
+        return stats["content_sums"], stats["content_counts"]
+
+
+@time_it
+def __score_shards_in_pool(
+    bundle: ScoringBundle,
+    user_codes: np.ndarray,
+    shard_size: int,
+    memory_budget_mb: int,
+    workers: int,
+    blas_threads: int,
+    evaluate: bool,
+    scores_key: str | None = None,
+) -> tuple[np.ndarray, np.ndarray, list[pd.DataFrame]]:
+    """
+    Scores and stores shards in worker processes, which memory map the fitted models from a bundle on disk.
+    With a scores_key shards stored by an earlier run are skipped.
+    """
+    content_sums = np.zeros(len(bundle.catalog_movie_ids))
+    content_counts = np.zeros(len(bundle.catalog_movie_ids), dtype=np.int64)
+    evaluation_dfs = []
+    progress_dir = (
+        None
+        if scores_key is None
+        else checkpoints.stage_dir("storage_progress", scores_key)
+    )
+
+    pending_shards = {}
+    for shard_id, (start, stop) in enumerate(
+        block_scoring.iter_blocks(len(user_codes), shard_size)
+    ):
+        if progress_dir is not None and (progress_dir / f"{shard_id}.npz").exists():
+            shard_sums, shard_counts = __load_shard_stats(
+                progress_dir / f"{shard_id}.npz"
+            )
+            content_sums += shard_sums
+            content_counts += shard_counts
+        else:
+            pending_shards[shard_id] = user_codes[start:stop]
+    logger.info(f"{len(pending_shards)} shards left to score")
+
+    worker_stats = defaultdict(lambda: {"shards": 0, "users": 0, "seconds": 0.0})
+
+    bundle_dir = Path(tempfile.mkdtemp(prefix="scoring_bundle_"))
+    try:
+        scoring_bundle.write_scoring_bundle(bundle_dir, bundle)
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),  # no forked DB clients
+            initializer=__init_scoring_worker,
+            initargs=(str(bundle_dir), blas_threads),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    __score_worker_shard,
+                    shard_user_codes,
+                    memory_budget_mb,
+                    evaluate,
+                ): shard_id
+                for shard_id, shard_user_codes in pending_shards.items()
+            }
+
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="Scoring shards"
+            ):
+                pid, n_users, seconds, shard_sums, shard_counts, evaluation_df = (
+                    future.result()
+                )
+                if progress_dir is not None:
+                    __save_shard_stats(
+                        progress_dir / f"{futures[future]}.npz",
+                        shard_sums,
+                        shard_counts,
+                    )  # marks the shard as stored
+
+                content_sums += shard_sums
+                content_counts += shard_counts
+                if evaluation_df is not None:
+                    evaluation_dfs.append(evaluation_df)
+
+                worker_stats[pid]["shards"] += 1
+                worker_stats[pid]["users"] += n_users
+                worker_stats[pid]["seconds"] += seconds
+    finally:
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+
+    for pid, stats in worker_stats.items():
+        logger.info(
+            f"Worker {pid}: {stats['shards']} shards, {stats['users']} users in"
+            f" {stats['seconds']:.1f}s ({stats['users'] / max(stats['seconds'], 1e-9):.1f} users/s)"
+        )
+
+    return content_sums, content_counts, evaluation_dfs
+
+
+def __init_scoring_worker(bundle_dir: str, blas_threads: int):
+    global _worker_bundle
+
+    threadpool_limits(
+        limits=blas_threads
+    )  # workers x blas_threads stays within the cores
+    _worker_bundle = scoring_bundle.load_scoring_bundle(Path(bundle_dir))
+
+
+def __score_worker_shard(
+    shard_user_codes: np.ndarray, memory_budget_mb: int, evaluate: bool
+):
+    started = time.perf_counter()
+    content_sums, content_counts, evaluation_df = score_user_shard(
+        _worker_bundle, shard_user_codes, memory_budget_mb, evaluate
+    )
+
+    return (
+        os.getpid(),
+        len(shard_user_codes),
+        time.perf_counter() - started,
+        content_sums,
+        content_counts,
+        evaluation_df,
+    )
+
+
+@time_it
+def __coordinate_shards(
+    bundle: ScoringBundle,
+    user_codes: np.ndarray,
+    shard_size: int,
+    memory_budget_mb: int,
+    run_dir: Path,
+    blas_threads: int | None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Publishes the scoring bundle and shard leases of a new run, then works on shards alongside the other workers.
+    :return: content score sum and count per catalog movie over all shards
+    """
+    run_id = datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    scoring_bundle.write_scoring_bundle(run_dir / run_id / "bundle", bundle)
+
+    shard_ranges = [
+        (user_codes[start], user_codes[stop - 1] + 1)
+        for start, stop in block_scoring.iter_blocks(len(user_codes), shard_size)
+    ]
+    shard_leases.create_shards(run_id, shard_ranges)
+
+    # Written last, workers only see a run once its bundle and leases exist
+    __write_json_atomically(
+        run_dir / RUN_MANIFEST,
+        {"run_id": run_id, "n_shards": len(shard_ranges), "shard_size": shard_size},
+    )
+    logger.info(f"Published run {run_id} with {len(shard_ranges)} shards")
+
+    # Workers of earlier runs are done, their coordinator waited for every shard
+    for old_run_dir in run_dir.iterdir():
+        if old_run_dir.is_dir() and old_run_dir.name != run_id:
+            shutil.rmtree(old_run_dir, ignore_errors=True)
+
+    run_shard_worker(
+        run_dir, memory_budget_mb, blas_threads, run_id=run_id
+    )  # returns once all are done
+
+    content_sums = np.zeros(len(bundle.catalog_movie_ids))
+    content_counts = np.zeros(len(bundle.catalog_movie_ids), dtype=np.int64)
+    for shard_id in range(len(shard_ranges)):
+        shard_sums, shard_counts = __load_shard_stats(
+            run_dir / run_id / "shards" / f"{shard_id}.npz"
+        )
+        content_sums += shard_sums
+        content_counts += shard_counts
+
+    return content_sums, content_counts
+
+
+@time_it
+def run_shard_worker(
+    run_dir: Path,
+    memory_budget_mb: int = block_scoring.MEMORY_BUDGET_MB,
+    blas_threads: int | None = None,
+    run_id: str | None = None,
+):
+    """
+    Claims, scores and stores shards of the run published in run_dir until every shard is done.
+    Shards of workers that stop sending heartbeats are taken over once their lease expires,
+    a worker whose lease was taken over does not store the shard.
+    :param run_id: Run to work on, by default the next published run that has unfinished shards
+    """
+    if run_id is None:
+        run_id = __wait_for_unfinished_run(run_dir)
+
+    if blas_threads:
+        threadpool_limits(limits=blas_threads)
+
+    bundle = scoring_bundle.load_scoring_bundle(run_dir / run_id / "bundle")
+    scored_user_codes = get_scored_user_codes(
+        bundle.user_ids, bundle.score_external_users
+    )
+    shards_dir = run_dir / run_id / "shards"
+    shards_dir.mkdir(parents=True, exist_ok=True)
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    n_shards, n_users, started = 0, 0, time.perf_counter()
+
+    while True:
+        shard = shard_leases.claim_shard(run_id, worker_id)
+        if shard is None:
+            if shard_leases.count_unfinished_shards(run_id) == 0:
+                break
+            time.sleep(shard_leases.POLL_SECONDS)  # other workers hold the rest
+            continue
+
+        shard_id = shard["shard_id"]
+        start, stop = np.searchsorted(
+            scored_user_codes, [shard["user_code_start"], shard["user_code_stop"]]
         )
+        shard_user_codes = scored_user_codes[start:stop]
+
+        with shard_leases.LeaseHeartbeat(run_id, shard_id, worker_id) as heartbeat:
+            content_sums, content_counts, _ = score_user_shard(
+                bundle, shard_user_codes, memory_budget_mb, heartbeat=heartbeat
+            )
+            if not heartbeat.lost:
+                # Stats are in place before the shard is marked done
+                __save_shard_stats(
+                    shards_dir / f"{shard_id}.npz", content_sums, content_counts
+                )
+
+        if not heartbeat.lost and shard_leases.complete_shard(
+            run_id, shard_id, worker_id
+        ):
+            n_shards += 1
+            n_users += len(shard_user_codes)
+        else:
+            logger.warning(f"Shard {shard_id} was taken over before it was completed")
+
+    seconds = time.perf_counter() - started
+    logger.info(
+        f"Worker {worker_id} finished run {run_id}: {n_shards} shards, {n_users} users"
+        f" in {seconds:.1f}s ({n_users / max(seconds, 1e-9):.1f} users/s)"
+    )
+
+
+def __wait_for_unfinished_run(run_dir: Path) -> str:
+    """
+    Waits for a coordinator to publish a run that still has shards to work on.
+    A finished run's manifest is left in place until the next coordinator starts, it is not joined.
+    :return: run_id of the published run
+    """
+    while True:
+        try:
+            with open(run_dir / RUN_MANIFEST) as f:
+                run_id = json.load(f)["run_id"]
+        except FileNotFoundError:
+            run_id = None
+
+        if run_id is not None and shard_leases.count_unfinished_shards(run_id) > 0:
+            return run_id
+
+        logger.info(f"Waiting for a coordinator to publish a run to {run_dir}")
+        time.sleep(shard_leases.POLL_SECONDS)
+
+
+def __write_json_atomically(path: Path, data: dict):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+@time_it
+def score_shard(
+    content_scores: tuple[np.ndarray, np.ndarray, np.ndarray],
+    cf_scores: tuple[np.ndarray, np.ndarray, np.ndarray],
+    quality_prior: np.ndarray,
+    external_user_codes: np.ndarray | None = None,
+) -> pd.DataFrame:
+    """
+    Merges, normalises and quality boosts the columnar CF and CBF scores of a shard of users.
+    :param quality_prior: Quality boost of each catalog movie, see compute_quality_prior
+    :param external_user_codes: External (lb_) users of the shard, see compute_hybrid_scores
+    """
+    hybrid_df = merge_scores(content_scores, cf_scores, len(quality_prior))
+
+    hybrid_df = normalize_per_user(hybrid_df, ["content_score", "cf_score"])
+
+    hybrid_df = compute_hybrid_scores(
+        hybrid_df, external_user_codes=external_user_codes
+    )
+
+    return apply_quality_boost(hybrid_df, quality_prior)
+
+
+def get_top_k_per_user(hybrid_df: pd.DataFrame, k: int) -> pd.DataFrame:
+    return (
+        hybrid_df.sort_values(["user_code", "final_score"], ascending=[True, False])
+        .groupby("user_code", sort=False)
+        .head(k)
+    )
 
 
 @time_it
 def generate_user_hybrid_recommendations(user_id: str):
     print(f"Generating hybrid recs for user: {user_id}")
-    artifacts = azure_blob.load_artifacts()
+    artifacts = artifact_registry.get().artifacts
 
-    raw_ratings, centered_ratings = rating_matrix_service.get_rating_matrix_for_user(
+    raw_ratings, centered_ratings = ratings_aggregate.get_rating_matrix_for_user(
         user_id
     )  # Dict of {movie_id: rating}
 
     if len(raw_ratings) < 5:
         raise ValueError("Not enough ratings to generate recommendations.")
 
-    content_scores = content_based_filtering_service.get_new_user_content_score(
-        raw_ratings, user_id, artifacts
-    )
+    content_scores, user_vector = (
+        content_based_filtering_service.get_new_user_content_score(
+            raw_ratings, user_id, artifacts
+        )
+    )  # columnar, movies coded by catalog code
     cf_scores = collaborative_filtering_service.get_new_user_cf_scores(
-        centered_ratings, user_id, artifacts
-    )  # shape: {movie_id: cf_score}
+        centered_ratings, artifacts
+    )  # columnar, movies coded by catalog code
 
-    hybrid_df = merge_scores(content_scores, cf_scores)
+    catalog_movie_ids = artifacts["movie_ids"].astype(object)
 
-    hybrid_df = normalize_per_user(hybrid_df, ["content_score", "cf_score"])
-
-    hybrid_df = compute_hybrid_scores(hybrid_df)
-
-    hybrid_df = apply_quality_boost(hybrid_df, artifacts["movies_metadata"])
+    hybrid_df = score_shard(content_scores, cf_scores, artifacts["movie_quality_prior"])
 
     hybrid_df["quality_boost_final_score"] = hybrid_df["final_score"]
 
     hybrid_df = normalize_per_user(hybrid_df, ["final_score"])
 
-    recommendation_storing_service.store_predictions(hybrid_df)
+    user_ids = np.array([user_id], dtype=object)
+    recommendation_storing_service.store_predictions(
+        hybrid_df,
+        user_ids,
+        catalog_movie_ids,
+        candidates=(
+            recommendation_storing_service.get_watch_provider_candidates(
+                user_ids, catalog_movie_ids
+            )
+            if recommendation_storing_service.STORE_CANDIDATES == "watch_providers"
+            else None
+        ),
+    )
 
+    if user_vector is not None:
+        recommendation_storing_service.store_user_profiles(
+            [user_id], csr_matrix(user_vector)
+        )
+
+
+def get_scored_user_codes(
+    user_ids: np.ndarray, include_external: bool = False
+) -> np.ndarray:
+    """
+    :return: codes of internal users (numeric user_ids), and of external (lb_) users when include_external
+    """
+    return np.flatnonzero(
+        [
+            uid.isnumeric() or (include_external and uid.startswith("lb_"))
+            for uid in user_ids
+        ]
+    ).astype(np.int32)
 
-@time_it
-def apply_quality_boost(
-    hybrid_df: pd.DataFrame, metadata: pd.DataFrame
-) -> pd.DataFrame:
-    merged = hybrid_df.merge(
-        metadata[["movie_id", "popularity", "vote_count", "vote_average"]],
-        on="movie_id",
-        how="left",
-    )
 
+def remap_movie_codes(
+    scores: tuple[np.ndarray, np.ndarray, np.ndarray], code_map: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Moves columnar scores into another movie code space, dropping movies that map to -1.
+    """
+    user_codes, movie_codes, values = scores
+    movie_codes = code_map[movie_codes]
+    mapped = movie_codes >= 0
+
+    return user_codes[mapped], movie_codes[mapped], values[mapped]
+
+
+def compute_quality_prior(metadata: pd.DataFrame) -> np.ndarray:
+    """
+    Quality boost of every catalog movie from its popularity and Bayesian weighted vote.
+    It only depends on the catalog, so it is computed once per catalog and added to scores by movie code.
+    :return: boost of each catalog movie code (movies_metadata row)
+    """
     # Fill and clip
-    merged["popularity"] = merged["popularity"].clip(0, 100).fillna(0)
-    merged["popularity"] = merged["popularity"].astype(float)
-    merged["vote_count"] = merged["vote_count"].clip(0, 1000).fillna(0)
-    merged["vote_average"] = merged["vote_average"].fillna(0)
+    popularity = metadata["popularity"].clip(0, 100).fillna(0).to_numpy(dtype=float)
+    v = metadata["vote_count"].clip(0, 1000).fillna(0).to_numpy(dtype=float)
+    R = metadata["vote_average"].fillna(0).to_numpy(dtype=float)
 
     # Weighted vote
     C = float(metadata["vote_average"].mean())
     m = float(metadata["vote_count"].quantile(0.70))
-    v = merged["vote_count"].astype(float)
-    R = merged["vote_average"].astype(float)
     # Bayesian
-    merged["weighted_rating"] = (v / (v + m)) * R + (m / (v + m)) * C
-    merged["rating_score"] = merged["weighted_rating"] / 10
+    weighted_rating = (v / (v + m)) * R + (m / (v + m)) * C
+    rating_score = weighted_rating / 10
 
-    merged["popularity_score"] = cap_boost(merged["popularity"], threshold=40)
+    popularity_score = cap_boost(popularity, threshold=40)
 
-    merged["popularity_score"] = merged["popularity_score"].astype(float)
-    merged["rating_score"] = merged["rating_score"].astype(float)
+    return 0.05 * popularity_score + 0.1 * rating_score
 
-    # Blend into adjusted final score
-    merged["final_score"] = (
-        0.75 * merged["raw_final_score"]
-        + 0.05 * merged["popularity_score"]
-        + 0.1 * merged["rating_score"]
+
+@time_it
+def apply_quality_boost(
+    hybrid_df: pd.DataFrame, quality_prior: np.ndarray
+) -> pd.DataFrame:
+    """
+    Blends each score with its movie's quality prior into the adjusted final score.
+    """
+    hybrid_df["final_score"] = (
+        0.75 * hybrid_df["raw_final_score"].to_numpy()
+        + quality_prior[hybrid_df["movie_code"].to_numpy()]
     )
 
-    return merged
+    return hybrid_df
 
 
 def cap_boost(x, threshold):
@@ -171,40 +874,77 @@ def cap_boost(x, threshold):
 
 
 @time_it
-def merge_scores(cbf_df: pd.DataFrame, cf_df: pd.DataFrame):
-    internal_cbf_df = cbf_df[cbf_df["user_id"].str.isnumeric()]
-    internal_cf_df = cf_df[cf_df["user_id"].str.isnumeric()]
+def merge_scores(
+    content_scores: tuple[np.ndarray, np.ndarray, np.ndarray],
+    cf_scores: tuple[np.ndarray, np.ndarray, np.ndarray],
+    n_movies: int,
+) -> pd.DataFrame:
+    """
+    Outer joins columnar content and cf scores that share user and catalog movie codes.
+    :return: DataFrame with user_code, movie_code, content_score and cf_score sorted by user then movie, NaN where a score is missing
+    """
+    content_keys = __pair_keys(content_scores, n_movies)
+    cf_keys = __pair_keys(cf_scores, n_movies)
+
+    keys = np.union1d(content_keys, cf_keys)  # sorted unique (user, movie) pairs
+
+    content_score = np.full(len(keys), np.nan)
+    content_score[np.searchsorted(keys, content_keys)] = content_scores[2]
 
-    return pd.merge(
-        internal_cbf_df,
-        internal_cf_df,
-        on=["user_id", "movie_id"],
-        how="outer",
-        sort=False,
+    cf_score = np.full(len(keys), np.nan)
+    cf_score[np.searchsorted(keys, cf_keys)] = cf_scores[2]
+
+    return pd.DataFrame(
+        {
+            "user_code": (keys // n_movies).astype(np.int32),
+            "movie_code": (keys % n_movies).astype(np.int32),
+            "content_score": content_score,
+            "cf_score": cf_score,
+        }
     )
 
 
+def __pair_keys(
+    scores: tuple[np.ndarray, np.ndarray, np.ndarray], n_movies: int
+) -> np.ndarray:
+    user_codes, movie_codes, _ = scores
+
+    return user_codes.astype(np.int64) * n_movies + movie_codes
+
+
 @time_it
 def normalize_per_user(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
-    def normalize(group):
-        for column in columns:
-            min_val = group[column].min()
-            max_val = group[column].max()
-            if max_val - min_val == 0:
-                group[column] = 0.0  # Could also use 1.0 depending on your use case
-            else:
-                group[column] = (group[column] - min_val) / (max_val - min_val)
-        return group
+    """
+    Min-max normalises each column within each users rows, users with a single value get 0.0.
+    """
+    grouped = df.groupby("user_code", sort=False)
+
+    for column in columns:
+        min_val = grouped[column].transform("min")
+        max_val = grouped[column].transform("max")
+        value_range = max_val - min_val
+
+        df[column] = ((df[column] - min_val) / value_range).where(
+            value_range != 0, 0.0
+        )  # Could also use 1.0 depending on your use case
 
-    return df.groupby("user_id", group_keys=False).apply(normalize)
+    return df
 
 
 @time_it
-def compute_hybrid_scores(hybrid_df: pd.DataFrame, alpha: float = 0.7) -> pd.DataFrame:
+def compute_hybrid_scores(
+    hybrid_df: pd.DataFrame,
+    alpha: float = 0.7,
+    external_user_codes: np.ndarray | None = None,
+) -> pd.DataFrame:
+    """
+    :param external_user_codes: Users without a content profile, their movies without a content score are ranked on CF alone
+    """
     cf = hybrid_df["cf_score"].to_numpy()
     cb = hybrid_df["content_score"].to_numpy()
 
     has_cf = ~np.isnan(cf)
+    has_cb = ~np.isnan(cb)
 
     final: np.ndarray = cb.copy()
 
@@ -213,6 +953,15 @@ def compute_hybrid_scores(hybrid_df: pd.DataFrame, alpha: float = 0.7) -> pd.Dat
         ~has_cf
     ] *= 0.8  # Scaling where only content based scores are available cause it leads to obscure recommendations
 
+    if external_user_codes is not None and len(external_user_codes):
+        # External users have no content profile, they are ranked on CF alone
+        cf_only = (
+            has_cf
+            & ~has_cb
+            & np.isin(hybrid_df["user_code"].to_numpy(), external_user_codes)
+        )
+        final[cf_only] = cf[cf_only]
+
     hybrid_df["raw_final_score"] = final
     return hybrid_df
 
@@ -224,9 +973,31 @@ def get_normal_final_scores(
     return alpha * cf[has_cf] + (1 - alpha) * cb[has_cf]
 
 
-def run_recommender():
+def run_recommender(
+    shard_size: int | None = None,
+    memory_budget_mb: int = block_scoring.MEMORY_BUDGET_MB,
+    workers: int = 1,
+    blas_threads: int | None = None,
+    role: str = "local",
+    run_dir: Path = Path(shard_leases.RUN_DIR),
+    fresh: bool = False,
+    rebuild_ratings: bool = False,
+):
     try:
-        get_hybrid_filtering()
+        if fresh:
+            checkpoints.clear_checkpoints()
+
+        if role == "worker":
+            run_shard_worker(run_dir, memory_budget_mb, blas_threads)
+        else:
+            get_hybrid_filtering(
+                shard_size=shard_size,
+                memory_budget_mb=memory_budget_mb,
+                workers=workers,
+                blas_threads=blas_threads,
+                run_dir=run_dir if role == "coordinator" else None,
+                rebuild_ratings=rebuild_ratings,
+            )
     except Exception as e:
         logger.error(f"Error in hybrid recommendation service: {e}")
         logger.error(f"Traceback: {traceback.format_exc()}")
@@ -234,4 +1005,62 @@ def run_recommender():
 
 
 if __name__ == "__main__":
-    run_recommender()
+    parser = argparse.ArgumentParser(description="Nightly hybrid recommender")
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=None,
+        help="Users scored and stored per shard, chosen from the memory budget by default",
+    )
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=int,
+        default=block_scoring.MEMORY_BUDGET_MB,
+        help="Memory a shard may use, defaults to RECOMMENDER_MEMORY_BUDGET_MB",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processes scoring shards in parallel, 1 scores in this process",
+    )
+    parser.add_argument(
+        "--blas-threads",
+        type=int,
+        default=None,
+        help="BLAS threads per worker, defaults to the cores divided between workers",
+    )
+    parser.add_argument(
+        "--role",
+        choices=["local", "coordinator", "worker"],
+        default="local",
+        help="local scores every shard itself, a coordinator fits and publishes a run that workers on any node lease shards of",
+    )
+    parser.add_argument(
+        "--run-dir",
+        type=Path,
+        default=Path(shard_leases.RUN_DIR),
+        help="Shared directory runs are published to, defaults to RECOMMENDER_RUN_DIR",
+    )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="Clear the stage checkpoints of earlier runs instead of resuming from them",
+    )
+    parser.add_argument(
+        "--rebuild-ratings",
+        action="store_true",
+        help="Rebuild the ratings aggregate from every interaction instead of updating it",
+    )
+    args = parser.parse_args()
+
+    run_recommender(
+        shard_size=args.shard_size,
+        memory_budget_mb=args.memory_budget_mb,
+        workers=args.workers,
+        blas_threads=args.blas_threads,
+        role=args.role,
+        run_dir=args.run_dir,
+        fresh=args.fresh,
+        rebuild_ratings=args.rebuild_ratings,
+    )
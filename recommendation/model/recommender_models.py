@@ -0,0 +1,28 @@
+from dataclasses import dataclass
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+
+@dataclass
+class CollaborativeFilteringModel:
+    user_features: np.ndarray  # [n_users x k] float32, row = user code
+    movie_features: np.ndarray  # [k x n_movies] column = ratings matrix column
+
+
+@dataclass
+class ContentBasedFilteringModel:
+    tfidf_vectorizer: TfidfVectorizer
+    tfidf_matrix: csr_matrix  # [n_movies x n_features] row = catalog movie code
+    user_profiles: csr_matrix  # [n_profiles x n_features]
+    profile_user_codes: np.ndarray  # ascending user code of each profile row
+    normalized_profiles: csr_matrix  # unit length float32 profiles
+    movie_vectors_t: csr_matrix  # [n_features x n_movies] unit length float32 movies
+
+
+@dataclass
+class WatchProviderCandidates:
+    user_offers: (
+        csr_matrix  # [n_users x n_offers] offer = (provider, region) the user can watch
+    )
+    offer_movies: csr_matrix  # [n_offers x n_movies] column = catalog movie code
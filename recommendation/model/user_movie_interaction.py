@@ -9,6 +9,10 @@ class UserMovieInteraction:
     interaction_type: str
     created_at: str
     rating: int
+    active: bool = True
+    id: int | None = None
+    # Time the interaction was created or deactivated at
+    changed_at: str | None = None
 
 
 @dataclass
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+
+def sort_catalog(movies_metadata: pd.DataFrame) -> pd.DataFrame:
+    """
+    Orders the catalog by movie id, so the catalog code of a movie (its movies_metadata row)
+    is its position in the movie id table and ids resolve to codes by binary search.
+    """
+    return movies_metadata.sort_values(
+        "movie_id", key=lambda ids: ids.astype(str), ignore_index=True
+    )
+
+
+def get_movie_id_table(catalog_movie_ids) -> np.ndarray:
+    """
+    The movie ids of a sorted catalog as fixed width strings, published as the movie_ids artifact.
+    Every matrix artifact is indexed by the codes of this table.
+    """
+    movie_id_table = np.asarray(catalog_movie_ids, dtype=str)
+    if np.any(movie_id_table[:-1] >= movie_id_table[1:]):
+        raise ValueError("Movie ids must be unique and sorted, see sort_catalog")
+
+    return movie_id_table
+
+
+def get_movie_codes(movie_ids, movie_id_table: np.ndarray) -> np.ndarray:
+    """
+    Resolves movie ids to their code in the sorted movie id table, -1 for ids missing from it.
+    """
+    return get_sorted_positions(
+        np.asarray(movie_ids, dtype=str), np.asarray(movie_id_table, dtype=str)
+    )
+
+
+def get_sorted_positions(values: np.ndarray, sorted_table: np.ndarray) -> np.ndarray:
+    """
+    Position of each value in a sorted table without duplicates, -1 for values missing from it.
+    """
+    positions = np.searchsorted(sorted_table, values)
+    found = positions < len(sorted_table)
+    found[found] = sorted_table[positions[found]] == values[found]
+
+    return np.where(found, positions, -1).astype(np.int32)
@@ -0,0 +1,354 @@
+import datetime
+import json
+import os
+import shutil
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from scipy.sparse import csr_matrix, load_npz, save_npz
+from dotenv import load_dotenv
+from common.utils import azure_blob
+from common.utils.logging_service import logger
+from common.utils.utils import time_it
+from recommendation import checkpoints, ratings_matrix
+from recommendation.ratings_matrix import (
+    DECAY_RATE,
+    aggregate_interaction_batches,
+    aggregate_interactions,
+    read_interaction_batches,
+)
+from user_movie_interactions import user_movie_interaction_service
+
+load_dotenv()
+
+# Local directory the aggregated ratings are versioned in between runs
+RATINGS_AGGREGATE_DIR = Path(
+    os.getenv("RECOMMENDER_RATINGS_AGGREGATE_DIR", "artifacts/ratings_aggregate")
+)
+
+CURRENT_VERSION = "CURRENT"
+AGGREGATE_MANIFEST = "aggregate.json"
+
+SOURCES = ["internal", "external"]
+
+# Interactions are read again from this long before the previous read, so rows whose transaction committed after it are not missed
+WATERMARK_LAG_SECONDS = int(os.getenv("RECOMMENDER_WATERMARK_LAG_SECONDS", "600"))
+
+
+@time_it
+def load_ratings(full_rebuild: bool = False) -> tuple[pd.DataFrame, str]:
+    """
+    Brings the persisted ratings aggregate up to date and returns it.
+    Scores are decayed to the aggregate's reference date, moving it to today rescales them by DECAY_RATE ** days.
+    Internal interactions created or deactivated since the last watermark are then applied,
+    the external aggregate is rebuilt, streaming the artifact, when the external interactions artifact changes.
+    Both are rebuilt from every interaction with full_rebuild, or when nothing is persisted yet.
+    :return: user_id, movie_id, final_score and interaction_count sorted by user_id and movie_id, and the aggregate version
+    """
+    manifest, aggregates = __load_current()
+    today = datetime.datetime.now(tz=datetime.timezone.utc).date()
+
+    rebuild = full_rebuild or manifest is None or "reference_date" not in manifest
+    if rebuild:
+        manifest = {"reference_date": today.isoformat(), "watermark": None}
+        aggregates = {}
+
+    days = (today - datetime.date.fromisoformat(manifest["reference_date"])).days
+    if days > 0:
+        aggregates["internal"]["final_score"] *= DECAY_RATE**days
+        manifest["reference_date"] = today.isoformat()
+
+    external_path = azure_blob.get_artifact_path("external_interactions_transformed")
+    external_fingerprint = checkpoints.fingerprint(external_path)
+    external_changed = manifest.get("external_fingerprint") != external_fingerprint or (
+        days > 0 and "created_at" in pq.read_schema(external_path).names
+    )  # undated external interactions are not decayed, so are kept until the artifact changes
+    if external_changed:
+        aggregates["external"] = aggregate_interaction_batches(
+            read_interaction_batches(external_path), today
+        )
+
+    since = (
+        None
+        if manifest["watermark"] is None
+        else datetime.datetime.fromisoformat(manifest["watermark"])
+    )
+    changed, watermark = user_movie_interaction_service.get_interactions_changed_since(
+        since, lag_seconds=WATERMARK_LAG_SECONDS
+    )
+    changed = pd.DataFrame(changed)
+    directions = __get_directions(changed, since, manifest.get("overlap", {}))
+    applied = int(np.count_nonzero(directions))
+    if applied or rebuild:
+        aggregates["internal"] = __apply_interactions(
+            aggregates.get("internal"), changed, directions, today
+        )
+    logger.info(
+        f"{'Rebuilt' if rebuild else f'Decayed by {days} days and updated'} ratings aggregate"
+        f" with {applied} internal interactions"
+    )
+
+    # Rows only read again in the overlap leave the watermark as it is, they stay recorded in the overlap
+    if rebuild or days > 0 or external_changed or applied:
+        if applied or rebuild:
+            manifest["watermark"] = watermark.isoformat()
+            manifest["overlap"] = __get_overlap(changed, watermark)
+        manifest["external_fingerprint"] = external_fingerprint
+        manifest["version"] = checkpoints.fingerprint(
+            manifest.get("version"),
+            manifest["reference_date"],
+            manifest["watermark"],
+            external_fingerprint,
+        )
+        __save_version(manifest, aggregates)
+
+    ratings = pd.concat([aggregates[source] for source in SOURCES], ignore_index=True)
+    ratings = ratings.sort_values(["user_id", "movie_id"], ignore_index=True)
+
+    return ratings, manifest["version"]
+
+
+@time_it
+def get_rating_matrix_for_user(user_id: int) -> tuple[dict, dict]:
+    """
+    Serves a user's ratings from the persisted aggregate, decayed to today and updated with their interactions
+    changed since it was saved. Falls back to the user's interactions when no aggregate is persisted.
+    """
+    if not (RATINGS_AGGREGATE_DIR / CURRENT_VERSION).exists():
+        return ratings_matrix.get_rating_matrix_for_user(user_id)
+
+    version = (RATINGS_AGGREGATE_DIR / CURRENT_VERSION).read_text().strip()
+    manifest, scores, user_index, movie_ids, counts = __load_internal_aggregate(version)
+    today = datetime.datetime.now(tz=datetime.timezone.utc).date()
+
+    user_aggregate = __empty_aggregate()
+    if str(user_id) in user_index:
+        user_code = user_index.get_loc(str(user_id))
+        start, stop = scores.indptr[user_code], scores.indptr[user_code + 1]
+        days = (today - datetime.date.fromisoformat(manifest["reference_date"])).days
+
+        user_aggregate = pd.DataFrame(
+            {
+                "user_id": str(user_id),
+                "movie_id": movie_ids[scores.indices[start:stop]],
+                "final_score": scores.data[start:stop] * DECAY_RATE ** max(days, 0),
+                "interaction_count": counts[start:stop],
+            }
+        )
+
+    since = datetime.datetime.fromisoformat(manifest["watermark"])
+    changed, _ = user_movie_interaction_service.get_interactions_changed_since(
+        since, user_id=user_id
+    )
+    changed = pd.DataFrame(changed)
+
+    return ratings_matrix.get_rating_matrix_for_user(
+        user_id,
+        __apply_interactions(
+            user_aggregate,
+            changed,
+            __get_directions(changed, since, manifest.get("overlap", {})),
+            today,
+        ),
+    )
+
+
+@lru_cache(maxsize=1)
+def __load_internal_aggregate(
+    version: str,
+) -> tuple[dict, csr_matrix, pd.Index, np.ndarray, np.ndarray]:
+    """
+    Loaded once per version, so requests only read the rows of their user.
+    """
+    version_dir = RATINGS_AGGREGATE_DIR / version
+    with open(version_dir / AGGREGATE_MANIFEST) as f:
+        manifest = json.load(f)
+
+    return (
+        manifest,
+        load_npz(version_dir / "internal_scores.npz").tocsr(),
+        pd.Index(np.load(version_dir / "internal_user_ids.npy").astype(object)),
+        np.load(version_dir / "internal_movie_ids.npy").astype(object),
+        np.load(version_dir / "internal_counts.npy"),
+    )
+
+
+def __get_directions(
+    interactions: pd.DataFrame, since: datetime.datetime | None, overlap: dict
+) -> np.ndarray:
+    """
+    Whether each interaction read is added to the aggregate (1), taken back out (-1) or already in the state read (0).
+    An interaction read before in the overlap was applied as recorded there, any other one was applied
+    if it was created before the watermark (and read as active then), so reading a row twice applies it once.
+    :param overlap: Active state each interaction changed after the watermark was applied with, by id
+    """
+    if interactions.empty:
+        return np.zeros(0, dtype=np.int64)
+
+    is_active = interactions["active"].astype(bool).to_numpy()
+    if since is None:
+        was_applied = np.zeros(len(interactions), dtype=bool)
+    else:
+        was_applied = (
+            interactions["id"]
+            .astype(str)
+            .map(overlap)
+            .fillna(
+                pd.Series(
+                    pd.to_datetime(interactions["created_at"], utc=True)
+                    <= pd.Timestamp(since)
+                )
+            )
+            .astype(bool)
+            .to_numpy()
+        )
+
+    return is_active.astype(np.int64) - was_applied.astype(np.int64)
+
+
+def __get_overlap(interactions: pd.DataFrame, watermark: datetime.datetime) -> dict:
+    """
+    :return: Active state of the interactions changed after the watermark, which the next read returns again
+    """
+    if interactions.empty:
+        return {}
+
+    in_overlap = pd.to_datetime(interactions["changed_at"], utc=True) > pd.Timestamp(
+        watermark
+    )
+    return dict(
+        zip(
+            interactions.loc[in_overlap, "id"].astype(str),
+            interactions.loc[in_overlap, "active"].astype(bool),
+        )
+    )
+
+
+def __apply_interactions(
+    aggregate: pd.DataFrame | None,
+    interactions: pd.DataFrame,
+    directions: np.ndarray,
+    reference_date: datetime.date,
+) -> pd.DataFrame:
+    """
+    Adds new interactions to the aggregate and takes deactivated ones back out,
+    pairs left without any interaction are dropped.
+    :param directions: See __get_directions
+    """
+    parts = [aggregate if aggregate is not None else __empty_aggregate()]
+
+    if not interactions.empty:
+        for direction in [1, -1]:
+            rows = directions == direction
+            if rows.any():
+                grouped = aggregate_interactions(
+                    interactions[rows].copy(), reference_date
+                )
+                grouped["final_score"] *= direction
+                grouped["interaction_count"] *= direction
+                parts.append(grouped)
+
+    if len(parts) == 1:
+        return parts[0]
+
+    aggregate = (
+        pd.concat(parts, ignore_index=True)
+        .groupby(["user_id", "movie_id"])[["final_score", "interaction_count"]]
+        .sum()
+        .reset_index()
+    )
+    return aggregate[aggregate["interaction_count"] > 0].reset_index(drop=True)
+
+
+def __empty_aggregate() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "user_id": pd.Series(dtype=object),
+            "movie_id": pd.Series(dtype=object),
+            "final_score": pd.Series(dtype=float),
+            "interaction_count": pd.Series(dtype=np.int64),
+        }
+    )
+
+
+def __load_current() -> tuple[dict | None, dict[str, pd.DataFrame]]:
+    if not (RATINGS_AGGREGATE_DIR / CURRENT_VERSION).exists():
+        return None, {}
+
+    version_dir = (
+        RATINGS_AGGREGATE_DIR
+        / (RATINGS_AGGREGATE_DIR / CURRENT_VERSION).read_text().strip()
+    )
+    with open(version_dir / AGGREGATE_MANIFEST) as f:
+        manifest = json.load(f)
+
+    aggregates = {}
+    for source in SOURCES:
+        scores = load_npz(version_dir / f"{source}_scores.npz").tocsr()
+        user_ids = np.load(version_dir / f"{source}_user_ids.npy").astype(object)
+        movie_ids = np.load(version_dir / f"{source}_movie_ids.npy").astype(object)
+
+        aggregates[source] = pd.DataFrame(
+            {
+                "user_id": np.repeat(user_ids, np.diff(scores.indptr)),
+                "movie_id": movie_ids[scores.indices],
+                "final_score": scores.data,
+                "interaction_count": np.load(version_dir / f"{source}_counts.npy"),
+            }
+        )
+
+    return manifest, aggregates
+
+
+def __save_version(manifest: dict, aggregates: dict[str, pd.DataFrame]):
+    """
+    Writes the aggregate under its version, then points CURRENT_VERSION at it and removes older versions.
+    Each aggregate is a [n_users x n_movies] CSR of scores with its own id tables,
+    explicit zeros are kept since a pair whose interactions cancel out still counts towards its user.
+    """
+    version_dir = RATINGS_AGGREGATE_DIR / manifest["version"]
+    shutil.rmtree(version_dir, ignore_errors=True)
+    version_dir.mkdir(parents=True)
+
+    for source in SOURCES:
+        aggregate = aggregates[source]  # sorted by user_id, movie_id
+        user_codes, user_ids = pd.factorize(aggregate["user_id"], sort=True)
+        movie_codes, movie_ids = pd.factorize(aggregate["movie_id"], sort=True)
+
+        scores = csr_matrix(
+            (
+                aggregate["final_score"].to_numpy(dtype=float),
+                movie_codes.astype(np.int32),
+                np.concatenate(
+                    [[0], np.cumsum(np.bincount(user_codes, minlength=len(user_ids)))]
+                ),
+            ),
+            shape=(len(user_ids), len(movie_ids)),
+        )
+        save_npz(version_dir / f"{source}_scores.npz", scores, compressed=False)
+        np.save(
+            version_dir / f"{source}_counts.npy",
+            aggregate["interaction_count"].to_numpy(dtype=np.int64),
+        )
+        np.save(version_dir / f"{source}_user_ids.npy", np.asarray(user_ids, dtype=str))
+        np.save(
+            version_dir / f"{source}_movie_ids.npy", np.asarray(movie_ids, dtype=str)
+        )
+
+    with open(version_dir / AGGREGATE_MANIFEST, "w") as f:
+        json.dump(manifest, f)
+
+    tmp_path = RATINGS_AGGREGATE_DIR / f"{CURRENT_VERSION}.tmp"
+    tmp_path.write_text(manifest["version"])
+    os.replace(tmp_path, RATINGS_AGGREGATE_DIR / CURRENT_VERSION)
+
+    for other in RATINGS_AGGREGATE_DIR.iterdir():
+        if other.is_dir() and other != version_dir:
+            shutil.rmtree(other, ignore_errors=True)
+
+    logger.info(
+        f"Ratings aggregate {manifest['version']}: "
+        + ", ".join(f"{source} {len(aggregates[source])} pairs" for source in SOURCES)
+    )
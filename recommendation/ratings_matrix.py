@@ -1,6 +1,11 @@
 import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from common.utils import azure_blob
 from user_movie_interactions import user_movie_interaction_service
 from common.utils.utils import time_it
@@ -8,35 +13,240 @@ from scipy.sparse import csr_matrix
 
 LIKED_THRESHOLD = 5
 
+# Interaction scores are multiplied by this for every day since the interaction
+DECAY_RATE = 0.97
+
+# Score of each interaction type, a rating scores its offset from NEUTRAL_RATING on top
+INTERACTION_TYPES = ["RATING", "LIKE", "WATCHED", "REVIEW"]
+INTERACTION_WEIGHTS = np.array([0.0, 2.0, 1.0, 1.2, 0.0])  # last: unknown types
+NEUTRAL_RATING = 5
+
+# Interactions read from parquet at a time, a batch is summed per pair before the next one is read
+INTERACTION_BATCH_SIZE = 1_000_000
+
 
 @time_it
-def create_ratings_matrix(
-    split_for_evaluation=False,
-) -> tuple[csr_matrix, dict, dict, pd.DataFrame | None]:
-    artifacts = azure_blob.load_artifacts()
-    df_external = artifacts["external_interactions_transformed"]
+def aggregate_interactions(
+    df_all: pd.DataFrame, reference_date: datetime.date | None = None
+) -> pd.DataFrame:
+    """
+    Scores and time decays interactions, then sums them per user and movie.
+    :param reference_date: Day the decay is computed at, defaults to today (UTC)
+    :return: user_id, movie_id and final_score sorted by user_id and movie_id, and the number of interactions summed
+    """
+    user_codes, user_ids = __factorize_ids(df_all["user_id"])
+    movie_codes, movie_ids = __factorize_ids(df_all["movie_id"])
+
+    scores = score_interactions(
+        pd.Categorical(df_all["interaction_type"], categories=INTERACTION_TYPES).codes,
+        pd.to_numeric(df_all["rating"]).to_numpy(dtype=float),
+        __get_days_ago(
+            df_all["created_at"] if "created_at" in df_all else None,
+            len(df_all),
+            reference_date,
+        ),  # external interactions are undated, so not decayed
+    )
+    pair_user_codes, pair_movie_codes, final_scores, interaction_counts = sum_per_pair(
+        user_codes, movie_codes, scores, len(movie_ids)
+    )
+
+    return pd.DataFrame(
+        {
+            "user_id": user_ids[pair_user_codes],
+            "movie_id": movie_ids[pair_movie_codes],
+            "final_score": final_scores,
+            "interaction_count": interaction_counts,
+        }
+    )
+
+
+@time_it
+def aggregate_interaction_batches(
+    batches: Iterable[pa.RecordBatch], reference_date: datetime.date | None = None
+) -> pd.DataFrame:
+    """
+    aggregate_interactions over Arrow record batches, so interactions are never loaded whole.
+    Ids stay dictionary encoded, each batch is summed per pair of dictionary codes with a pyarrow group by
+    and only its pairs are kept. The batch dictionaries are unified into one at the end, so pairs are summed
+    across batches by integer code and ids are only turned into str once per distinct id.
+    :return: same as aggregate_interactions
+    """
+    user_parts, movie_parts, score_parts, count_parts = [], [], [], []
+
+    for batch in batches:
+        user_ids = __dictionary_encode(batch.column("user_id"))
+        movie_ids = __dictionary_encode(batch.column("movie_id"))
+        interaction_types = __dictionary_encode(batch.column("interaction_type"))
+
+        type_codes = pc.take(
+            pc.index_in(
+                interaction_types.dictionary, value_set=pa.array(INTERACTION_TYPES)
+            ),
+            interaction_types.indices,
+        )
+        scores = score_interactions(
+            pc.fill_null(type_codes, -1).to_numpy(),
+            pc.cast(batch.column("rating"), pa.float64()).to_numpy(
+                zero_copy_only=False
+            ),
+            __get_days_ago(
+                (
+                    batch.column("created_at").to_pandas()
+                    if "created_at" in batch.schema.names
+                    else None
+                ),
+                batch.num_rows,
+                reference_date,
+            ),
+        )
+
+        grouped = (
+            pa.table(
+                {
+                    "user_code": user_ids.indices,
+                    "movie_code": movie_ids.indices,
+                    "final_score": scores,
+                }
+            )
+            .group_by(["user_code", "movie_code"], use_threads=False)
+            .aggregate([("final_score", "sum"), ("final_score", "count")])
+        )
+        user_parts.append(
+            pa.DictionaryArray.from_arrays(
+                grouped["user_code"].combine_chunks(), user_ids.dictionary
+            )
+        )
+        movie_parts.append(
+            pa.DictionaryArray.from_arrays(
+                grouped["movie_code"].combine_chunks(), movie_ids.dictionary
+            )
+        )
+        score_parts.append(grouped["final_score_sum"].to_numpy())
+        count_parts.append(grouped["final_score_count"].to_numpy())
+
+    if not user_parts:
+        return pd.DataFrame(
+            columns=["user_id", "movie_id", "final_score", "interaction_count"]
+        )
+
+    user_codes, user_ids = __factorize_dictionaries(user_parts)
+    movie_codes, movie_ids = __factorize_dictionaries(movie_parts)
+    pair_user_codes, pair_movie_codes, final_scores, interaction_counts = sum_per_pair(
+        user_codes,
+        movie_codes,
+        np.concatenate(score_parts),
+        len(movie_ids),
+        np.concatenate(count_parts),
+    )
 
-    df_internal = pd.DataFrame(
-        user_movie_interaction_service.get_all_user_interactions()
+    return pd.DataFrame(
+        {
+            "user_id": user_ids[pair_user_codes],
+            "movie_id": movie_ids[pair_movie_codes],
+            "final_score": final_scores,
+            "interaction_count": interaction_counts,
+        }
     )
 
-    df_all = pd.concat([df_internal, df_external], ignore_index=True)
 
-    df_all["user_id"] = df_all["user_id"].astype(str)
-    df_all["movie_id"] = df_all["movie_id"].astype(str)
+def read_interaction_batches(
+    path: Path, batch_size: int = INTERACTION_BATCH_SIZE
+) -> Iterator[pa.RecordBatch]:
+    """
+    Streams an interactions parquet file, string ids and types are read dictionary encoded.
+    """
+    parquet_file = pq.ParquetFile(
+        path, read_dictionary=["user_id", "movie_id", "interaction_type"]
+    )
+    yield from parquet_file.iter_batches(batch_size=batch_size)
+
+
+def score_interactions(
+    type_codes: np.ndarray, ratings: np.ndarray, days_ago: np.ndarray
+) -> np.ndarray:
+    """
+    :param type_codes: Position of each interaction's type in INTERACTION_TYPES, -1 for unknown types
+    :param ratings: Rating of each interaction, only read for ratings
+    :param days_ago: Whole days each interaction is decayed by
+    """
+    scores = INTERACTION_WEIGHTS[type_codes]  # -1 picks the unknown weight
+    is_rating = type_codes == INTERACTION_TYPES.index("RATING")
+    scores[is_rating] += ratings[is_rating] - NEUTRAL_RATING
+
+    return scores * DECAY_RATE**days_ago
+
+
+def sum_per_pair(
+    user_codes: np.ndarray,
+    movie_codes: np.ndarray,
+    values: np.ndarray,
+    n_movies: int,
+    counts: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param counts: Number of interactions each value already sums, 1 each when None
+    :return: user and movie code of each pair with values, ordered by user then movie code,
+             and the sum and number of its values
+    """
+    pair_keys, pair_positions = np.unique(
+        user_codes.astype(np.int64) * n_movies + movie_codes, return_inverse=True
+    )
+    pair_counts = np.bincount(pair_positions, weights=counts, minlength=len(pair_keys))
+
+    return (
+        pair_keys // n_movies,
+        pair_keys % n_movies,
+        np.bincount(pair_positions, weights=values, minlength=len(pair_keys)),
+        pair_counts.astype(np.int64),
+    )
 
-    df_all = __compute_first_interaction_score(df_all)
 
-    df_all = __add_time_decay(df_all)
+@time_it
+def aggregate_all_interactions(
+    reference_date: datetime.date | None = None,
+) -> pd.DataFrame:
+    """
+    Aggregates internal interactions from Postgres and streams the external interactions artifact,
+    internal and external users never overlap so their sums are concatenated.
+    :return: same as aggregate_interactions
+    """
+    df_internal = aggregate_interactions(
+        pd.DataFrame(user_movie_interaction_service.get_all_user_interactions()),
+        reference_date,
+    )
+    df_external = aggregate_interaction_batches(
+        read_interaction_batches(
+            azure_blob.get_artifact_path("external_interactions_transformed")
+        ),
+        reference_date,
+    )
 
-    df_grouped = (
-        df_all.groupby(["user_id", "movie_id"])["adjusted_score"]
-        .sum()
-        .reset_index()
-        .rename(columns={"adjusted_score": "final_score"})
+    return pd.concat([df_internal, df_external], ignore_index=True).sort_values(
+        ["user_id", "movie_id"], ignore_index=True
     )
 
-    df_grouped["final_score"] = df_grouped["final_score"].astype(float)
+
+@time_it
+def create_ratings_matrix(
+    split_for_evaluation=False,
+    interactions: tuple[pd.DataFrame, pd.DataFrame] | None = None,
+    ratings: pd.DataFrame | None = None,
+) -> tuple[csr_matrix, dict, dict, pd.DataFrame | None]:
+    """
+    :param interactions: Internal and external interactions, aggregated from Postgres and the external artifact
+                         when neither these nor ratings are given
+    :param ratings: Scores already aggregated per user and movie, as returned by aggregate_interactions
+    """
+    if ratings is not None:
+        df_grouped = ratings[["user_id", "movie_id", "final_score"]].copy()
+    elif interactions is not None:
+        df_grouped = aggregate_interactions(pd.concat(interactions, ignore_index=True))[
+            ["user_id", "movie_id", "final_score"]
+        ]
+    else:
+        df_grouped = aggregate_all_interactions()[
+            ["user_id", "movie_id", "final_score"]
+        ]
 
     if split_for_evaluation:
         positive_interactions = df_grouped[df_grouped["final_score"] >= LIKED_THRESHOLD]
@@ -100,23 +310,16 @@ def create_ratings_matrix(
 @time_it
 def get_rating_matrix_for_user(
     user_id: int,
+    user_ratings: pd.DataFrame | None = None,
 ) -> dict[str, float]:
-    user_ratings_df = pd.DataFrame(
-        user_movie_interaction_service.get_users_interactions(user_id)
-    )
-
-    user_ratings_df["user_id"] = user_ratings_df["user_id"].astype(str)
-    user_ratings_df["movie_id"] = user_ratings_df["movie_id"].astype(str)
-
-    user_ratings_df = __compute_first_interaction_score(user_ratings_df)
-    user_ratings_df = __add_time_decay(user_ratings_df)
-
-    user_ratings = (
-        user_ratings_df.groupby(["user_id", "movie_id"])["adjusted_score"]
-        .sum()
-        .reset_index()
-        .rename(columns={"adjusted_score": "final_score"})
-    )
+    """
+    :param user_ratings: The user's scores already aggregated per movie, their interactions are loaded when None
+    """
+    if user_ratings is None:
+        user_ratings = aggregate_interactions(
+            pd.DataFrame(user_movie_interaction_service.get_users_interactions(user_id))
+        )
+    user_ratings = user_ratings[["user_id", "movie_id", "final_score"]].copy()
 
     raw_ratings = dict(zip(user_ratings["movie_id"], user_ratings["final_score"]))
 
@@ -156,59 +359,64 @@ def leave_k_out_split(
     return train_df, test_df
 
 
-@time_it
-def __compute_first_interaction_score(df_all: pd.DataFrame) -> pd.DataFrame:
-    df_all["interaction_score"] = 0.0  # default
-
-    # Rating: use actual rating value
-    rating_mask = df_all["interaction_type"] == "RATING"
-    df_all.loc[rating_mask, "interaction_score"] = (
-        df_all.loc[rating_mask, "rating"].astype(float) - 5
-    )
-
-    # LIKE
-    like_mask = df_all["interaction_type"] == "LIKE"
-    df_all.loc[like_mask, "interaction_score"] = 2
-
-    # WATCHED
-    watched_mask = df_all["interaction_type"] == "WATCHED"
-    df_all.loc[watched_mask, "interaction_score"] = 1.0
-
-    # REVIEW
-    review_mask = df_all["interaction_type"] == "REVIEW"
-    df_all.loc[review_mask, "interaction_score"] = 1.2
+def __factorize_ids(ids: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Codes ids by their str, in sorted order. Only the distinct ids are turned into str.
+    """
+    codes, distinct_ids = pd.factorize(ids)
+    str_codes, str_ids = pd.factorize(distinct_ids.astype(str), sort=True)
 
-    df_all["interaction_score"] = df_all["interaction_score"].astype(float)
-    return df_all
-
-
-@time_it
-def __add_time_decay(user_interactions: pd.DataFrame) -> pd.DataFrame:
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return str_codes[codes], np.asarray(str_ids, dtype=object)
 
-    user_interactions["created_at"] = pd.to_datetime(
-        user_interactions["created_at"]
-    ).dt.tz_localize("UTC", ambiguous="NaT", nonexistent="NaT")
 
-    user_interactions["created_at"] = user_interactions["created_at"].fillna(now)
+def __dictionary_encode(column: pa.Array) -> pa.DictionaryArray:
+    if pa.types.is_dictionary(column.type):
+        return column
+    return pc.dictionary_encode(column)
 
-    user_interactions["days_ago"] = (
-        now - user_interactions["created_at"]
-    ).dt.days.clip(lower=0)
 
-    decay_rate = 0.97
-    user_interactions["time_decay"] = decay_rate ** user_interactions["days_ago"]
-    # user_interactions["recency_boost"] = 2 / (
-    #     1 + np.exp(user_interactions["days_ago"] / 10)
-    # )
-
-    user_interactions["adjusted_score"] = (
-        user_interactions["interaction_score"]
-        * user_interactions["time_decay"]
-        # * user_interactions["recency_boost"]
-    ).astype(float)
+def __factorize_dictionaries(
+    parts: list[pa.DictionaryArray],
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    __factorize_ids for dictionary encoded parts, only their unified dictionary is turned into str.
+    """
+    unified = pa.chunked_array(parts).unify_dictionaries()
+    str_codes, str_ids = pd.factorize(
+        unified.chunk(0).dictionary.to_pandas().astype(str), sort=True
+    )
+    codes = np.concatenate([part.indices.to_numpy() for part in unified.chunks])
+
+    return str_codes[codes], np.asarray(str_ids, dtype=object)
+
+
+def __get_days_ago(
+    created_at: pd.Series | None,
+    n_interactions: int,
+    reference_date: datetime.date | None = None,
+) -> np.ndarray:
+    """
+    Whole days between each interaction's date and reference_date, so a sum decayed at one date
+    is decayed to a later one by multiplying it by DECAY_RATE ** days in between.
+    Undated interactions are 0 days old.
+    """
+    if created_at is None:
+        return np.zeros(n_interactions)
+
+    reference = pd.Timestamp(
+        reference_date or datetime.datetime.now(tz=datetime.timezone.utc).date(),
+        tz="UTC",
+    )
+    created_at = pd.to_datetime(created_at).dt.tz_localize(
+        "UTC", ambiguous="NaT", nonexistent="NaT"
+    )
 
-    return user_interactions
+    return (
+        (reference - created_at.dt.floor("D"))
+        .dt.days.fillna(0)
+        .clip(lower=0)
+        .to_numpy(dtype=float)
+    )
 
 
 @time_it
@@ -2,12 +2,13 @@ import datetime
 import psycopg
 from common.utils.utils import DB_CONFIG
 from psycopg.rows import dict_row
+from recommendation.storage_layout import RECOMMENDATIONS_RELATION
 
 
 def get_recommendations(user_id: str, movie_id="6798244c6243f72901adb45e"):
-    query = """
+    query = f"""
     SELECT predicted_score
-    FROM user_recommendations ur
+    FROM {RECOMMENDATIONS_RELATION} ur
     WHERE ur.user_id =  %s
     AND ur.movie_id = %s
     """
@@ -22,10 +23,11 @@ def get_recommendations(user_id: str, movie_id="6798244c6243f72901adb45e"):
 
 
 def get_last_recommendation_update(user_id: str) -> datetime.datetime:
+    # Unchanged recommendations keep their old updated_at, each run records when it stored the user
     query = """
-    SELECT MAX(updated_at) AS last_update
-    FROM user_recommendations ur
-    WHERE ur.user_id =  %s
+    SELECT generated_at AS last_update
+    FROM user_recommendation_updates
+    WHERE user_id = %s
     """
 
     with psycopg.connect(**DB_CONFIG) as conn:
@@ -34,7 +36,7 @@ def get_last_recommendation_update(user_id: str) -> datetime.datetime:
 
             result = cur.fetchone()
 
-    last_update_raw = result["last_update"]
+    last_update_raw = result["last_update"] if result is not None else None
 
     if last_update_raw is not None:
         if last_update_raw.tzinfo is None:
@@ -0,0 +1,241 @@
+import os
+import shutil
+import time
+from functools import cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from dotenv import load_dotenv
+from common.utils.logging_service import logger
+from common.utils.utils import time_it
+
+load_dotenv()
+
+# Only write recommendations that moved since the previous run, compared against a local snapshot
+DELTA_WRITES = os.getenv("RECOMMENDER_DELTA_WRITES", "false").lower() == "true"
+
+# A stored score is rewritten when it moved by more than this
+SCORE_THRESHOLD = float(os.getenv("RECOMMENDER_DELTA_SCORE_THRESHOLD", "0.001"))
+
+# or when its rank within the users recommendations moved by more than this
+RANK_THRESHOLD = int(os.getenv("RECOMMENDER_DELTA_RANK_THRESHOLD", "0"))
+
+# Scores as stored by the last run, shared with every process writing recommendations
+SNAPSHOT_DIR = Path(
+    os.getenv("RECOMMENDER_SNAPSHOT_DIR", "artifacts/recommendation_snapshot")
+)
+
+
+class RecommendationSnapshot:
+    """
+    The stored score of every (user, movie) as a sparse [n_users x n_movies] matrix in the snapshot's own codes,
+    with id tables to look rows up by user and movie id.
+    """
+
+    def __init__(self, snapshot_dir: Path):
+        if (snapshot_dir / "scores_indptr.npy").exists():
+            scores = csr_matrix(
+                (
+                    np.load(snapshot_dir / "scores_data.npy", mmap_mode="r"),
+                    np.load(snapshot_dir / "scores_indices.npy", mmap_mode="r"),
+                    np.load(snapshot_dir / "scores_indptr.npy", mmap_mode="r"),
+                ),
+                copy=False,
+            )
+            user_ids = np.load(snapshot_dir / "user_ids.npy")
+            movie_ids = np.load(snapshot_dir / "movie_ids.npy")
+        else:
+            scores = csr_matrix((0, 0), dtype=np.float32)
+            user_ids = np.empty(0, dtype=str)
+            movie_ids = np.empty(0, dtype=str)
+
+        self.scores = scores
+        self.user_index = pd.Index(user_ids.astype(object))
+        self.movie_index = pd.Index(movie_ids.astype(object))
+
+    def previous(
+        self, user_ids: np.ndarray, movie_ids: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Looks up the stored score of each (user_id, movie_id) row.
+        :return: previous score (NaN when not stored) and rank (-1 when not stored) of each row,
+                 and how many movies were stored for the row's user
+        """
+        user_codes = self.user_index.get_indexer(user_ids)
+        movie_codes = self.movie_index.get_indexer(movie_ids)
+
+        previous_score = np.full(len(user_ids), np.nan)
+        previous_rank = np.full(len(user_ids), -1, dtype=np.int64)
+        previous_count = np.zeros(len(user_ids), dtype=np.int64)
+
+        known_users = np.unique(user_codes[user_codes >= 0])
+        if len(known_users) == 0:
+            return previous_score, previous_rank, previous_count
+
+        rows = self.scores[known_users]
+        counts = np.diff(rows.indptr)
+        stored_users = np.repeat(np.arange(len(known_users)), counts)
+
+        # rank of every stored movie within its user, best score first
+        order = np.lexsort((-rows.data, stored_users))
+        stored_rank = np.empty(len(order), dtype=np.int64)
+        stored_rank[order] = np.arange(len(order)) - np.repeat(rows.indptr[:-1], counts)
+
+        n_movies = max(len(self.movie_index), 1)
+        stored_keys = stored_users.astype(np.int64) * n_movies + rows.indices
+
+        row_user_positions = np.searchsorted(known_users, user_codes)
+        is_known_user = user_codes >= 0
+        previous_count[is_known_user] = counts[row_user_positions[is_known_user]]
+
+        looked_up = is_known_user & (movie_codes >= 0)
+        row_keys = (
+            row_user_positions[looked_up].astype(np.int64) * n_movies
+            + movie_codes[looked_up]
+        )  # stored keys are sorted, csr rows are in user order and columns ascending within a row
+        positions = np.minimum(
+            np.searchsorted(stored_keys, row_keys), max(len(stored_keys) - 1, 0)
+        )
+        found = stored_keys[positions] == row_keys
+
+        looked_up_rows = np.flatnonzero(looked_up)
+        previous_score[looked_up_rows[found]] = rows.data[positions[found]]
+        previous_rank[looked_up_rows[found]] = stored_rank[positions[found]]
+
+        return previous_score, previous_rank, previous_count
+
+
+def compare_with_snapshot(
+    snapshot: RecommendationSnapshot, df: pd.DataFrame
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compares the recommendations about to be stored with the snapshot.
+    :param df: user_id, movie_id and final_score of every recommendation kept for its users
+    :return: whether each row is new or moved beyond the thresholds, whether its user has any such row or a
+             different number of recommendations, and the previously stored score of each row
+    """
+    user_ids = df["user_id"].to_numpy()
+    scores = df["final_score"].to_numpy()
+    previous_score, previous_rank, previous_count = snapshot.previous(
+        user_ids, df["movie_id"].to_numpy()
+    )
+
+    by_user = pd.Series(-scores, index=df.index).groupby(user_ids)
+    rank = by_user.rank(method="first").to_numpy().astype(np.int64) - 1
+    count = by_user.transform("size").to_numpy()
+
+    changed = (
+        np.isnan(previous_score)
+        | (np.abs(scores - previous_score) > SCORE_THRESHOLD)
+        | (np.abs(rank - previous_rank) > RANK_THRESHOLD)
+    )
+    user_changed = (
+        pd.Series(changed | (count != previous_count), index=df.index)
+        .groupby(user_ids)
+        .transform("any")
+        .to_numpy()
+    )
+
+    return changed, user_changed, previous_score
+
+
+@cache
+def load_snapshot() -> RecommendationSnapshot:
+    """
+    Loaded once per process, the snapshot is only replaced by finalize_snapshot at the end of a run.
+    """
+    return RecommendationSnapshot(SNAPSHOT_DIR / "current")
+
+
+def record_stored(user_ids: np.ndarray, movie_ids: np.ndarray, scores: np.ndarray):
+    """
+    Records what the database holds for the users just stored, as a part of the next snapshot.
+    """
+    parts_dir = SNAPSHOT_DIR / "parts"
+    parts_dir.mkdir(parents=True, exist_ok=True)
+
+    part_name = f"{time.time_ns()}_{os.getpid()}"
+    np.savez(
+        parts_dir / f"{part_name}.tmp.npz",
+        user_ids=user_ids.astype(str),
+        movie_ids=movie_ids.astype(str),
+        scores=scores.astype(np.float32),
+    )
+    os.replace(parts_dir / f"{part_name}.tmp.npz", parts_dir / f"{part_name}.npz")
+
+
+@time_it
+def finalize_snapshot():
+    """
+    Folds the parts recorded since the snapshot was last finalized into it, including parts of an interrupted run.
+    A user recorded more than once keeps their latest part, users without a part keep their snapshot rows.
+    """
+    parts_dir = SNAPSHOT_DIR / "parts"
+    part_paths = sorted(parts_dir.glob("*.npz")) if parts_dir.exists() else []
+    part_paths = [path for path in part_paths if not path.name.endswith(".tmp.npz")]
+
+    if not part_paths:
+        return
+
+    current = RecommendationSnapshot(SNAPSHOT_DIR / "current")
+    current_scores = current.scores.tocoo()
+    parts = [
+        pd.DataFrame(
+            {
+                "user_id": current.user_index.to_numpy()[current_scores.row],
+                "movie_id": current.movie_index.to_numpy()[current_scores.col],
+                "score": current_scores.data,
+                "part": -1,
+            }
+        )
+    ]
+    for part_number, path in enumerate(part_paths):
+        with np.load(path) as part:
+            parts.append(
+                pd.DataFrame(
+                    {
+                        "user_id": part["user_ids"],
+                        "movie_id": part["movie_ids"],
+                        "score": part["scores"],
+                        "part": part_number,
+                    }
+                )
+            )
+    stored = pd.concat(parts, ignore_index=True)
+
+    latest_part = stored.groupby("user_id")["part"].transform("max")
+    stored = stored[stored["part"] == latest_part]
+
+    user_codes, user_ids = pd.factorize(stored["user_id"], sort=True)
+    movie_codes, movie_ids = pd.factorize(stored["movie_id"], sort=True)
+    scores = csr_matrix(
+        (stored["score"].to_numpy(np.float32), (user_codes, movie_codes)),
+        shape=(len(user_ids), len(movie_ids)),
+    )
+    scores.sum_duplicates()
+
+    next_dir = SNAPSHOT_DIR / "next"
+    shutil.rmtree(next_dir, ignore_errors=True)
+    next_dir.mkdir(parents=True)
+    np.save(next_dir / "scores_data.npy", scores.data)
+    np.save(next_dir / "scores_indices.npy", scores.indices)
+    np.save(next_dir / "scores_indptr.npy", scores.indptr)
+    np.save(next_dir / "user_ids.npy", np.asarray(user_ids, dtype=str))
+    np.save(next_dir / "movie_ids.npy", np.asarray(movie_ids, dtype=str))
+
+    current_dir = SNAPSHOT_DIR / "current"
+    previous_dir = SNAPSHOT_DIR / "previous"
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    if current_dir.exists():
+        os.replace(current_dir, previous_dir)
+    os.replace(next_dir, current_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+
+    for path in part_paths:
+        path.unlink()
+    load_snapshot.cache_clear()
+
+    logger.info(
+        f"Recommendation snapshot: {len(user_ids)} users, {scores.nnz} recommendations"
+    )
@@ -1,35 +1,236 @@
 from concurrent.futures import ThreadPoolExecutor
 import datetime
+import os
+import threading
+import numpy as np
 import pandas as pd
 import psycopg
 from psycopg.rows import dict_row
 from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from tqdm import tqdm
-from psycopg.types.json import Jsonb
+from scipy.sparse import csr_matrix
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from common.utils.utils import DB_CONFIG, time_it, user_recommendations
+from dotenv import load_dotenv
+from common.utils.utils import DB_CONFIG, db, time_it, user_recommendations
+from recommendation.model.recommender_models import WatchProviderCandidates
+from recommendation.storage_layout import STORAGE_LAYOUT
+from recommendation.recommendation_snapshot import (
+    DELTA_WRITES,
+    RecommendationSnapshot,
+    compare_with_snapshot,
+    record_stored,
+)
+
+load_dotenv()
+
+# Recommendations kept per user, unset (0) keeps a score for every movie
+STORE_TOP_N = int(os.getenv("RECOMMENDER_STORE_TOP_N", "0")) or None
+
+# "watch_providers" only keeps movies on the user's watch providers in their region, "all" keeps any movie
+STORE_CANDIDATES = os.getenv("RECOMMENDER_STORE_CANDIDATES", "all")
+
+# "upsert" updates external recommendations in place, "replace" bulk loads a versioned collection
+# during the run and swaps it in for user_recommendations once every shard is stored
+MONGO_WRITE_MODE = os.getenv("RECOMMENDER_MONGO_WRITE_MODE", "upsert")
+
+# Also scores external (lb_) users, whose recommendations are stored in MongoDB
+SCORE_EXTERNAL_USERS = (
+    os.getenv("RECOMMENDER_SCORE_EXTERNAL_USERS", "false").lower() == "true"
+)
 
 
 @time_it
-def store_predictions(predicted_df: pd.DataFrame):
-    predicted_df["cf_score"] = predicted_df["cf_score"].round(9)
-    predicted_df["content_score"] = predicted_df["content_score"].round(9)
-    predicted_df["final_score"] = predicted_df["final_score"].round(9)
+def store_predictions(
+    predicted_df: pd.DataFrame,
+    user_ids: np.ndarray,
+    movie_ids: np.ndarray,
+    top_n: int | None = STORE_TOP_N,
+    candidates: WatchProviderCandidates | None = None,
+    model_version: str | None = None,
+    snapshot: RecommendationSnapshot | None = None,
+):
+    """
+    Stores the top hybrid scores of each user, turning user and movie codes back into ids.
+    Rows of these users that were not rewritten, such as movies that dropped out of their top_n, are pruned.
+    :param predicted_df: Scores with user_code and movie_code columns
+    :param user_ids: User ID of each user code
+    :param movie_ids: Movie ID of each movie code
+    :param top_n: Scores kept per user, None keeps all of them
+    :param candidates: Only keeps movies on the user's watch providers, users without providers keep every movie
+    :param model_version: Stored with the arrays layout, defaults to the date the artifacts are versioned by.
+                          External recommendations are staged under it in replace mode.
+    :param snapshot: Scores stored by the previous run, internal rows (or sets) that did not move are not rewritten
+    """
+    predicted_df = select_stored_recommendations(predicted_df, top_n, candidates)
+
+    user_codes = predicted_df["user_code"].to_numpy()
+    predicted_df["user_id"] = user_ids[user_codes]
+    predicted_df["movie_id"] = movie_ids[predicted_df["movie_code"].to_numpy()]
+
+    # Scores can arrive as float32 from the scoring blocks, drivers only adapt python floats
+    predicted_df["cf_score"] = predicted_df["cf_score"].astype(float).round(9)
+    predicted_df["content_score"] = predicted_df["content_score"].astype(float).round(9)
+    predicted_df["final_score"] = predicted_df["final_score"].astype(float).round(9)
 
-    predicted_df.reset_index
+    is_internal_user = np.array([uid.isnumeric() for uid in user_ids], dtype=bool)
+    is_external_user = np.array([uid.startswith("lb_") for uid in user_ids], dtype=bool)
 
-    internal_preds = predicted_df[predicted_df["user_id"].str.isnumeric()]
-    external_preds = predicted_df[predicted_df["user_id"].str.startswith("lb_")]
+    internal_preds = predicted_df[is_internal_user[user_codes]]
+    external_preds = predicted_df[is_external_user[user_codes]]
 
-    __save_internal_predictions_to_postgres(internal_preds)
+    if snapshot is None or internal_preds.empty:
+        is_written = np.ones(len(internal_preds), dtype=bool)
+        previous_score = internal_preds["final_score"].to_numpy()
+    else:
+        is_changed, is_user_changed, previous_score = compare_with_snapshot(
+            snapshot, internal_preds
+        )
+        # a set is rewritten whole, so a user with any moved row is rewritten
+        is_written = is_user_changed if STORAGE_LAYOUT == "arrays" else is_changed
+
+    if STORAGE_LAYOUT == "arrays":
+        __save_internal_prediction_sets_to_postgres(
+            internal_preds[is_written],
+            model_version
+            or datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d"),
+            skipped=len(internal_preds) - int(is_written.sum()),
+        )
+    elif snapshot is None:
+        __save_internal_predictions_to_postgres(internal_preds)
+    else:
+        __save_internal_predictions_to_postgres(
+            internal_preds[is_written], kept_df=internal_preds
+        )
+
+    if not internal_preds.empty:
+        __record_generated(internal_preds["user_id"].unique())
+
+    if (snapshot is not None or DELTA_WRITES) and not internal_preds.empty:
+        # rows that were not rewritten keep their previous score in the database,
+        # online writes are recorded too so the next run compares against them
+        record_stored(
+            internal_preds["user_id"].to_numpy(),
+            internal_preds["movie_id"].to_numpy(),
+            np.where(
+                is_written, internal_preds["final_score"].to_numpy(), previous_score
+            ),
+        )
 
     # Save external (optional)
     if not external_preds.empty:
-        __save_external_recommendations_to_mongo_grouped(external_preds)
+        if MONGO_WRITE_MODE == "replace" and model_version is not None:
+            __stage_external_recommendations_in_mongo(external_preds, model_version)
+        else:
+            __save_external_recommendations_to_mongo_grouped(external_preds)
+
+
+def select_stored_recommendations(
+    predicted_df: pd.DataFrame,
+    top_n: int | None = STORE_TOP_N,
+    candidates: WatchProviderCandidates | None = None,
+) -> pd.DataFrame:
+    if candidates is not None and not predicted_df.empty:
+        predicted_df = predicted_df[
+            __is_candidate(
+                candidates,
+                predicted_df["user_code"].to_numpy(),
+                predicted_df["movie_code"].to_numpy(),
+            )
+        ]
+
+    if top_n is None:
+        return predicted_df
+
+    predicted_df = predicted_df.sort_values(
+        ["user_code", "final_score"], ascending=[True, False], kind="stable"
+    )
+    return predicted_df[predicted_df.groupby("user_code").cumcount() < top_n]
+
+
+def __is_candidate(
+    candidates: WatchProviderCandidates,
+    user_codes: np.ndarray,
+    movie_codes: np.ndarray,
+) -> np.ndarray:
+    unique_user_codes, user_positions = np.unique(user_codes, return_inverse=True)
+    user_offers = candidates.user_offers[unique_user_codes]
+
+    # [n_unique_users x n_movies] number of the user's offers each movie is on
+    available = (user_offers @ candidates.offer_movies).tocsr()
+    is_available = np.asarray(available[user_positions, movie_codes]).ravel() > 0
+
+    has_providers = np.diff(user_offers.indptr) > 0
+    return is_available | ~has_providers[user_positions]
+
+
+@time_it
+def get_watch_provider_candidates(
+    user_ids: np.ndarray, movie_ids: np.ndarray
+) -> WatchProviderCandidates:
+    """
+    Loads which catalog movies each user can watch on their watch providers in their region.
+    :param user_ids: User ID of each user code, only internal users have watch providers
+    :param movie_ids: Movie ID of each catalog movie code
+    """
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT uwp.user_id, uwp.watch_provider_id, u.region
+                FROM user_watch_providers uwp
+                JOIN users u ON u.id = uwp.user_id;
+                """)
+            user_rows = cur.fetchall()
+
+            cur.execute("""
+                SELECT DISTINCT mwp.movie_id::text, mwp.provider_id, mwp.region
+                FROM movie_watch_providers mwp;
+                """)
+            movie_rows = cur.fetchall()
+
+    user_codes = {user_id: code for code, user_id in enumerate(user_ids)}
+    movie_codes = {movie_id: code for code, movie_id in enumerate(movie_ids)}
+    offer_codes = {}
+
+    offer_movie_pairs = [
+        (
+            offer_codes.setdefault((provider_id, region), len(offer_codes)),
+            movie_codes[movie_id],
+        )
+        for movie_id, provider_id, region in movie_rows
+        if movie_id in movie_codes
+    ]
+    user_offer_pairs = [
+        (user_codes[str(user_id)], offer_codes[(provider_id, region)])
+        for user_id, provider_id, region in user_rows
+        if str(user_id) in user_codes and (provider_id, region) in offer_codes
+    ]
+
+    return WatchProviderCandidates(
+        user_offers=__pairs_to_csr(user_offer_pairs, (len(user_ids), len(offer_codes))),
+        offer_movies=__pairs_to_csr(
+            offer_movie_pairs, (len(offer_codes), len(movie_ids))
+        ),
+    )
+
+
+def __pairs_to_csr(pairs: list[tuple[int, int]], shape: tuple[int, int]) -> csr_matrix:
+    rows, cols = np.array(pairs, dtype=np.int32).reshape(-1, 2).T
+
+    return csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
 
 
 @time_it
-def __save_internal_predictions_to_postgres(df: pd.DataFrame):
+def __save_internal_predictions_to_postgres(
+    df: pd.DataFrame, kept_df: pd.DataFrame | None = None
+):
+    """
+    :param df: Rows to upsert
+    :param kept_df: Every row kept for the users, when only the rows that changed are upserted in df.
+                    Rows of these users outside kept_df are pruned.
+    """
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
     with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
         with conn.cursor() as cur:
             batch = [
@@ -39,10 +240,7 @@ def __save_internal_predictions_to_postgres(df: pd.DataFrame):
                     row["final_score"],
                     row["cf_score"],
                     row["content_score"],
-                    build_hybrid_explanation(
-                        row["cf_score"], row.get("explanation", [])
-                    ),
-                    datetime.datetime.now(tz=datetime.timezone.utc),
+                    now,
                 )
                 for _, row in df.iterrows()
             ]
@@ -50,63 +248,187 @@ def __save_internal_predictions_to_postgres(df: pd.DataFrame):
             cur.executemany(
                 """
                 INSERT INTO user_recommendations (
-                    user_id, movie_id, predicted_score, cf_score, content_score, explanation, updated_at
+                    user_id, movie_id, predicted_score, cf_score, content_score, updated_at
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                VALUES (%s, %s, %s, %s, %s, %s)
                 ON CONFLICT (user_id, movie_id)
                 DO UPDATE SET 
                     predicted_score = EXCLUDED.predicted_score,
                     cf_score = EXCLUDED.cf_score,
                     content_score = EXCLUDED.content_score,
-                    explanation = EXCLUDED.explanation,
                     updated_at = EXCLUDED.updated_at;
                 """,
                 batch,
             )
+
+            if kept_df is None:
+                # Everything just written has updated_at = now, older rows of these users are stale
+                cur.execute(
+                    """
+                    DELETE FROM user_recommendations
+                    WHERE user_id = ANY(%s) AND updated_at < %s;
+                    """,
+                    ([int(user_id) for user_id in df["user_id"].unique()], now),
+                )
+            else:
+                # Unchanged rows keep their old updated_at, so stale rows are the ones no longer kept.
+                # NOT EXISTS plans as one hash anti join against the kept pairs
+                cur.execute(
+                    """
+                    DELETE FROM user_recommendations ur
+                    WHERE ur.user_id = ANY(%s)
+                      AND NOT EXISTS (
+                        SELECT 1
+                        FROM unnest(%s::int[], %s::text[]) AS kept(user_id, movie_id)
+                        WHERE kept.user_id = ur.user_id
+                          AND kept.movie_id = ur.movie_id::text
+                      );
+                    """,
+                    (
+                        [int(user_id) for user_id in kept_df["user_id"].unique()],
+                        [int(user_id) for user_id in kept_df["user_id"]],
+                        kept_df["movie_id"].tolist(),
+                    ),
+                )
+            pruned = cur.rowcount
         conn.commit()
 
-    print(f"PostgreSQL: {len(df)} rows modified")
+    skipped = 0 if kept_df is None else len(kept_df) - len(df)
+    print(
+        f"PostgreSQL: {len(df)} rows modified, {skipped} unchanged rows skipped, "
+        f"{pruned} stale rows pruned"
+    )
 
 
-def build_hybrid_explanation(
-    cf_score: float, content_features: list[dict] | None
-) -> Jsonb | None:
+def __record_generated(user_ids: np.ndarray):
     """
-    Builds a hybrid explanation combining CF and content-based insights.
+    Records that these users' recommendations were just generated, read by get_last_recommendation_update.
+    Rows and sets that did not change are not rewritten, so their updated_at can't tell.
     """
-    if not content_features:
-        return None
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
 
-    # Collaborative filtering explanation
-    if cf_score != -999:
-        cf_msg = f"Based on collaborative filtering — similar users liked this movie (score: {cf_score:.2f})"
-    else:
-        cf_msg = "Collaborative filtering data was not available; recommendation is based on movie features"
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                """
+                INSERT INTO user_recommendation_updates (user_id, generated_at)
+                VALUES (%s, %s)
+                ON CONFLICT (user_id)
+                DO UPDATE SET generated_at = EXCLUDED.generated_at;
+                """,
+                [(int(user_id), now) for user_id in user_ids],
+            )
+        conn.commit()
 
-    # Build top features (limit + fallback)
-    summary = "Based on your preference for: " + ", ".join(
-        f.get("feature", "N/A") for f in content_features[:3]
-    )
 
-    return Jsonb(
-        {
-            "cf": cf_msg,
-            "content": {"summary": summary, "top_features": content_features},
-        }
+@time_it
+def __save_internal_prediction_sets_to_postgres(
+    df: pd.DataFrame, model_version: str, skipped: int = 0
+):
+    """
+    Replaces each user's recommendation set, movies ordered by predicted score.
+    :param skipped: Rows of unchanged sets that were left out of df, for reporting
+    """
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    df = df.sort_values(["user_id", "final_score"], ascending=[True, False])
+
+    batch = [
+        (
+            int(user_id),
+            user_df["movie_id"].tolist(),
+            user_df["final_score"].tolist(),
+            user_df["cf_score"].tolist(),
+            user_df["content_score"].tolist(),
+            model_version,
+            now,
+        )
+        for user_id, user_df in df.groupby("user_id", sort=False)
+    ]
+
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                """
+                INSERT INTO user_recommendation_sets (
+                    user_id, movie_ids, predicted_scores, cf_scores, content_scores,
+                    model_version, updated_at
+                )
+                VALUES (%s, %s, %s::real[], %s::real[], %s::real[], %s, %s)
+                ON CONFLICT (user_id)
+                DO UPDATE SET
+                    movie_ids = EXCLUDED.movie_ids,
+                    predicted_scores = EXCLUDED.predicted_scores,
+                    cf_scores = EXCLUDED.cf_scores,
+                    content_scores = EXCLUDED.content_scores,
+                    model_version = EXCLUDED.model_version,
+                    updated_at = EXCLUDED.updated_at;
+                """,
+                batch,
+            )
+        conn.commit()
+
+    print(
+        f"PostgreSQL: {len(batch)} recommendation sets ({len(df)} movies) modified, "
+        f"{skipped} movies in unchanged sets skipped"
     )
 
 
+@time_it
+def store_user_profiles(user_ids: list[str], user_profiles: csr_matrix):
+    """
+    Stores the sparse content profile of each internal user, explanations are built from these on request.
+    :param user_ids: User ID of each profile row
+    :param user_profiles: Sparse profiles [n_users x n_features]
+    """
+    user_profiles = user_profiles.tocsr()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    batch = [
+        (
+            int(user_id),
+            user_profiles.indices[start:end].tolist(),
+            user_profiles.data[start:end].tolist(),
+            now,
+        )
+        for user_id, start, end in zip(
+            user_ids, user_profiles.indptr[:-1], user_profiles.indptr[1:]
+        )
+        if user_id.isnumeric()
+    ]
+
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                """
+                INSERT INTO user_content_profiles (
+                    user_id, feature_indices, feature_weights, updated_at
+                )
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id)
+                DO UPDATE SET
+                    feature_indices = EXCLUDED.feature_indices,
+                    feature_weights = EXCLUDED.feature_weights,
+                    updated_at = EXCLUDED.updated_at;
+                """,
+                batch,
+            )
+        conn.commit()
+
+    print(f"PostgreSQL: {len(batch)} user profiles modified")
+
+
 @time_it
 def __save_external_recommendations_to_mongo_grouped(
     df: pd.DataFrame, batch_size=10000, max_workers=8
 ):
     total_modified = 0
     total_inserted = 0
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
 
     batches = [df.iloc[i : i + batch_size] for i in range(0, len(df), batch_size)]
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(write_batch, batch) for batch in batches]
+        futures = [executor.submit(write_batch, batch, now) for batch in batches]
         for future in tqdm(
             as_completed(futures), total=len(futures), desc="Writing to MongoDB"
         ):
@@ -114,12 +436,20 @@ def __save_external_recommendations_to_mongo_grouped(
             total_inserted += inserted
             total_modified += modified
 
-    print(f"Mongo (parallel): {total_inserted} inserted, {total_modified} updated.")
+    pruned = user_recommendations.delete_many(
+        {
+            "user_id": {"$in": df["user_id"].unique().tolist()},
+            "updated_at": {"$lt": now},
+        }
+    ).deleted_count
 
+    print(
+        f"Mongo (parallel): {total_inserted} inserted, {total_modified} updated, {pruned} stale pruned."
+    )
 
-def write_batch(batch_df: pd.DataFrame):
+
+def write_batch(batch_df: pd.DataFrame, now: datetime.datetime):
     ops = []
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
 
     for row in batch_df.itertuples(index=False):
         ops.append(
@@ -140,3 +470,139 @@ def write_batch(batch_df: pd.DataFrame):
         result = user_recommendations.bulk_write(ops, ordered=False)
         return result.upserted_count, result.modified_count
     return 0, 0
+
+
+def get_external_recommendations_collection(model_version: str) -> str:
+    """
+    :return: Name of the collection external recommendations of a run are staged in
+    """
+    return f"{user_recommendations.name}_v{model_version.replace('-', '')}"
+
+
+def prepare_external_recommendations(model_version: str, resume: bool = False):
+    """
+    Drops collections staged by earlier runs, a resumed run keeps what it already staged.
+    """
+    staging_name = get_external_recommendations_collection(model_version)
+
+    for name in db.list_collection_names():
+        if name.startswith(f"{user_recommendations.name}_v") and (
+            name != staging_name or not resume
+        ):
+            db.drop_collection(name)
+
+
+@time_it
+def __stage_external_recommendations_in_mongo(
+    df: pd.DataFrame, model_version: str, batch_size=10000, max_workers=8
+):
+    """
+    Inserts into the run's staging collection, which has no secondary indexes to maintain until it is swapped in.
+    Documents are keyed by user and movie, so a shard staged twice is only inserted once.
+    """
+    collection = db[get_external_recommendations_collection(model_version)]
+    total_inserted = 0
+    total_duplicates = 0
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    batches = [df.iloc[i : i + batch_size] for i in range(0, len(df), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(insert_batch, collection, batch, now) for batch in batches
+        ]
+        for future in tqdm(
+            as_completed(futures), total=len(futures), desc="Staging in MongoDB"
+        ):
+            inserted, duplicates = future.result()
+            total_inserted += inserted
+            total_duplicates += duplicates
+
+    print(
+        f"Mongo (staged in {collection.name}): {total_inserted} inserted,"
+        f" {total_duplicates} already staged."
+    )
+
+
+def insert_batch(collection, batch_df: pd.DataFrame, now: datetime.datetime):
+    documents = [
+        {
+            "_id": f"{row.user_id}:{row.movie_id}",
+            "user_id": row.user_id,
+            "movie_id": row.movie_id,
+            "final_score": row.final_score,
+            "cf_score": row.cf_score,
+            "content_score": row.content_score,
+            "updated_at": now,
+        }
+        for row in batch_df.itertuples(index=False)
+    ]
+    if not documents:
+        return 0, 0
+
+    try:
+        result = collection.insert_many(documents, ordered=False)
+        return len(result.inserted_ids), 0
+    except BulkWriteError as e:
+        write_errors = e.details["writeErrors"]
+        if any(error["code"] != 11000 for error in write_errors):  # duplicate key
+            raise
+        return e.details["nInserted"], len(write_errors)
+
+
+@time_it
+def swap_external_recommendations(model_version: str):
+    """
+    Builds the indexes of user_recommendations on the run's staging collection and renames it into place.
+    The replaced collection is renamed to a backup first and dropped in the background,
+    so dropping a large collection doesn't hold up the swap.
+    """
+    live_name = user_recommendations.name
+    staging_name = get_external_recommendations_collection(model_version)
+    collection_names = db.list_collection_names()
+
+    if staging_name not in collection_names:
+        print(f"Mongo: nothing staged in {staging_name}, keeping {live_name}")
+        return
+
+    staging = db[staging_name]
+    indexes = {
+        name: spec
+        for name, spec in (
+            user_recommendations.index_information()
+            if live_name in collection_names
+            else {}
+        ).items()
+        if name != "_id_"
+    } or {"user_id_1_movie_id_1": {"key": [("user_id", 1), ("movie_id", 1)]}}
+
+    for name, spec in indexes.items():
+        staging.create_index(
+            spec["key"], name=name, unique=spec.get("unique", False)
+        )  # one sorted build per index instead of an update per insert
+
+    # Readers only miss the collection between the two renames
+    backup_name = f"{live_name}_retired_{model_version.replace('-', '')}"
+    if live_name in collection_names:
+        db.drop_collection(backup_name)  # left by an earlier swap of this version
+        user_recommendations.rename(backup_name)
+    try:
+        staging.rename(live_name)
+    except Exception:
+        if live_name in collection_names:
+            db[backup_name].rename(live_name)
+        raise
+
+    backup_names = [
+        name
+        for name in db.list_collection_names()
+        if name.startswith(f"{live_name}_retired_")
+    ]  # including backups a failed earlier drop left behind
+    threading.Thread(target=__drop_collections, args=(backup_names,)).start()
+
+    print(f"Mongo: swapped {staging_name} in for {live_name}")
+
+
+def __drop_collections(names: list[str]):
+    for name in names:
+        db.drop_collection(name)
@@ -1,7 +1,7 @@
 import datetime
 import threading
 from flask import Blueprint, g, make_response, jsonify, request
-from common.utils import azure_blob
+from common.utils.artifact_registry import artifact_registry
 
 from security.guards import authorization_guard
 
@@ -12,15 +12,18 @@ from security.guards import (
 
 import users.users_service as users_service
 import recommendation.recommendation_service as recommendation_service
+import recommendation.explanation_service as explanation_service
 import recommendation.hybrid_recommendation_service as hybrid_recommendation_service
 from common.utils.utils import cache
 
-
 bp_name = "recommendation"
 bp_url_prefix = "/api/v1.0/recommendation"
 bp = Blueprint(bp_name, __name__, url_prefix=bp_url_prefix)
 LOCK_EXPIRY_SECONDS = 10 * 60
 
+# Read by get_baseline_recs
+artifact_registry.declare(["baseline_recs"])
+
 
 @bp.route("/<int:user_id>", methods=["GET"])
 def getRecommendations(user_id):
@@ -43,6 +46,32 @@ def getRecommendations(user_id):
     )
 
 
+@bp.route("/<int:user_id>/explanation", methods=["GET"])
+@authorization_guard
+def getRecommendationExplanation(user_id):
+    user = users_service.getUserFromAccessToken()
+
+    if user is None:
+        return make_response(jsonify({"error": "Invalid user"}), 404)
+    if user.id != user_id:
+        return make_response(jsonify(unauthorized_error), 401)
+
+    movie_id = request.args.get("movie_id")
+
+    if movie_id is None:
+        return make_response(jsonify({"error": "Invalid Movie Id"}), 400)
+
+    explanation = explanation_service.get_explanation(user_id, movie_id)
+
+    if explanation is None:
+        return make_response(jsonify({"error": "No explanation found"}), 404)
+
+    return make_response(
+        jsonify(explanation),
+        200,
+    )
+
+
 @bp.route("/generate", methods=["GET"])
 @authorization_guard
 def generate_recommendations():
@@ -92,5 +121,5 @@ def generate_recommendations():
 
 
 def get_baseline_recs(movie_id: str):
-    artifacts = azure_blob.load_artifacts()
+    artifacts = artifact_registry.get().artifacts
     return artifacts["baseline_recs"].get(movie_id)
@@ -0,0 +1,136 @@
+import json
+from dataclasses import dataclass
+from pathlib import Path
+import numpy as np
+from scipy.sparse import csr_matrix
+from common.utils.utils import time_it
+from recommendation.model.recommender_models import (
+    CollaborativeFilteringModel,
+    ContentBasedFilteringModel,
+    WatchProviderCandidates,
+)
+
+
+@dataclass
+class ScoringBundle:
+    cf_model: CollaborativeFilteringModel
+    cbf_model: ContentBasedFilteringModel
+    ratings_to_catalog: np.ndarray
+    quality_prior: np.ndarray  # quality boost, row = catalog movie code
+    user_ids: np.ndarray
+    catalog_movie_ids: np.ndarray
+    # Limits the movies stored per user, None stores any movie
+    candidates: WatchProviderCandidates | None = None
+    # Recommendations stored from this bundle are versioned by it, the same for every shard of a run
+    model_version: str | None = None
+    # External (lb_) users are scored along with internal ones
+    score_external_users: bool = False
+
+
+@time_it
+def write_scoring_bundle(bundle_dir: Path, bundle: ScoringBundle):
+    """
+    Writes everything needed to score users as plain .npy files, so scoring processes can memory map them.
+    The TF-IDF vectorizer and raw profiles are not needed to score and are left out.
+    """
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+    cbf_model = bundle.cbf_model
+
+    arrays = {
+        "user_features": bundle.cf_model.user_features,
+        "movie_features": bundle.cf_model.movie_features.astype(np.float32),
+        "profile_user_codes": cbf_model.profile_user_codes,
+        "ratings_to_catalog": bundle.ratings_to_catalog,
+        "user_ids": bundle.user_ids.astype(str),
+        "catalog_movie_ids": bundle.catalog_movie_ids.astype(str),
+        "quality_prior": bundle.quality_prior,
+    }
+    arrays.update(__csr_arrays("normalized_profiles", cbf_model.normalized_profiles))
+    arrays.update(__csr_arrays("movie_vectors_t", cbf_model.movie_vectors_t))
+    shapes = {
+        "normalized_profiles": cbf_model.normalized_profiles.shape,
+        "movie_vectors_t": cbf_model.movie_vectors_t.shape,
+    }
+
+    if bundle.candidates is not None:
+        for name in ["user_offers", "offer_movies"]:
+            matrix = getattr(bundle.candidates, name)
+            arrays.update(__csr_arrays(name, matrix))
+            shapes[name] = matrix.shape
+
+    for name, array in arrays.items():
+        np.save(bundle_dir / f"{name}.npy", np.ascontiguousarray(array))
+
+    with open(bundle_dir / "shapes.json", "w") as f:
+        json.dump(shapes, f)
+
+    with open(bundle_dir / "bundle.json", "w") as f:
+        json.dump(
+            {
+                "model_version": bundle.model_version,
+                "score_external_users": bundle.score_external_users,
+            },
+            f,
+        )
+
+
+@time_it
+def load_scoring_bundle(bundle_dir: Path) -> ScoringBundle:
+    """
+    Memory maps a bundle written by write_scoring_bundle, processes on a host share one page cache copy.
+    """
+    with open(bundle_dir / "shapes.json") as f:
+        shapes = json.load(f)
+
+    with open(bundle_dir / "bundle.json") as f:
+        settings = json.load(f)
+
+    def load(name: str) -> np.ndarray:
+        return np.load(bundle_dir / f"{name}.npy", mmap_mode="r")
+
+    cbf_model = ContentBasedFilteringModel(
+        tfidf_vectorizer=None,
+        tfidf_matrix=None,
+        user_profiles=None,
+        profile_user_codes=load("profile_user_codes"),
+        normalized_profiles=__load_csr(load, "normalized_profiles", shapes),
+        movie_vectors_t=__load_csr(load, "movie_vectors_t", shapes),
+    )
+
+    return ScoringBundle(
+        cf_model=CollaborativeFilteringModel(
+            user_features=load("user_features"),
+            movie_features=load("movie_features"),
+        ),
+        cbf_model=cbf_model,
+        ratings_to_catalog=load("ratings_to_catalog"),
+        quality_prior=load("quality_prior"),
+        user_ids=load("user_ids").astype(object),
+        catalog_movie_ids=load("catalog_movie_ids").astype(object),
+        candidates=(
+            WatchProviderCandidates(
+                user_offers=__load_csr(load, "user_offers", shapes),
+                offer_movies=__load_csr(load, "offer_movies", shapes),
+            )
+            if "user_offers" in shapes
+            else None
+        ),
+        model_version=settings["model_version"],
+        score_external_users=settings["score_external_users"],
+    )
+
+
+def __csr_arrays(name: str, matrix: csr_matrix) -> dict[str, np.ndarray]:
+    return {
+        f"{name}_data": matrix.data,
+        f"{name}_indices": matrix.indices,
+        f"{name}_indptr": matrix.indptr,
+    }
+
+
+def __load_csr(load, name: str, shapes: dict) -> csr_matrix:
+    return csr_matrix(
+        (load(f"{name}_data"), load(f"{name}_indices"), load(f"{name}_indptr")),
+        shape=tuple(shapes[name]),
+        copy=False,
+    )
@@ -0,0 +1,192 @@
+import os
+import threading
+import psycopg
+from psycopg.rows import dict_row
+from dotenv import load_dotenv
+from common.utils.utils import DB_CONFIG
+from common.utils.logging_service import logger
+
+load_dotenv()
+
+# Shared directory the coordinator publishes runs to, must be reachable from every worker node
+RUN_DIR = os.getenv("RECOMMENDER_RUN_DIR", "recommender_runs")
+
+# How often idle workers look for shards whose lease expired
+POLL_SECONDS = int(os.getenv("RECOMMENDER_SHARD_POLL_SECONDS", "30"))
+
+# A shard whose worker has not sent a heartbeat for this long can be claimed by another worker
+LEASE_SECONDS = int(os.getenv("RECOMMENDER_LEASE_SECONDS", "300"))
+
+
+def create_shards(run_id: str, shard_ranges: list[tuple[int, int]]):
+    """
+    Registers the shards of a run, rerunning with the same run_id keeps the progress already made.
+    :param shard_ranges: user code range [start, stop) of each shard
+    """
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                """
+                INSERT INTO recommender_shard_leases (
+                    run_id, shard_id, user_code_start, user_code_stop
+                )
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (run_id, shard_id) DO NOTHING;
+                """,
+                [
+                    (run_id, shard_id, int(start), int(stop))
+                    for shard_id, (start, stop) in enumerate(shard_ranges)
+                ],
+            )
+        conn.commit()
+
+
+def claim_shard(
+    run_id: str, worker_id: str, lease_seconds: int = LEASE_SECONDS
+) -> dict | None:
+    """
+    Leases the next pending shard of a run, or one whose lease expired.
+    SKIP LOCKED lets concurrent workers claim different shards without waiting on each other.
+    :return: shard_id, user_code_start and user_code_stop of the claimed shard, None when nothing is claimable
+    """
+    with psycopg.connect(**DB_CONFIG, row_factory=dict_row) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE recommender_shard_leases
+                SET status = 'leased',
+                    worker_id = %(worker_id)s,
+                    attempts = attempts + 1,
+                    lease_expires_at = NOW() + make_interval(secs => %(lease_seconds)s),
+                    heartbeat_at = NOW()
+                WHERE (run_id, shard_id) = (
+                    SELECT run_id, shard_id
+                    FROM recommender_shard_leases
+                    WHERE run_id = %(run_id)s
+                      AND (
+                        status = 'pending'
+                        OR (status = 'leased' AND lease_expires_at < NOW())
+                      )
+                    ORDER BY shard_id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING shard_id, user_code_start, user_code_stop;
+                """,
+                {
+                    "run_id": run_id,
+                    "worker_id": worker_id,
+                    "lease_seconds": lease_seconds,
+                },
+            )
+            shard = cur.fetchone()
+        conn.commit()
+
+    return shard
+
+
+def renew_lease(
+    run_id: str, shard_id: int, worker_id: str, lease_seconds: int = LEASE_SECONDS
+) -> bool:
+    """
+    Extends a lease held by worker_id.
+    :return: False when the lease was lost to another worker
+    """
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE recommender_shard_leases
+                SET lease_expires_at = NOW() + make_interval(secs => %s),
+                    heartbeat_at = NOW()
+                WHERE run_id = %s AND shard_id = %s
+                  AND worker_id = %s AND status = 'leased';
+                """,
+                (lease_seconds, run_id, shard_id, worker_id),
+            )
+            renewed = cur.rowcount == 1
+        conn.commit()
+
+    return renewed
+
+
+def complete_shard(run_id: str, shard_id: int, worker_id: str) -> bool:
+    """
+    Marks a shard done, only if worker_id still holds its lease.
+    :return: False when another worker took the shard over, its stored rows are then rewritten by that worker
+    """
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE recommender_shard_leases
+                SET status = 'done', completed_at = NOW(), lease_expires_at = NULL
+                WHERE run_id = %s AND shard_id = %s
+                  AND worker_id = %s AND status = 'leased';
+                """,
+                (run_id, shard_id, worker_id),
+            )
+            completed = cur.rowcount == 1
+        conn.commit()
+
+    return completed
+
+
+def count_unfinished_shards(run_id: str) -> int:
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT COUNT(*)
+                FROM recommender_shard_leases
+                WHERE run_id = %s AND status <> 'done';
+                """,
+                (run_id,),
+            )
+            (unfinished,) = cur.fetchone()
+
+    return unfinished
+
+
+class LeaseHeartbeat:
+    """
+    Renews a shard lease in the background while the shard is scored and stored.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        shard_id: int,
+        worker_id: str,
+        lease_seconds: int = LEASE_SECONDS,
+    ):
+        self.run_id = run_id
+        self.shard_id = shard_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+
+    def _beat(self):
+        while not self._stopped.wait(self.lease_seconds / 3):
+            try:
+                if not renew_lease(
+                    self.run_id, self.shard_id, self.worker_id, self.lease_seconds
+                ):
+                    self.lost = True
+                    logger.warning(
+                        f"Lease on shard {self.shard_id} of run {self.run_id} was lost"
+                    )
+                    return
+            except Exception as e:
+                # a missed heartbeat is retried, the lease only lapses after lease_seconds
+                logger.warning(f"Heartbeat for shard {self.shard_id} failed: {e}")
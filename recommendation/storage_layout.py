@@ -0,0 +1,19 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "rows" stores a user_recommendations row per (user, movie), "arrays" a user_recommendation_sets row per user
+STORAGE_LAYOUT = os.getenv("RECOMMENDER_STORAGE_LAYOUT", "rows")
+
+# Relation read paths query, the view unnests the arrays layout into the same columns as the rows layout
+RECOMMENDATIONS_RELATION = {
+    "rows": "user_recommendations",
+    "arrays": "user_recommendation_pairs",
+}[STORAGE_LAYOUT]
+
+# Database function listing movies with the users recommendation scores, reading RECOMMENDATIONS_RELATION
+RECOMMENDATION_SCORE_FUNCTION = {
+    "rows": "get_filtered_movies_with_recommendation_score",
+    "arrays": "get_filtered_movies_with_recommendation_score_arrays",
+}[STORAGE_LAYOUT]
@@ -73,7 +73,7 @@ def add_review(
 
     deactivate_rating_query = """
     UPDATE user_movie_interactions 
-    SET active = FALSE 
+    SET active = FALSE, updated_at = NOW()
     WHERE movie_id = %s AND user_id = %s AND interaction_type = 'RATING' AND active = TRUE;
     """
 
@@ -0,0 +1,123 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+from common.utils import azure_blob
+from common.utils.artifact_storage import LocalDirectoryStorage
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = LocalDirectoryStorage(tmp_path / "storage")
+    monkeypatch.setattr(azure_blob, "storage", storage)
+    monkeypatch.setattr(azure_blob, "CACHE_DIR", tmp_path / "cache")
+    (tmp_path / "cache").mkdir()
+    monkeypatch.setattr(azure_blob.time, "sleep", lambda seconds: None)
+    return storage
+
+
+def save_all_artifacts(version: str, movie_quality_prior=np.zeros(3)):
+    azure_blob.save_all_artifacts(
+        tfidf_vectorizer={"vocabulary": ["drama"]},
+        movie_ids=np.array(["a" * 24, "b" * 24, "c" * 24]),
+        item_feature_matrix=csr_matrix(np.eye(3)),
+        baseline_recs=pd.DataFrame({"movie_id": ["a" * 24]}),
+        movie_features=np.ones((2, 3)),
+        movie_features_movie_codes=np.arange(3),
+        movies_metadata=pd.DataFrame({"popularity": [1.0, 2.0, 3.0]}),
+        movie_quality_prior=movie_quality_prior,
+        version=version,
+    )
+
+
+def count_downloads(storage, monkeypatch) -> list[str]:
+    """
+    :return: blob paths downloaded from now on, requests answered as not modified are left out
+    """
+    downloads = []
+    download = storage.download
+
+    def counted_download(blob_path, *args):
+        etag = download(blob_path, *args)
+        if etag is not None:
+            downloads.append(blob_path)
+        return etag
+
+    monkeypatch.setattr(storage, "download", counted_download)
+    return downloads
+
+
+def test_artifacts_are_read_through_the_published_manifest(storage, monkeypatch):
+    save_all_artifacts("2025-01-01", movie_quality_prior=np.array([0.1, 0.2, 0.3]))
+
+    manifest = azure_blob.read_manifest()
+    assert manifest["version"] == "2025-01-01"
+    assert not (storage.root / "latest" / "movie_quality_prior.npy").exists()
+
+    downloads = count_downloads(storage, monkeypatch)
+    artifacts = azure_blob.load_artifacts(keys=["movie_quality_prior", "movie_ids"])
+
+    np.testing.assert_array_equal(artifacts["movie_quality_prior"], [0.1, 0.2, 0.3])
+    assert sorted(downloads) == [
+        "2025-01-01/movie_ids.npy",
+        "2025-01-01/movie_quality_prior.npy",
+    ]
+
+
+def test_cached_artifacts_of_a_version_are_not_downloaded_again(storage, monkeypatch):
+    save_all_artifacts("2025-01-01")
+    azure_blob.load_artifacts(keys=["movie_quality_prior"])
+
+    downloads = count_downloads(storage, monkeypatch)
+    azure_blob.load_artifacts(keys=["movie_quality_prior"])
+    assert downloads == []
+
+    save_all_artifacts("2025-01-02", movie_quality_prior=np.ones(3))
+    artifacts = azure_blob.load_artifacts(keys=["movie_quality_prior"])
+
+    np.testing.assert_array_equal(artifacts["movie_quality_prior"], np.ones(3))
+    assert downloads == ["2025-01-02/movie_quality_prior.npy"]
+
+
+def test_unlisted_artifacts_are_only_downloaded_when_their_etag_changed(
+    storage, monkeypatch
+):
+    azure_blob.save_and_upload_artifact(
+        "external_interactions_transformed", pd.DataFrame({"user_id": ["lb_1"]})
+    )
+    path = azure_blob.CACHE_DIR / "external_interactions_transformed.parquet"
+    path.unlink()  # as on a host that didn't upload it
+
+    downloads = count_downloads(storage, monkeypatch)
+    azure_blob.get_artifact_path("external_interactions_transformed")
+    azure_blob.get_artifact_path("external_interactions_transformed")
+
+    assert downloads == ["latest/external_interactions_transformed.parquet"]
+    assert len(list(azure_blob.CACHE_DIR.glob("*.tmp"))) == 0
+    assert json.loads((azure_blob.CACHE_DIR / f"{path.name}.etag.json").read_text())[
+        "sha256"
+    ] == azure_blob.get_file_sha256(path)
+
+
+def test_manifest_is_not_published_when_an_upload_fails(storage, monkeypatch):
+    save_all_artifacts("2025-01-01")
+
+    upload = storage.upload
+
+    def fail_quality_prior(local_path, blob_path):
+        if blob_path.endswith("movie_quality_prior.npy"):
+            raise OSError("upload failed")
+        return upload(local_path, blob_path)
+
+    monkeypatch.setattr(storage, "upload", fail_quality_prior)
+
+    with pytest.raises(ValueError, match="movie_quality_prior"):
+        save_all_artifacts("2025-01-02")
+
+    assert azure_blob.read_manifest()["version"] == "2025-01-01"
+
+
+def test_artifacts_are_not_loaded_without_a_manifest(storage):
+    with pytest.raises(FileNotFoundError):
+        azure_blob.load_artifacts(keys=["movie_quality_prior"])
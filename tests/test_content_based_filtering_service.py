@@ -0,0 +1,45 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from recommendation import content_based_filtering_service
+
+MOVIE_IDS = np.array(["a" * 24, "b" * 24, "c" * 24])
+FEATURE_NAMES = np.array(["drama", "comedy", "horror", "action"])
+ITEM_FEATURES = np.array(
+    [
+        [0.0, 0.6, 0.8, 0.0],
+        [0.5, 0.0, 0.5, 0.7],
+        [1.0, 0.0, 0.0, 0.0],
+    ]
+)
+
+
+def explain(item_feature_matrix, movie_id: str, top_n: int = 10) -> list[dict]:
+    user_vector = np.array([0.2, 0.0, 0.9, 0.4])
+    return content_based_filtering_service.explain_recommendation(
+        user_vector, movie_id, MOVIE_IDS, item_feature_matrix, FEATURE_NAMES, top_n
+    )
+
+
+def test_explain_recommendation_ranks_positive_contributions():
+    explanation = explain(ITEM_FEATURES, "b" * 24)
+
+    assert [feature["feature"] for feature in explanation] == [
+        "horror",
+        "action",
+        "drama",
+    ]
+    assert np.isclose(explanation[0]["score"], 0.45)
+
+
+def test_explain_recommendation_matches_for_sparse_item_features():
+    assert explain(csr_matrix(ITEM_FEATURES), "b" * 24) == explain(
+        ITEM_FEATURES, "b" * 24
+    )
+
+
+def test_explain_recommendation_limits_to_top_n():
+    assert len(explain(ITEM_FEATURES, "b" * 24, top_n=1)) == 1
+
+
+def test_explain_recommendation_unknown_movie():
+    assert explain(ITEM_FEATURES, "z" * 24) == []
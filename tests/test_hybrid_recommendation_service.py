@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+from recommendation import benchmarks, hybrid_recommendation_service
+
+NAN = np.nan
+
+
+def hybrid_frame() -> pd.DataFrame:
+    # User 0 is internal, user 1 external; each has a movie with only a CF score
+    return pd.DataFrame(
+        {
+            "user_code": np.array([0, 0, 0, 1, 1], dtype=np.int32),
+            "movie_code": np.array([0, 1, 2, 0, 1], dtype=np.int32),
+            "content_score": [0.4, NAN, 1.0, NAN, NAN],
+            "cf_score": [1.0, 0.5, NAN, 0.2, 0.9],
+        }
+    )
+
+
+def test_compute_hybrid_scores_blends_cf_and_content():
+    scores = hybrid_recommendation_service.compute_hybrid_scores(hybrid_frame())
+
+    np.testing.assert_allclose(
+        scores["raw_final_score"], [0.82, NAN, 0.8, NAN, NAN], equal_nan=True
+    )
+
+
+def test_compute_hybrid_scores_ranks_external_users_on_cf_alone():
+    scores = hybrid_recommendation_service.compute_hybrid_scores(
+        hybrid_frame(), external_user_codes=np.array([1], dtype=np.int32)
+    )
+
+    np.testing.assert_allclose(scores["raw_final_score"][3:], [0.2, 0.9])
+
+
+def test_compute_hybrid_scores_leaves_internal_users_unchanged():
+    internal = hybrid_recommendation_service.compute_hybrid_scores(hybrid_frame())
+    with_external = hybrid_recommendation_service.compute_hybrid_scores(
+        hybrid_frame(), external_user_codes=np.array([1], dtype=np.int32)
+    )
+
+    np.testing.assert_array_equal(
+        with_external["raw_final_score"][:3], internal["raw_final_score"][:3]
+    )
+
+
+def test_normalize_per_user_matches_groupby_apply():
+    columns = ["content_score", "cf_score"]
+    df = benchmarks.__build_hybrid_frame(n_users=30, n_movies=40)
+
+    expected = benchmarks.__normalize_per_user_apply(df.copy(), columns)
+    result = hybrid_recommendation_service.normalize_per_user(df.copy(), columns)
+
+    pd.testing.assert_frame_equal(
+        result.sort_index(), expected.sort_index(), check_exact=True
+    )
+
+
+def test_apply_quality_boost_matches_metadata_merge():
+    df = benchmarks.__build_hybrid_frame(n_users=5, n_movies=200)
+    df["raw_final_score"] = df["content_score"]
+    metadata = benchmarks.__build_quality_metadata(n_movies=200)
+
+    expected = benchmarks.__apply_quality_boost_merge(df.copy(), metadata)
+    result = hybrid_recommendation_service.apply_quality_boost(
+        df.copy(), hybrid_recommendation_service.compute_quality_prior(metadata)
+    )
+
+    np.testing.assert_allclose(result["final_score"], expected["final_score"])
+
+
+def test_merge_scores_outer_joins_on_user_and_movie():
+    content_scores = (
+        np.array([0, 2, 2], dtype=np.int32),
+        np.array([3, 0, 4], dtype=np.int32),
+        np.array([0.1, 0.2, 0.3]),
+    )
+    cf_scores = (
+        np.array([2, 0], dtype=np.int32),
+        np.array([4, 1], dtype=np.int32),
+        np.array([0.9, 0.8]),
+    )
+
+    merged = hybrid_recommendation_service.merge_scores(
+        content_scores, cf_scores, n_movies=5
+    )
+
+    assert merged["user_code"].tolist() == [0, 0, 2, 2]
+    assert merged["movie_code"].tolist() == [1, 3, 0, 4]
+    np.testing.assert_array_equal(merged["content_score"], [NAN, 0.1, 0.2, 0.3])
+    np.testing.assert_array_equal(merged["cf_score"], [0.8, NAN, NAN, 0.9])
+
+
+def test_merge_scores_keeps_users_apart_past_int32_keys():
+    # user code * n_movies overflows int32, pair keys are int64
+    n_movies = 100_000
+    user_codes = np.array([30_000, 30_001], dtype=np.int32)
+    movie_codes = np.array([n_movies - 1, 0], dtype=np.int32)
+
+    merged = hybrid_recommendation_service.merge_scores(
+        (user_codes, movie_codes, np.array([0.1, 0.2])),
+        (user_codes, movie_codes, np.array([0.3, 0.4])),
+        n_movies,
+    )
+
+    assert merged["user_code"].tolist() == [30_000, 30_001]
+    assert merged["movie_code"].tolist() == [n_movies - 1, 0]
+    np.testing.assert_array_equal(merged["cf_score"], [0.3, 0.4])
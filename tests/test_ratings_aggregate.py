@@ -0,0 +1,102 @@
+import datetime
+import numpy as np
+import pandas as pd
+from recommendation import ratings_aggregate, ratings_matrix
+
+REFERENCE_DATE = datetime.date(2025, 1, 10)
+WATERMARK = datetime.datetime(2025, 1, 10, 12, tzinfo=datetime.timezone.utc)
+
+
+def interaction(
+    id: int, movie_id: str, created: int, changed: int, active: bool = True
+) -> dict:
+    """
+    :param created: minutes after the watermark the interaction was created
+    :param changed: minutes after the watermark it was last changed
+    """
+    return {
+        "id": id,
+        "user_id": "1",
+        "movie_id": movie_id,
+        "interaction_type": "RATING",
+        "rating": 8.0,
+        # interactions are stored without a time zone, the watermark is read with one
+        "created_at": WATERMARK.replace(tzinfo=None)
+        + datetime.timedelta(minutes=created),
+        "changed_at": WATERMARK + datetime.timedelta(minutes=changed),
+        "active": active,
+    }
+
+
+def get_directions(rows: list[dict], since, overlap: dict) -> list[int]:
+    return ratings_aggregate.__get_directions(
+        pd.DataFrame(rows), since, overlap
+    ).tolist()
+
+
+def test_directions_without_a_watermark_add_active_interactions():
+    rows = [interaction(1, "a", -60, -60), interaction(2, "b", -30, -10, False)]
+
+    assert get_directions(rows, None, {}) == [1, 0]
+
+
+def test_directions_apply_each_change_once():
+    rows = [
+        interaction(1, "a", -60, 5, active=False),  # applied before, now deactivated
+        interaction(2, "b", 5, 5),  # created since the watermark
+        interaction(3, "c", -30, 5),  # read again in the overlap, recorded active
+        interaction(4, "d", -30, 5, active=False),  # deactivated within the overlap
+    ]
+
+    assert get_directions(rows, WATERMARK, {"3": True, "4": True}) == [-1, 1, 0, -1]
+
+
+def test_overlap_records_interactions_changed_after_the_watermark():
+    rows = pd.DataFrame(
+        [interaction(1, "a", -60, -5), interaction(2, "b", -60, 5, active=False)]
+    )
+
+    assert ratings_aggregate.__get_overlap(rows, WATERMARK) == {"2": False}
+
+
+def test_reads_overlapping_the_watermark_match_a_rebuild():
+    # first read, lagging the watermark: "b", "c" and "e" changed after it and are read again next time
+    first = [
+        interaction(1, "a", -120, -120),
+        interaction(2, "b", -90, 5),
+        interaction(3, "c", -60, 5, active=False),
+        interaction(5, "e", 3, 3),
+    ]
+    # second read, since the watermark: "b" was deactivated meanwhile, "c" and "e" are unchanged and "d" is new
+    second = [
+        interaction(2, "b", -90, 20, active=False),
+        interaction(3, "c", -60, 5, active=False),
+        interaction(4, "d", 10, 10),
+        interaction(5, "e", 3, 3),
+    ]
+
+    aggregate = apply(None, first, since=None, overlap={})
+    overlap = ratings_aggregate.__get_overlap(pd.DataFrame(first), WATERMARK)
+    aggregate = apply(aggregate, second, since=WATERMARK, overlap=overlap)
+
+    rebuilt = ratings_matrix.aggregate_interactions(
+        pd.DataFrame(
+            [
+                interaction(1, "a", -120, -120),
+                interaction(4, "d", 10, 10),
+                interaction(5, "e", 3, 3),
+            ]
+        ),
+        REFERENCE_DATE,
+    )
+    pd.testing.assert_frame_equal(aggregate, rebuilt, check_dtype=False)
+
+
+def apply(aggregate, rows: list[dict], since, overlap: dict) -> pd.DataFrame:
+    interactions = pd.DataFrame(rows)
+    return ratings_aggregate.__apply_interactions(
+        aggregate,
+        interactions,
+        ratings_aggregate.__get_directions(interactions, since, overlap),
+        REFERENCE_DATE,
+    )
@@ -0,0 +1,29 @@
+import datetime
+import pandas as pd
+from recommendation import benchmarks, ratings_matrix
+
+REFERENCE_DATE = datetime.date(2025, 1, 1)
+
+
+def test_aggregate_interactions_matches_pandas_masks():
+    df = benchmarks.__build_interactions_frame(n_rows=2_000)
+
+    expected = benchmarks.__aggregate_interactions_masks(df.copy(), REFERENCE_DATE)
+    result = ratings_matrix.aggregate_interactions(df, REFERENCE_DATE)
+
+    pd.testing.assert_frame_equal(
+        result[["user_id", "movie_id", "final_score"]], expected, check_exact=False
+    )
+
+
+def test_aggregate_interactions_counts_interactions_per_pair():
+    df = benchmarks.__build_interactions_frame(n_rows=2_000)
+
+    result = ratings_matrix.aggregate_interactions(df, REFERENCE_DATE)
+
+    expected = (
+        df.astype({"user_id": str, "movie_id": str})
+        .groupby(["user_id", "movie_id"])
+        .size()
+    )
+    assert result["interaction_count"].tolist() == expected.tolist()
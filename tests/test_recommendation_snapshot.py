@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+from recommendation import recommendation_snapshot
+
+
+def store(snapshot_dir, monkeypatch, rows: list[tuple[str, str, float]]):
+    monkeypatch.setattr(recommendation_snapshot, "SNAPSHOT_DIR", snapshot_dir)
+    user_ids, movie_ids, scores = zip(*rows)
+    recommendation_snapshot.record_stored(
+        np.array(user_ids), np.array(movie_ids), np.array(scores)
+    )
+    recommendation_snapshot.finalize_snapshot()
+
+    return recommendation_snapshot.RecommendationSnapshot(snapshot_dir / "current")
+
+
+def recommendations(rows: list[tuple[str, str, float]]) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=["user_id", "movie_id", "final_score"])
+
+
+def test_previous_looks_up_stored_scores_and_ranks(tmp_path, monkeypatch):
+    snapshot = store(
+        tmp_path, monkeypatch, [("1", "a", 0.5), ("1", "b", 0.9), ("2", "a", 0.1)]
+    )
+
+    score, rank, count = snapshot.previous(
+        np.array(["1", "1", "1", "2", "3"]), np.array(["a", "b", "c", "a", "a"])
+    )
+
+    np.testing.assert_allclose(score, [0.5, 0.9, np.nan, 0.1, np.nan])
+    assert rank.tolist() == [1, 0, -1, 0, -1]
+    assert count.tolist() == [2, 2, 2, 1, 0]
+
+
+def test_compare_with_snapshot_flags_moved_scores_and_their_users(
+    tmp_path, monkeypatch
+):
+    monkeypatch.setattr(recommendation_snapshot, "SCORE_THRESHOLD", 0.01)
+    snapshot = store(
+        tmp_path,
+        monkeypatch,
+        [("1", "a", 0.9), ("1", "b", 0.5), ("2", "a", 0.9), ("2", "b", 0.5)],
+    )
+
+    changed, user_changed, previous = recommendation_snapshot.compare_with_snapshot(
+        snapshot,
+        recommendations(
+            [("1", "a", 0.905), ("1", "b", 0.6), ("2", "a", 0.9), ("2", "b", 0.5)]
+        ),
+    )
+
+    assert changed.tolist() == [False, True, False, False]
+    assert user_changed.tolist() == [True, True, False, False]
+    np.testing.assert_allclose(previous, [0.9, 0.5, 0.9, 0.5], rtol=1e-6)
+
+
+def test_compare_with_snapshot_flags_users_with_fewer_recommendations(
+    tmp_path, monkeypatch
+):
+    snapshot = store(tmp_path, monkeypatch, [("1", "a", 0.9), ("1", "b", 0.5)])
+
+    changed, user_changed, _ = recommendation_snapshot.compare_with_snapshot(
+        snapshot, recommendations([("1", "a", 0.9)])
+    )
+
+    assert changed.tolist() == [False]
+    assert user_changed.tolist() == [True]
+
+
+def test_finalize_snapshot_keeps_the_latest_part_per_user(tmp_path, monkeypatch):
+    store(tmp_path, monkeypatch, [("1", "a", 0.9), ("1", "b", 0.5), ("2", "a", 0.3)])
+    snapshot = store(tmp_path, monkeypatch, [("1", "c", 0.7)])
+
+    score, _, count = snapshot.previous(
+        np.array(["1", "1", "2"]), np.array(["a", "c", "a"])
+    )
+
+    np.testing.assert_allclose(score, [np.nan, 0.7, 0.3], rtol=1e-6)
+    assert count.tolist() == [1, 1, 1]
@@ -0,0 +1,47 @@
+import time
+from recommendation import shard_leases
+
+
+def test_heartbeat_renews_the_lease_until_stopped(monkeypatch):
+    renewals = []
+    monkeypatch.setattr(
+        shard_leases,
+        "renew_lease",
+        lambda *args: renewals.append(args) or True,
+    )
+
+    with shard_leases.LeaseHeartbeat("run", 3, "worker", lease_seconds=0.03) as beat:
+        time.sleep(0.1)
+    renewed = len(renewals)
+    time.sleep(0.05)
+
+    assert renewed > 0 and len(renewals) == renewed
+    assert renewals[0] == ("run", 3, "worker", 0.03)
+    assert not beat.lost
+
+
+def test_heartbeat_marks_a_lease_taken_over_as_lost(monkeypatch):
+    monkeypatch.setattr(shard_leases, "renew_lease", lambda *args: False)
+
+    with shard_leases.LeaseHeartbeat("run", 3, "worker", lease_seconds=0.03) as beat:
+        time.sleep(0.1)
+
+    assert beat.lost
+
+
+def test_heartbeat_retries_after_a_failed_renewal(monkeypatch):
+    attempts = []
+
+    def renew_lease(*args):
+        attempts.append(args)
+        if len(attempts) == 1:
+            raise ConnectionError("database unavailable")
+        return True
+
+    monkeypatch.setattr(shard_leases, "renew_lease", renew_lease)
+
+    with shard_leases.LeaseHeartbeat("run", 3, "worker", lease_seconds=0.03) as beat:
+        time.sleep(0.1)
+
+    assert len(attempts) > 1
+    assert not beat.lost
@@ -1,3 +1,4 @@
+import datetime
 from typing import List
 import psycopg
 
@@ -118,6 +119,60 @@ def get_all_user_interactions() -> List[UserMovieInteraction]:
     return user_interactions
 
 
+@time_it
+def get_interactions_changed_since(
+    since: datetime.datetime | None,
+    user_id: int | None = None,
+    lag_seconds: int = 0,
+) -> tuple[List[UserMovieInteraction], datetime.datetime]:
+    """
+    Interactions created or deactivated after since, up to the time of the read, with their id and changed_at.
+    Rows are stamped by NOW() before their transaction commits, so the next read starts lag_seconds before this one
+    and rows changed in that overlap are read twice, see ratings_aggregate.__get_directions.
+    :param since: Watermark of the previous read, None reads every active interaction and the deactivations in the overlap
+    :param user_id: Only reads this user's interactions
+    :param lag_seconds: Longest a transaction writing interactions is expected to take
+    :return: interactions and the watermark to read from next time
+    """
+    select_query = """
+    SELECT umi.id, user_id, movie_id, rating, interaction_type, created_at, active,
+        COALESCE(umi.updated_at, umi.created_at) AS changed_at
+    FROM user_movie_interactions umi
+    INNER JOIN movies ON umi.movie_id = movies.id
+    WHERE COALESCE(umi.updated_at, umi.created_at) <= %(read_at)s
+    """
+    if user_id is not None:
+        select_query += "AND user_id = %(user_id)s\n"
+    if since is None:
+        # deactivations in the overlap are read too, so they are not taken back out next time
+        select_query += """
+        AND (active = TRUE OR COALESCE(umi.updated_at, umi.created_at) > %(watermark)s);
+        """
+    else:
+        select_query += "AND COALESCE(umi.updated_at, umi.created_at) > %(since)s;"
+
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                "SELECT NOW() AS read_at, NOW() - make_interval(secs => %s) AS watermark;",
+                (lag_seconds,),
+            )
+            read = cur.fetchone()
+
+            cur.execute(
+                select_query,
+                {
+                    "since": since,
+                    "read_at": read["read_at"],
+                    "watermark": read["watermark"],
+                    "user_id": user_id,
+                },
+            )
+            user_interactions = [UserMovieInteraction(**row) for row in cur.fetchall()]
+
+    return user_interactions, read["watermark"]
+
+
 @time_it
 def get_users_interactions(user_id: int) -> List[UserMovieInteraction]:
     select_query = """